@@ -0,0 +1,70 @@
+"""
+Benchmarks for the parking queries and endpoints.
+
+Every benchmark seeds a throwaway test database, so they can be run against a
+checkout with real data, from the project root:
+
+    python -m benchmarks.anti_join
+"""
+import contextlib
+import os
+import time
+
+import django
+
+
+def setup():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'parking_demo.settings')
+    django.setup()
+
+
+@contextlib.contextmanager
+def test_database():
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def timed(func, repeat):
+    """
+    Run func repeat times.
+
+    :return: the wall clock seconds of every run
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def report(name, samples):
+    print('%-28s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms' % (
+        name, percentile(samples, 50) * 1000, percentile(samples, 95) * 1000, percentile(samples, 99) * 1000))
+
+
+def summary(samples):
+    """
+    Latency percentiles in milliseconds and the sequential throughput of the samples.
+    """
+    return {
+        'runs': len(samples),
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'per_second': len(samples) / sum(samples) if sum(samples) else None,
+    }
@@ -0,0 +1,77 @@
+"""
+Time filtered search: the legacy DbUtils.join_to LEFT JOIN against the NOT EXISTS
+anti-join of ParkingSpotReservation.exclude_reserved, on spots with a long
+reservation history.
+
+    python -m benchmarks.anti_join [spots] [reservations per spot]
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+
+from benchmarks import report, setup, test_database, timed
+
+
+def seed(spot_count, reservations_per_spot):
+    from django.utils import timezone
+    from parking.models import ParkingSpot, ParkingSpotReservation
+
+    rnd = random.Random(42)
+    ParkingSpot.objects.bulk_create(
+        ParkingSpot(location=ParkingSpot.create_point(37.78 + rnd.uniform(-0.005, 0.005),
+                                                      -122.39 + rnd.uniform(-0.005, 0.005)),
+                    address='spot %s' % i)
+        for i in range(spot_count))
+
+    epoch = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    reservations = []
+    for spot_id in ParkingSpot.objects.values_list('id', flat=True):
+        for slot in range(reservations_per_spot):
+            start = epoch + timedelta(hours=2 * slot)
+            reservations.append(ParkingSpotReservation(user_id=rnd.randint(1, 1000), parkingspot_id=spot_id,
+                                                       start_ts=start, end_ts=start + timedelta(hours=1)))
+    ParkingSpotReservation.objects.bulk_create(reservations, batch_size=500)
+    return epoch
+
+
+def legacy_query(queryset, start_ts, end_ts):
+    from django.db.models import Q
+    from parking.models import DbUtils, ParkingSpot, ParkingSpotReservation
+
+    join_query = DbUtils.join_to(ParkingSpot, ParkingSpotReservation, 'id', 'id', queryset)
+    return join_query.filter(
+        Q(parkingspotreservation__isnull=True)
+        | Q(parkingspotreservation__start_ts__gt=end_ts)
+        | Q(parkingspotreservation__end_ts__lt=start_ts)
+    )
+
+
+def search(query):
+    list(query()[:10])
+    query().count()
+
+
+def main(spot_count=500, reservations_per_spot=200, repeat=20):
+    from django.test.utils import override_settings
+    from parking.models import ParkingSpot, ParkingSpotReservation
+
+    with test_database(), override_settings(PARKING_AVAILABILITY_ENGINE=False, PARKING_SPATIAL_INDEX=False):
+        epoch = seed(spot_count, reservations_per_spot)
+        # inside the history, overlapping one reservation of every spot
+        start_ts = epoch + timedelta(hours=reservations_per_spot, minutes=30)
+        end_ts = start_ts + timedelta(minutes=45)
+        candidates = ParkingSpot.in_range(37.78, -122.39, 2000)
+
+        queries = (
+            ('legacy LEFT JOIN', lambda: legacy_query(candidates, start_ts, end_ts)),
+            ('NOT EXISTS anti-join', lambda: ParkingSpotReservation.exclude_reserved(candidates, start_ts, end_ts)),
+        )
+        print('%s spots, %s reservations per spot' % (spot_count, reservations_per_spot))
+        for name, query in queries:
+            print('%-28s count() = %s' % (name, query().count()))
+            report(name, timed(lambda: search(query), repeat))
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
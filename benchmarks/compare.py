@@ -0,0 +1,43 @@
+"""
+Compare two benchmarks.hot_endpoints result files.
+
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 10]
+
+Exits with status 1 when the p50 or p95 of a scenario got slower by more than the
+threshold percentage.
+"""
+import argparse
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='allowed slowdown in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+
+    print('%s -> %s' % ((baseline.get('commit') or '?')[:10], (candidate.get('commit') or '?')[:10]))
+    regressions = 0
+    for size, scenarios in sorted(candidate['sizes'].items(), key=lambda item: int(item[0])):
+        for name, stats in sorted(scenarios.items()):
+            before = baseline['sizes'].get(size, {}).get(name)
+            if before is None:
+                continue
+            for metric in ('p50_ms', 'p95_ms'):
+                change = (stats[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+                flag = ''
+                if change > args.threshold:
+                    flag = '  REGRESSION'
+                    regressions += 1
+                print('%10s %-28s %-6s %9.2f -> %9.2f ms  %+7.1f%%%s' % (
+                    size, name, metric[:3], before[metric], stats[metric], change, flag))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Latency percentiles and throughput of the hot paths, ParkingSpot.within_range and the
+available and reserve views, over synthetic cities of growing size. Results are
+written as JSON so runs of different commits can be compared with benchmarks.compare.
+
+    DJANGO_LOG_LEVEL=WARNING python -m benchmarks.hot_endpoints --sizes 10000,100000 --output results.json
+"""
+import argparse
+import json
+import random
+import subprocess
+import time
+from datetime import timedelta
+
+from benchmarks import report, setup, summary, test_database, timed
+from benchmarks.synthetic import generate, spot_coordinates
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scenarios(start, seed):
+    from django.test import Client
+    from django.urls import reverse
+    from parking.models import ParkingSpot
+
+    rnd = random.Random(seed)
+    client = Client()
+    spot_count = ParkingSpot.objects.count()
+    points = list(spot_coordinates(rnd, 1000))
+
+    def point():
+        return points[rnd.randrange(len(points))]
+
+    def window():
+        begin = start + timedelta(minutes=15 * rnd.randrange(7 * 24 * 4))
+        return begin, begin + timedelta(hours=1)
+
+    def within_range(radius, with_window):
+        def run():
+            lat, lng = point()
+            total, page = ParkingSpot.within_range(lat, lng, radius, 0, 10, *(window() if with_window else ()))
+            list(page)
+        return run
+
+    def available(radius):
+        def run():
+            lat, lng = point()
+            begin, end = window()
+            client.get(reverse('parking:available'), {'lat': lat, 'lng': lng, 'radius': radius,
+                                                      'start_ts': begin.isoformat(), 'end_ts': end.isoformat()})
+        return run
+
+    def make_reservation():
+        begin, end = window()
+        client.post(reverse('parking:reserve'), json.dumps({
+            'user_id': rnd.randint(1, 100000),
+            'parkingspot_id': rnd.randint(1, spot_count),
+            'start_ts': begin.isoformat(),
+            'end_ts': end.isoformat(),
+        }), 'json')
+
+    return (
+        ('within_range 200m', within_range(200, False)),
+        ('within_range 1000m', within_range(1000, False)),
+        ('within_range 1000m window', within_range(1000, True)),
+        ('available 500m window', available(500)),
+        ('make_reservation', make_reservation),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--sizes', default='10000,100000', help='comma separated spot counts')
+    parser.add_argument('--reservations-per-spot', type=float, default=2.0)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='json file for the results')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'repeat': args.repeat,
+        'reservations_per_spot': args.reservations_per_spot,
+        'sizes': {},
+    }
+    for size in [int(size) for size in args.sizes.split(',')]:
+        with test_database():
+            started = time.perf_counter()
+            start = generate(size, args.reservations_per_spot, seed=args.seed)
+            print('%s spots generated in %.1fs' % (size, time.perf_counter() - started))
+            results['sizes'][size] = {}
+            for name, scenario in scenarios(start, args.seed):
+                samples = timed(scenario, args.repeat)
+                report(name, samples)
+                results['sizes'][size][name] = summary(samples)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    setup()
+    main()
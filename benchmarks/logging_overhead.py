@@ -0,0 +1,54 @@
+"""
+Time the logging of an available response in the request path: the whole payload through a
+synchronous StreamHandler, against a sampled Summary through the BackgroundHandler.
+
+    python -m benchmarks.logging_overhead [page size] [sample rate]
+"""
+import logging
+import os
+import sys
+
+from benchmarks import report, timed
+from parking.log import BackgroundHandler, SampleFilter, Summary
+
+FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s [%(filename)s:%(lineno)s - %(funcName)10s() ] %(message)s'
+
+
+def payload(page_size):
+    return {
+        'hits': {'offset': 0, 'page_size': page_size, 'total': page_size * 10},
+        'result': [{'id': spot_id, 'lng': -122.4 + spot_id * 1e-6, 'lat': 37.77 + spot_id * 1e-6,
+                    'address': '%s Market St, San Francisco, CA 94103, USA' % spot_id}
+                   for spot_id in range(page_size)]
+    }
+
+
+def make_logger(name, handler, *filters):
+    handler.setFormatter(logging.Formatter(FORMAT))
+    logger = logging.getLogger('benchmarks.%s' % name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    for log_filter in filters:
+        logger.addFilter(log_filter)
+    return logger
+
+
+def main(page_size=2000, sample_rate=0.01, repeat=500):
+    response = payload(page_size)
+    with open(os.devnull, 'w') as devnull:
+        sync_logger = make_logger('sync', logging.StreamHandler(devnull))
+        report('sync full payload', timed(lambda: sync_logger.info(response), repeat))
+
+        background = BackgroundHandler(logging.StreamHandler(devnull))
+        queued_logger = make_logger('queued', background)
+        report('queued summary', timed(lambda: queued_logger.info('Returning %s', Summary(response)), repeat))
+
+        sampled_logger = make_logger('sampled', background, SampleFilter(sample_rate))
+        report('queued sampled summary',
+               timed(lambda: sampled_logger.info('Returning %s', Summary(response)), repeat))
+        background.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000, float(sys.argv[2]) if len(sys.argv) > 2 else 0.01)
@@ -0,0 +1,105 @@
+"""
+Concurrent booking stress test: threads and processes race to book the same
+windows, verifying there are no double bookings and measuring bookings per second
+as more workers compete for each spot.
+
+    python -m benchmarks.reservation_contention [spots] [windows per spot]
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+from benchmarks import setup, test_database
+
+
+def book(spot_ids, windows, worker, counts):
+    from django.core.exceptions import ValidationError
+    from django.db import connections
+    from parking.models import ParkingSpotReservation
+
+    booked = failed = 0
+    try:
+        for spot_id in spot_ids:
+            for start, end in windows:
+                try:
+                    ParkingSpotReservation(user_id=worker, parkingspot_id=spot_id, start_ts=start, end_ts=end).save()
+                    booked += 1
+                except ValidationError:
+                    failed += 1
+    finally:
+        connections.close_all()
+    counts.put((booked, failed))
+
+
+def double_bookings():
+    from django.db import connection
+    from parking.models import ParkingSpotReservation
+
+    table = ParkingSpotReservation._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM %s a JOIN %s b ON a.parkingspot_id = b.parkingspot_id '
+                       'AND a.id < b.id AND a.start_ts <= b.end_ts AND a.end_ts >= b.start_ts' % (table, table))
+        return cursor.fetchone()[0]
+
+
+def run(kind, workers, spot_ids, windows):
+    from django.db import connections
+    from parking.models import ParkingSpotReservation
+
+    ParkingSpotReservation.objects.all().delete()
+    connections.close_all()
+    if kind == 'threads':
+        counts = queue.Queue()
+        pool = [threading.Thread(target=book, args=(spot_ids, windows, worker, counts)) for worker in range(workers)]
+    else:
+        # forked workers inherit the configured django
+        context = multiprocessing.get_context('fork')
+        counts = context.Queue()
+        pool = [context.Process(target=book, args=(spot_ids, windows, worker, counts))
+                for worker in range(workers)]
+
+    start = time.perf_counter()
+    for worker in pool:
+        worker.start()
+    results = [counts.get() for _ in pool]
+    for worker in pool:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    booked = sum(booked for booked, _ in results)
+    attempts = booked + sum(failed for _, failed in results)
+    duplicates = double_bookings()
+    print('%-9s %3s workers: %5s booked / %6s attempts, %3s double bookings, %8.1f bookings/s, %8.1f attempts/s' % (
+        kind, workers, booked, attempts, duplicates, booked / elapsed, attempts / elapsed))
+    assert booked == len(spot_ids) * len(windows), 'every window should be booked exactly once'
+    assert duplicates == 0, 'double booking'
+
+
+def main(spot_count=20, windows_per_spot=20, contention=(1, 2, 4, 8)):
+    from django.db import connection
+    from django.utils import timezone
+    from parking.models import ParkingSpot
+
+    # processes can't share an in-memory database
+    connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'contention.sqlite3')
+    with test_database():
+        ParkingSpot.objects.bulk_create(ParkingSpot(location=ParkingSpot.create_point(37.78, -122.39 + i * 0.0001),
+                                                    address='spot %s' % i) for i in range(spot_count))
+        spot_ids = list(ParkingSpot.objects.values_list('id', flat=True))
+        base = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        windows = [(base + timedelta(hours=2 * i), base + timedelta(hours=2 * i + 1))
+                   for i in range(windows_per_spot)]
+
+        for kind in ('threads', 'processes'):
+            for workers in contention:
+                run(kind, workers, spot_ids, windows)
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+"""
+CPU time and allocations of building the available response for a large page, from
+model instances with GEOS points against the lean (id, lng, lat, address) rows.
+
+    python -m benchmarks.serialization [spots] [page size]
+"""
+import json
+import sys
+import tracemalloc
+
+from benchmarks import report, setup, test_database, timed
+from benchmarks.synthetic import CENTER, generate
+
+
+def from_models(page_size):
+    from parking.models import ParkingSpot
+
+    _, page = ParkingSpot.within_range(CENTER[0], CENTER[1], 3000, 0, page_size)
+    return json.dumps([{'id': spot.id, 'lng': spot.location.x, 'lat': spot.location.y, 'address': spot.address}
+                       for spot in page])
+
+
+def from_rows(page_size):
+    from parking.models import ParkingSpot
+
+    _, page = ParkingSpot.within_range(CENTER[0], CENTER[1], 3000, 0, page_size, lean=True)
+    return json.dumps([{'id': spot_id, 'lng': lng, 'lat': lat, 'address': address}
+                       for spot_id, lng, lat, address in page])
+
+
+def peak_allocations(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(spot_count=50000, page_size=2000, repeat=30):
+    with test_database():
+        generate(spot_count, reservations_per_spot=0)
+        assert from_models(page_size) == from_rows(page_size)
+        for name, build in (('models + GEOS', from_models), ('lean rows', from_rows)):
+            report(name, timed(lambda: build(page_size), repeat))
+            print('%-28s peak allocations %8.1f KiB' % (name, peak_allocations(lambda: build(page_size)) / 1024))
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,91 @@
+"""
+Search latency as geo shards are added: one synthetic city per shard, each in its
+own SQLite file, searched around San Francisco. The search only queries the shard
+owning the circle, so its latency stays flat as shards are added. A scatter to every
+shard is timed too, it runs the shards in parallel in the shard thread pool.
+
+    python -m benchmarks.sharding [spots per city] [max shards]
+"""
+import copy
+import os
+import shutil
+import sys
+import tempfile
+from datetime import timedelta
+
+from benchmarks import report, setup, timed
+
+# (name, center, geohash prefix)
+CITIES = (
+    ('san francisco', (37.7749, -122.4194), '9q'),
+    ('new york', (40.7128, -74.0060), 'dr'),
+    ('chicago', (41.8781, -87.6298), 'dp'),
+    ('seattle', (47.6062, -122.3321), 'c2'),
+    ('miami', (25.7617, -80.1918), 'dh'),
+    ('denver', (39.7392, -104.9903), '9x'),
+    ('houston', (29.7604, -95.3698), '9v'),
+    ('atlanta', (33.7490, -84.3880), 'dj'),
+)
+
+
+def create_shards(directory, count, spots_per_city):
+    from django.core.management import call_command
+    from django.db import connections
+    from django.test.utils import override_settings
+
+    from benchmarks.synthetic import generate
+    from parking import sharding
+
+    shards = []
+    for position, (name, center, prefix) in enumerate(CITIES[:count]):
+        alias = 'bench_shard_%s' % position
+        connections.databases[alias] = dict(copy.deepcopy(connections.databases['default']),
+                                            NAME=os.path.join(directory, '%s.sqlite3' % alias))
+        shards.append((alias, [prefix]))
+
+    with override_settings(PARKING_SHARDS=shards):
+        for alias, _ in shards:
+            call_command('migrate', database=alias, verbosity=0)
+            sharding.seed_id_range(alias)
+        for (alias, _), (name, center, _) in zip(shards, CITIES):
+            start = generate(spots_per_city, center=center, using=alias)
+            print('%s: %s spots in %s' % (alias, spots_per_city, name))
+    return shards, start
+
+
+def main(spots_per_city=20000, max_shards=8, repeat=200):
+    from django.db import connections
+    from django.test.utils import override_settings
+
+    from parking import sharding
+    from parking.models import ParkingSpot
+
+    directory = tempfile.mkdtemp(prefix='parking-shards-')
+    try:
+        shards, start = create_shards(directory, max_shards, spots_per_city)
+        lat, lng = CITIES[0][1]
+        window = (start + timedelta(hours=2), start + timedelta(hours=4))
+
+        def search():
+            ParkingSpot.within_range(lat, lng, 1000, 0, 20, *window, lean=True)
+
+        def scatter_all():
+            sharding.scatter(search, sharding.aliases())
+
+        count = 1
+        while count <= len(shards):
+            with override_settings(PARKING_SHARDS=shards[:count], PARKING_SPATIAL_INDEX=False,
+                                   PARKING_AVAILABILITY_ENGINE=False, PARKING_SLOT_BITMAPS=False):
+                search()
+                report('%s shards, search' % count, timed(search, repeat))
+                scatter_all()
+                report('%s shards, scatter to all' % count, timed(scatter_all, repeat))
+            count *= 2
+    finally:
+        connections.close_all()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
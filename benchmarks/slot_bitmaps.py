@@ -0,0 +1,51 @@
+"""
+Availability of a candidate set for an aligned window: the interval AvailabilityEngine
+against the slot bitmaps, with Python ints and with NumPy.
+
+    python -m benchmarks.slot_bitmaps [spots] [reservations per spot] [candidates]
+"""
+import random
+import sys
+from datetime import timedelta
+
+from benchmarks import report, setup, timed
+
+
+def main(spot_count=100000, reservations_per_spot=4, candidates=900, repeat=200):
+    from django.utils import timezone
+
+    from parking import slots
+    from parking.availability import AvailabilityEngine
+
+    rnd = random.Random(3)
+    now = timezone.now()
+    engine = AvailabilityEngine(now)
+    checkers = [('interval engine', engine), ('slot bitmaps, ints', slots.SlotBitmaps(now, use_numpy=False))]
+    if slots.numpy is not None:
+        checkers.append(('slot bitmaps, numpy', slots.SlotBitmaps(now, use_numpy=True)))
+    origin = checkers[1][1].origin
+
+    reservation_id = 0
+    for spot_id in range(spot_count):
+        for _ in range(reservations_per_spot):
+            start = origin + timedelta(minutes=15 * rnd.randrange(4, 6 * 24 * 4))
+            end = start + timedelta(minutes=15 * rnd.randrange(1, 12))
+            for _, checker in checkers:
+                checker.add(reservation_id, spot_id, start, end)
+            reservation_id += 1
+
+    windows = []
+    for _ in range(repeat):
+        start = origin + timedelta(minutes=15 * rnd.randrange(4, 6 * 24 * 4))
+        windows.append((rnd.sample(range(spot_count), candidates), start, start + timedelta(hours=2)))
+
+    expected = [engine.free_spots(*window) for window in windows]
+    for name, checker in checkers:
+        assert [checker.free_spots(*window) for window in windows] == expected, name
+        pending = iter(windows)
+        report(name, timed(lambda: checker.free_spots(*next(pending)), repeat))
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
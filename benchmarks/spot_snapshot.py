@@ -0,0 +1,60 @@
+"""
+Worker startup and radius search: loading the spots into the GridIndex against mapping
+the spot snapshot. The GridIndex is filled from a list here, a worker also pays for
+reading every spot from the database.
+
+    python -m benchmarks.spot_snapshot [spots] [radius meters]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks import report, setup, timed
+
+
+def main(spot_count=1000000, radius=500, repeat=200):
+    from benchmarks.synthetic import CENTER, spot_coordinates
+    from parking import snapshot
+    from parking.spatial_index import GridIndex
+
+    rnd = random.Random(42)
+    spots = [(spot_id, lat, lng) for spot_id, (lat, lng) in enumerate(spot_coordinates(rnd, spot_count), 1)]
+    path = os.path.join(tempfile.mkdtemp(prefix='parking-snapshot-'), 'spots.bin')
+    try:
+        started = time.perf_counter()
+        snapshot.write(path, spots)
+        print('snapshot written in %.1fs, %.1f MB' % (time.perf_counter() - started, os.path.getsize(path) / 1e6))
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = GridIndex()
+        for spot in spots:
+            index.add(*spot)
+        print('grid index built in %.2fs, %.1f MB of Python objects' % (
+            time.perf_counter() - started, tracemalloc.get_traced_memory()[0] / 1e6))
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        mapped = snapshot.SpotSnapshot(path)
+        print('snapshot mapped in %.4fs, %.3f MB of Python objects' % (
+            time.perf_counter() - started, tracemalloc.get_traced_memory()[0] / 1e6))
+        tracemalloc.stop()
+
+        centers = [spots[rnd.randrange(spot_count)][1:] for _ in range(repeat)]
+        for name, searcher in (('grid index', index), ('mapped snapshot', mapped)):
+            pending = iter(centers)
+            report(name, timed(lambda: searcher.within(*next(pending), radius), repeat))
+        assert [item[0] for item in index.within(*centers[0], radius)] == \
+            [item[0] for item in mapped.within(*centers[0], radius)]
+    finally:
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,114 @@
+"""
+Reproducible synthetic cities.
+
+Spots are drawn around a handful of gaussian clusters (downtown, neighbourhoods) over
+a uniform background, and every spot gets a Poisson distributed number of one to
+three hour reservations over the following days. The same seed always yields the
+same city.
+"""
+import math
+import random
+from datetime import timedelta
+
+CENTER = (37.7749, -122.4194)
+
+# (share of the spots, lat/lng offset from the center in degrees, spread in meters)
+CLUSTERS = (
+    (0.35, (0.0, 0.0), 800),
+    (0.15, (0.03, 0.02), 600),
+    (0.15, (-0.04, 0.01), 700),
+    (0.10, (0.01, -0.05), 500),
+)
+BACKGROUND_SPREAD_DEGREES = 0.12
+
+METERS_PER_DEGREE = 111320.0
+
+
+def poisson(rnd, lam):
+    # Knuth, fine for the small rates used here
+    threshold, count, product = math.exp(-lam), 0, rnd.random()
+    while product > threshold:
+        count += 1
+        product *= rnd.random()
+    return count
+
+
+def spot_coordinates(rnd, count, center=CENTER):
+    for _ in range(count):
+        pick = rnd.random()
+        for share, (dlat, dlng), spread in CLUSTERS:
+            if pick < share:
+                sigma = spread / METERS_PER_DEGREE
+                lat = center[0] + dlat + rnd.gauss(0, sigma)
+                lng = center[1] + dlng + rnd.gauss(0, sigma / math.cos(math.radians(center[0])))
+                break
+            pick -= share
+        else:
+            lat = center[0] + rnd.uniform(-BACKGROUND_SPREAD_DEGREES, BACKGROUND_SPREAD_DEGREES)
+            lng = center[1] + rnd.uniform(-BACKGROUND_SPREAD_DEGREES, BACKGROUND_SPREAD_DEGREES)
+        yield lat, lng
+
+
+def reservation_windows(rnd, start, reservations_per_spot, days):
+    """
+    Non overlapping windows of a single spot, in order.
+    """
+    windows = []
+    for _ in range(poisson(rnd, reservations_per_spot)):
+        begin = start + timedelta(minutes=15 * rnd.randrange(days * 24 * 4))
+        windows.append((begin, begin + timedelta(minutes=60 * rnd.randint(1, 3))))
+    windows.sort()
+    result = []
+    for window in windows:
+        if not result or window[0] > result[-1][1]:
+            result.append(window)
+    return result
+
+
+def spot_ids(page_size, using=None):
+    """
+    Every spot id, paged by id so no read cursor stays open during the inserts.
+    """
+    from parking.models import ParkingSpot
+
+    last = 0
+    while True:
+        page = list(ParkingSpot.objects.using(using).filter(id__gt=last).order_by('id').values_list('id', flat=True)[:page_size])
+        if not page:
+            return
+        for spot_id in page:
+            yield spot_id
+        last = page[-1]
+
+
+def generate(spot_count, reservations_per_spot=2.0, days=7, seed=42, batch_size=5000, center=CENTER, using=None):
+    """
+    Insert a synthetic city into the current database.
+
+    :param using: database alias, defaults to the routers' choice
+
+    :return: the start of the reservation period
+    """
+    from django.contrib.gis.geos import Point
+    from django.db import transaction
+    from django.utils import timezone
+    from parking.models import ParkingSpot, ParkingSpotReservation
+    from parking.spot_import import chunks
+
+    rnd = random.Random(seed)
+    start = timezone.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+
+    spots = (ParkingSpot(location=Point(lng, lat, srid=4326), address='synthetic spot %s' % position)
+             for position, (lat, lng) in enumerate(spot_coordinates(rnd, spot_count, center)))
+    for batch in chunks(spots, batch_size):
+        with transaction.atomic(using=using):
+            ParkingSpot.objects.using(using).bulk_create(batch)
+
+    reservations = (ParkingSpotReservation(user_id=rnd.randint(1, 100000), parkingspot_id=spot_id,
+                                           start_ts=begin, end_ts=end)
+                    for spot_id in spot_ids(batch_size, using)
+                    for begin, end in reservation_windows(rnd, start, reservations_per_spot, days))
+    for batch in chunks(reservations, batch_size):
+        with transaction.atomic(using=using):
+            ParkingSpotReservation.objects.using(using).bulk_create(batch)
+    return start
@@ -0,0 +1,75 @@
+"""
+Radius filtering on millions of spots: haversine throughput of NumPy against pure
+Python, and radius search latency of the vectorised index against the pure Python
+search of the same mapped snapshot, in the dense city and across the sparse rest.
+
+    python -m benchmarks.vector_search [spots] [radius meters]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks import report, setup, timed
+
+# continental US, for the spots outside the synthetic city
+US_BOX = ((25.0, 49.0), (-124.0, -67.0))
+
+
+def spots(rnd, count):
+    """
+    Half of the spots in the synthetic city, half spread over the US.
+    """
+    from benchmarks.synthetic import spot_coordinates
+
+    city = spot_coordinates(rnd, count // 2)
+    for spot_id in range(1, count + 1):
+        if spot_id <= count // 2:
+            lat, lng = next(city)
+        else:
+            lat, lng = rnd.uniform(*US_BOX[0]), rnd.uniform(*US_BOX[1])
+        yield spot_id, lat, lng
+
+
+def main(spot_count=2000000, radius=1000, repeat=100):
+    from parking import snapshot, vector_index
+    from parking.spatial_index import haversine_meters
+
+    rnd = random.Random(42)
+    rows = list(spots(rnd, spot_count))
+    path = os.path.join(tempfile.mkdtemp(prefix='parking-snapshot-'), 'spots.bin')
+    try:
+        snapshot.write(path, rows)
+        mapped = snapshot.SpotSnapshot(path)
+        index = vector_index.VectorIndex.from_snapshot(mapped)
+
+        started = time.perf_counter()
+        vector_index.haversine_meters(37.7749, -122.4194, index.lats, index.lngs)
+        print('numpy haversine   %8.1f M points/s' % (spot_count / (time.perf_counter() - started) / 1e6))
+        sample = min(spot_count, 200000)
+        started = time.perf_counter()
+        for lat, lng in zip(index.lats[:sample].tolist(), index.lngs[:sample].tolist()):
+            haversine_meters(37.7749, -122.4194, lat, lng)
+        print('python haversine  %8.1f M points/s' % (sample / (time.perf_counter() - started) / 1e6))
+
+        half = spot_count // 2
+        for area, centers in (
+                ('city', [rows[rnd.randrange(half)][1:] for _ in range(repeat)]),
+                ('sparse', [rows[half + rnd.randrange(spot_count - half)][1:] for _ in range(repeat)])):
+            found = sum(len(index.within(lat, lng, radius)) for lat, lng in centers) / repeat
+            print('%s, %.0f spots per search' % (area, found))
+            for name, searcher in (('vectorised index', index), ('mapped snapshot', mapped)):
+                pending = iter(centers)
+                report(name, timed(lambda: searcher.within(*next(pending), radius), repeat))
+            assert [item[0] for item in index.within(*centers[0], radius)] == \
+                [item[0] for item in mapped.within(*centers[0], radius)]
+        del index, mapped
+    finally:
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
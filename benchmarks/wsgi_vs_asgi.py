@@ -0,0 +1,108 @@
+"""
+Load comparison of the WSGI and ASGI handlers at the same worker count.
+
+WSGI: `workers` threads, each serving one request at a time.
+ASGI: one event loop with `clients` concurrent requests and the async views' database
+pool limited to `workers` threads. Every request waits `client_delay` seconds before
+it is sent, standing in for slow clients, which hold a WSGI thread but only a
+coroutine under ASGI.
+
+    python -m benchmarks.wsgi_vs_asgi [spots] [workers] [clients] [requests] [client delay ms]
+"""
+import asyncio
+import sys
+import threading
+import time
+
+from benchmarks import report, setup, test_database
+from benchmarks.synthetic import generate, spot_coordinates
+
+PATH = '/parking/v1/parking_spots/available'
+
+
+def queries(count):
+    import random
+
+    rnd = random.Random(7)
+    return [{'lat': lat, 'lng': lng, 'radius': 500} for lat, lng in spot_coordinates(rnd, count)]
+
+
+def run_wsgi(workers, params, client_delay):
+    from django.test import Client
+
+    samples = []
+    pending = list(params)
+    lock = threading.Lock()
+
+    def worker():
+        client = Client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                query = pending.pop()
+            start = time.perf_counter()
+            time.sleep(client_delay)
+            client.get(PATH, query)
+            samples.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - started
+
+
+def run_asgi(clients, params, client_delay):
+    from django.test import AsyncClient
+
+    samples = []
+
+    async def main():
+        client = AsyncClient()
+        limit = asyncio.Semaphore(clients)
+
+        async def one(query):
+            async with limit:
+                start = time.perf_counter()
+                await asyncio.sleep(client_delay)
+                await client.get(PATH, query)
+                samples.append(time.perf_counter() - start)
+
+        await asyncio.gather(*[one(query) for query in params])
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    return samples, time.perf_counter() - started
+
+
+def main(spot_count=20000, workers=4, clients=64, requests=400, client_delay_ms=20):
+    from django.test.utils import override_settings
+    from django.urls import clear_url_caches
+    import importlib
+    import parking.urls
+
+    client_delay = client_delay_ms / 1000.0
+    params = queries(requests)
+    with test_database():
+        generate(spot_count, reservations_per_spot=0)
+
+        samples, elapsed = run_wsgi(workers, params, client_delay)
+        report('WSGI %s threads' % workers, samples)
+        print('%-28s %8.1f requests/s' % ('', len(samples) / elapsed))
+
+        with override_settings(PARKING_ASYNC_VIEWS=True, PARKING_ASYNC_DB_THREADS=workers):
+            importlib.reload(parking.urls)
+            clear_url_caches()
+            samples, elapsed = run_asgi(clients, params, client_delay)
+        importlib.reload(parking.urls)
+        clear_url_caches()
+        report('ASGI %s db threads' % workers, samples)
+        print('%-28s %8.1f requests/s' % ('', len(samples) / elapsed))
+
+
+if __name__ == '__main__':
+    setup()
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -3,7 +3,9 @@ import os
 import sys
 
 if __name__ == "__main__":
-    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "parking_demo.settings")
+    # the tests add a second shard database
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                          "parking_demo.test_settings" if sys.argv[1:2] == ["test"] else "parking_demo.settings")
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
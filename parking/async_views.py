@@ -0,0 +1,164 @@
+"""
+Async variants of the parking views, served by the ASGI entry point.
+
+A request only holds a coroutine while it waits, the database work runs in a thread
+pool of PARKING_ASYNC_DB_THREADS threads, which also bounds the number of open
+database connections. Independent queries of a request, the COUNT and the page of a
+search or the groups of a batch search, run concurrently in the pool.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+
+from parking import availability_cache, batch, metrics, sharding, views
+from parking.models import ParkingSpot
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PARKING_ASYNC_DB_THREADS', 8),
+                                               thread_name_prefix='parking-db')
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run blocking database code in the pool, its queries count towards the request's metrics.
+    """
+    stats = metrics.current_stats()
+
+    def call():
+        try:
+            with metrics.track_queries(stats):
+                return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    # the pool threads see the request's context, e.g. its database routing
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), contextvars.copy_context().run, call)
+
+
+async def available(request):
+    if request.method != 'GET':
+        raise Http404()
+
+    try:
+        query = views.parse_available(request)
+    except ValidationError as validationerr:
+        return JsonResponse({
+            'exception': validationerr.message
+        }, status=400)
+
+    if query.stream:
+        return stream_available(query)
+
+    logger.debug('Getting the available parking spots at %s %s %s between %s and %s!',
+                 query.lat, query.lng, query.radius, query.start_ts, query.end_ts)
+
+    if query.with_total and availability_cache.get_backend() is None and not sharding.is_enabled():
+        # the COUNT and the page run concurrently
+        total, (_, rows) = await asyncio.gather(run_db(views.count_available, query),
+                                                run_db(views.search_available, query._replace(with_total=False)))
+    else:
+        total, rows = await run_db(views.search_available, query)
+    return views.available_response(query, total, rows)
+
+
+def stream_available(query):
+    """
+    views.stream_available for the ASGI server, which would buffer a response over a sync
+    iterator. The lines are read in keyset pages of STREAM_CHUNK_SIZE rows, each page one
+    query in the pool, so the event loop only waits between chunks.
+    """
+    logger.debug('Streaming the available parking spots at %s %s %s between %s and %s!',
+                 query.lat, query.lng, query.radius, query.start_ts, query.end_ts)
+
+    def read_chunk(offset, pagesize, after_id):
+        _, rows = ParkingSpot.within_range(query.lat, query.lng, query.radius, offset, pagesize,
+                                           query.start_ts, query.end_ts,
+                                           after_id=after_id, with_total=False, lean=True)
+        return list(rows)
+
+    async def lines():
+        offset, after_id, remaining = query.offset, query.after_id, query.pagesize
+        while remaining is None or remaining > 0:
+            pagesize = views.STREAM_CHUNK_SIZE if remaining is None else min(remaining, views.STREAM_CHUNK_SIZE)
+            rows = await run_db(read_chunk, offset, pagesize, after_id)
+            if rows:
+                yield ''.join(views.ndjson_line(row) for row in rows)
+            if len(rows) < pagesize:
+                return
+            offset, after_id = 0, rows[-1][0]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+
+async def nearest(request):
+    return await run_db(views.nearest, request)
+
+
+async def batch_available(request):
+    if request.method != 'POST':
+        raise Http404()
+
+    try:
+        queries = views.parse_batch(request)
+    except ValidationError as validationerr:
+        return JsonResponse({
+            'exception': validationerr.message
+        }, status=400)
+
+    logger.debug('Searching available parking spots for %s locations', len(queries))
+
+    groups = batch.group_queries(queries)
+    group_results = await asyncio.gather(*[
+        run_db(batch.search_group, [queries[position] for position in group]) for group in groups
+    ])
+    return JsonResponse({
+        'results': batch.merge(queries, groups, group_results)
+    })
+
+
+async def make_reservation(request):
+    return await run_db(views.make_reservation, request)
+
+
+async def hold_reservation(request):
+    return await run_db(views.hold_reservation, request)
+
+
+async def confirm_hold(request):
+    return await run_db(views.confirm_hold, request)
+
+
+async def bulk_reservation(request):
+    return await run_db(views.bulk_reservation, request)
+
+
+async def history(request):
+    return await run_db(views.history, request)
+
+
+# what csrf_exempt sets, the decorator itself only wraps sync views before Django 5.0
+batch_available.csrf_exempt = True
+make_reservation.csrf_exempt = True
+hold_reservation.csrf_exempt = True
+confirm_hold.csrf_exempt = True
+bulk_reservation.csrf_exempt = True
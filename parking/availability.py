@@ -0,0 +1,231 @@
+"""
+In-process availability engine.
+
+Keeps the current and future reservations of every parking spot as a list sorted by
+start time, so "is the spot free between start and end?" is a binary search instead
+of a query over every reservation the spot ever had.
+
+Intervals are closed on both ends to give the same answers as
+ParkingSpotReservation.overlapping_reservations_exist: a reservation ending at 20:00
+conflicts with one starting at 20:00. Holds keep their expiry date and stop conflicting
+once it passed, like ParkingSpotReservation.taken_filter, even before they are deleted.
+"""
+import bisect
+import logging
+import threading
+
+from django.conf import settings
+from django.db import router
+from django.utils import timezone
+
+from parking import journal
+
+logger = logging.getLogger(__name__)
+
+
+class SpotSchedule():
+    """
+    Reservations of a single spot sorted by start. max_ends[i] is the latest end among
+    the first i + 1 reservations, which keeps the lookup logarithmic even if the
+    stored reservations overlap each other. The few pending holds of the spot are kept
+    apart with their expiry date and checked one by one.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.reservation_ids = []
+        self.max_ends = []
+        # reservation id -> (start, end, expiry date) of the holds
+        self.holds = {}
+
+    def __len__(self):
+        return len(self.starts) + len(self.holds)
+
+    def _refresh_max_ends(self, position):
+        del self.max_ends[position:]
+        latest = self.max_ends[-1] if self.max_ends else None
+        for end in self.ends[position:]:
+            latest = end if latest is None or end > latest else latest
+            self.max_ends.append(latest)
+
+    def add(self, reservation_id, start, end, expires_at=None):
+        if expires_at is not None:
+            self.holds[reservation_id] = (start, end, expires_at)
+            return
+        position = bisect.bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self.reservation_ids.insert(position, reservation_id)
+        self._refresh_max_ends(position)
+
+    def remove(self, reservation_id):
+        if self.holds.pop(reservation_id, None) is not None:
+            return True
+        try:
+            position = self.reservation_ids.index(reservation_id)
+        except ValueError:
+            return False
+        del self.starts[position]
+        del self.ends[position]
+        del self.reservation_ids[position]
+        self._refresh_max_ends(position)
+        return True
+
+    def prune(self, before):
+        """
+        Drop the reservations that ended, and the holds that expired, before the given time.
+        """
+        self.holds = {reservation_id: hold for reservation_id, hold in self.holds.items()
+                      if hold[1] >= before and hold[2] > before}
+        kept = [(start, end, reservation_id) for start, end, reservation_id
+                in zip(self.starts, self.ends, self.reservation_ids) if end >= before]
+        self.starts = [start for start, _, _ in kept]
+        self.ends = [end for _, end, _ in kept]
+        self.reservation_ids = [reservation_id for _, _, reservation_id in kept]
+        self.max_ends = []
+        self._refresh_max_ends(0)
+
+    def is_free(self, start, end, now=None):
+        """
+        :param now: holds expiring by then are ignored, defaults to the current time
+        """
+        # the reservations starting at or before `end` are the only possible conflicts,
+        # and one of them conflicts if the latest of their ends reaches `start`
+        position = bisect.bisect_right(self.starts, end)
+        if position != 0 and self.max_ends[position - 1] >= start:
+            return False
+        if self.holds:
+            now = now or timezone.now()
+            return not any(hold_start <= end and hold_end >= start and expires_at > now
+                           for hold_start, hold_end, expires_at in self.holds.values())
+        return True
+
+
+class AvailabilityEngine():
+    def __init__(self, horizon):
+        """
+        :param horizon: reservations ending before this time are not tracked, so only
+        windows starting at or after it can be answered
+        """
+        self.horizon = horizon
+        # position in the ReservationChange log of the process wide engine
+        self.journal = None
+        self._schedules = {}
+        self._spot_by_reservation = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._spot_by_reservation)
+
+    def covers(self, start):
+        return start >= self.horizon
+
+    def add(self, reservation_id, spot_id, start, end, expires_at=None):
+        """
+        :param expires_at: expiry date of a hold, None for a reservation
+        """
+        with self._lock:
+            self.remove(reservation_id)
+            if spot_id is None or end < self.horizon:
+                return
+            self._schedules.setdefault(spot_id, SpotSchedule()).add(reservation_id, start, end, expires_at)
+            self._spot_by_reservation[reservation_id] = spot_id
+
+    def remove(self, reservation_id):
+        with self._lock:
+            spot_id = self._spot_by_reservation.pop(reservation_id, None)
+            if spot_id is None:
+                return
+            schedule = self._schedules[spot_id]
+            schedule.remove(reservation_id)
+            if not schedule:
+                del self._schedules[spot_id]
+
+    def prune(self, before=None):
+        """
+        Forget the reservations that can no longer conflict with a new booking.
+        """
+        before = before or timezone.now()
+        with self._lock:
+            for spot_id, schedule in list(self._schedules.items()):
+                schedule.prune(before)
+                if not schedule:
+                    del self._schedules[spot_id]
+            self._spot_by_reservation = {reservation_id: spot_id
+                                         for spot_id, schedule in self._schedules.items()
+                                         for reservation_id in schedule.reservation_ids + list(schedule.holds)}
+            self.horizon = max(self.horizon, before)
+
+    def is_free(self, spot_id, start, end):
+        with self._lock:
+            schedule = self._schedules.get(spot_id)
+            return schedule is None or schedule.is_free(start, end)
+
+    def free_spots(self, spot_ids, start, end):
+        """
+        The subset of spot_ids which have no reservation overlapping the window.
+        """
+        now = timezone.now()
+        with self._lock:
+            schedules = self._schedules
+            return [spot_id for spot_id in spot_ids
+                    if spot_id not in schedules or schedules[spot_id].is_free(start, end, now)]
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'PARKING_AVAILABILITY_ENGINE', False)
+
+
+def get_engine():
+    """
+    Process wide engine, loaded from the database on first use and brought up to date
+    with the reservations written by the other processes on every use.
+    """
+    global _engine
+    engine = _engine
+    if engine is not None and journal.catch_up(engine, engine.journal):
+        return engine
+    with _engine_lock:
+        # unless another thread rebuilt it meanwhile
+        if _engine is engine:
+            _engine = build_engine()
+        return _engine
+
+
+def build_engine(horizon=None):
+    from parking.models import ParkingSpotReservation
+
+    engine = AvailabilityEngine(horizon or timezone.now())
+    # loaded from the primary, the structures guard bookings
+    using = router.db_for_write(ParkingSpotReservation)
+    # taken first, the writes made while loading are caught up with afterwards
+    engine.journal = journal.Journal.at_end(using)
+    reservations = ParkingSpotReservation.objects.using(using) \
+        .filter(ParkingSpotReservation.taken_filter(), end_ts__gte=engine.horizon) \
+        .values_list('id', 'parkingspot_id', 'start_ts', 'end_ts', 'expires_at')
+    for reservation in reservations.iterator():
+        engine.add(*reservation)
+    logger.info('Built availability engine with %s reservations', len(engine))
+    return engine
+
+
+def reset_engine():
+    global _engine
+    with _engine_lock:
+        _engine = None
+
+
+def reservation_saved(reservation):
+    if _engine is not None:
+        _engine.add(reservation.id, reservation.parkingspot_id, reservation.start_ts, reservation.end_ts,
+                    reservation.expires_at)
+
+
+def reservation_deleted(reservation_id):
+    if _engine is not None:
+        _engine.remove(reservation_id)
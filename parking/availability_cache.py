@@ -0,0 +1,238 @@
+"""
+Result cache in front of ParkingSpot.within_range.
+
+The map is split into cells of CELL_DEGREES and every cell has a version counter,
+bumped whenever a reservation or a spot in the cell is written. A cache key holds
+the search parameters together with the versions of all the cells the search
+circle touches, so a write only invalidates the searches around it and the stale
+entries simply age out of the LRU/TTL store.
+
+Two backends are available: 'local', an in-process LRU, and 'django', which keeps
+the entries and versions in a Django cache so they are shared by the workers.
+"""
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from parking.spatial_index import bounding_box
+
+CELL_DEGREES = 0.01
+
+# searches covering more cells are not cached
+MAX_CELLS = 64
+
+
+def cell(lat, lng):
+    return int(math.floor(lat / CELL_DEGREES)), int(math.floor(lng / CELL_DEGREES))
+
+
+def cells(lat, lng, radius_meters):
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_meters)
+    (min_row, min_col), (max_row, max_col) = cell(min_lat, min_lng), cell(max_lat, max_lng)
+    if (max_row - min_row + 1) * (max_col - min_col + 1) > MAX_CELLS:
+        return None
+    return [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+
+class LocalBackend():
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def versions(self, cell_keys):
+        with self._lock:
+            return [self._versions.get(cell_key, 0) for cell_key in cell_keys]
+
+    def bump(self, cell_keys):
+        with self._lock:
+            for cell_key in cell_keys:
+                self._versions[cell_key] = self._versions.get(cell_key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class DjangoCacheBackend():
+    def __init__(self, alias='default', ttl=30, prefix='parking'):
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _version_key(self, cell_key):
+        return '%s:cell:%s:%s' % (self.prefix, cell_key[0], cell_key[1])
+
+    def _search_key(self, key):
+        # memcached limits keys to 250 characters without spaces
+        return '%s:search:%s' % (self.prefix, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        return self.cache.get(self._search_key(key))
+
+    def set(self, key, value):
+        self.cache.set(self._search_key(key), value, self.ttl)
+
+    def versions(self, cell_keys):
+        found = self.cache.get_many([self._version_key(cell_key) for cell_key in cell_keys])
+        return [found.get(self._version_key(cell_key), 0) for cell_key in cell_keys]
+
+    def bump(self, cell_keys):
+        for cell_key in cell_keys:
+            version_key = self._version_key(cell_key)
+            # versions never expire, an expired counter restarting at 0 could revive stale entries
+            self.cache.add(version_key, 0, None)
+            try:
+                self.cache.incr(version_key)
+            except ValueError:
+                self.cache.set(version_key, 1, None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class Stats():
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else None,
+        }
+
+
+stats = Stats()
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    The backend selected by the PARKING_AVAILABILITY_CACHE setting, None when disabled.
+    """
+    global _backend
+    kind = getattr(settings, 'PARKING_AVAILABILITY_CACHE', None)
+    if not kind:
+        return None
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                ttl = getattr(settings, 'PARKING_AVAILABILITY_CACHE_TTL', 30)
+                if kind == 'django':
+                    alias = getattr(settings, 'PARKING_AVAILABILITY_CACHE_ALIAS', 'default')
+                    _backend = DjangoCacheBackend(alias, ttl)
+                else:
+                    _backend = LocalBackend(getattr(settings, 'PARKING_AVAILABILITY_CACHE_SIZE', 10000), ttl)
+    return _backend
+
+
+def reset_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+def within_range(lat, lng, radius_meters, offset, pagesize, start_ts=None, end_ts=None,
+                 after_id=None, with_total=True, lean=False):
+    """
+    ParkingSpot.within_range with the page evaluated, served from the cache when possible.
+
+    :return: total and the list of spots, or (id, lng, lat, address) rows when lean, of the page
+    """
+    from parking.models import ParkingSpot
+
+    backend = get_backend()
+    cell_keys = cells(lat, lng, radius_meters) if backend is not None else None
+    if cell_keys is None:
+        if backend is not None:
+            stats.count('bypassed')
+        total, page = ParkingSpot.within_range(lat, lng, radius_meters, offset, pagesize, start_ts, end_ts,
+                                               after_id=after_id, with_total=with_total, lean=lean)
+        return total, list(page)
+
+    key = '%r:%r:%r:%s:%s:%s:%s:%s:%s:%s:%s' % (
+        lat, lng, radius_meters, offset, pagesize,
+        start_ts.isoformat() if start_ts is not None else '', end_ts.isoformat() if end_ts is not None else '',
+        after_id, with_total, lean, '.'.join(str(version) for version in backend.versions(cell_keys)))
+    cached = backend.get(key)
+    if cached is not None:
+        stats.count('hits')
+        return cached
+
+    stats.count('misses')
+    total, page = ParkingSpot.within_range(lat, lng, radius_meters, offset, pagesize, start_ts, end_ts,
+                                           after_id=after_id, with_total=with_total, lean=lean)
+    result = (total, list(page))
+    backend.set(key, result)
+    return result
+
+
+def invalidate(*points):
+    """
+    Bump the versions of the cells of the given (lat, lng) points.
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+    backend.bump({cell(lat, lng) for lat, lng in points})
+    stats.count('invalidations')
+
+
+def reservation_written(reservation):
+    if reservation.parkingspot_id is None or get_backend() is None:
+        return
+    from parking.models import ParkingSpot
+
+    try:
+        location = reservation.parkingspot.location
+    except ParkingSpot.DoesNotExist:
+        return
+    invalidate((location.y, location.x))
+
+
+def spot_written(spot, previous_location=None):
+    points = [(spot.location.y, spot.location.x)]
+    if previous_location is not None:
+        points.append((previous_location.y, previous_location.x))
+    invalidate(*points)
@@ -0,0 +1,117 @@
+"""
+Batched availability search for many locations at once, e.g. the waypoints of a route.
+
+Queries whose search areas share a grid cell are grouped together. Every group costs
+one candidate fetch for the union of its circles (ParkingSpot.in_ranges) and one
+availability check (ParkingSpotReservation.exclude_reserved) per distinct time window
+of its queries. Which candidates fall inside each query's radius is decided with the
+haversine distance, like the spatial index does.
+"""
+import math
+from collections import namedtuple
+
+from parking import sharding
+from parking.spatial_index import bounding_box, haversine_meters
+
+SearchQuery = namedtuple('SearchQuery', 'lat lng radius start_ts end_ts page_size')
+
+CELL_DEGREES = 0.01
+
+MAX_GROUP_SIZE = 50
+
+
+def cells(query):
+    min_lat, max_lat, min_lng, max_lng = bounding_box(query.lat, query.lng, query.radius)
+    rows = range(int(math.floor(min_lat / CELL_DEGREES)), int(math.floor(max_lat / CELL_DEGREES)) + 1)
+    cols = range(int(math.floor(min_lng / CELL_DEGREES)), int(math.floor(max_lng / CELL_DEGREES)) + 1)
+    if len(rows) * len(cols) > 10000:
+        # too wide to enumerate, such a query gets a group of its own
+        return [('wide', id(query))]
+    return [(row, col) for row in rows for col in cols]
+
+
+def group_queries(queries):
+    """
+    Union the queries sharing a cell, at most MAX_GROUP_SIZE queries per group.
+
+    :return: list of lists of positions in queries
+    """
+    parents = list(range(len(queries)))
+    sizes = [1] * len(queries)
+
+    def find(position):
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    owners = {}
+    for position, query in enumerate(queries):
+        for cell in cells(query):
+            owner = owners.setdefault(cell, position)
+            root, other = find(position), find(owner)
+            if root != other and sizes[root] + sizes[other] <= MAX_GROUP_SIZE:
+                parents[other] = root
+                sizes[root] += sizes[other]
+
+    groups = {}
+    for position in range(len(queries)):
+        groups.setdefault(find(position), []).append(position)
+    return list(groups.values())
+
+
+def search_group(queries):
+    from parking.models import ParkingSpot, ParkingSpotReservation
+
+    if sharding.needs_scatter():
+        return sharding.search_group(queries)
+
+    candidates = ParkingSpot.in_ranges((query.lat, query.lng, query.radius) for query in queries)
+    spots = list(ParkingSpot.lean_values(candidates.order_by('id')))
+
+    # the queries of a route usually share their window, it is checked once for all of them
+    windows = {(query.start_ts, query.end_ts) for query in queries
+               if query.start_ts is not None and query.end_ts is not None}
+    free = {window: set(ParkingSpotReservation.exclude_reserved(candidates, *window).values_list('id', flat=True))
+            for window in windows}
+
+    results = []
+    for query in queries:
+        available = free.get((query.start_ts, query.end_ts))
+        matches = [(spot_id, lng, lat, address) for spot_id, lng, lat, address in spots
+                   if haversine_meters(query.lat, query.lng, lat, lng) <= query.radius
+                   and (available is None or spot_id in available)]
+        results.append({
+            'hits': {
+                'offset': 0,
+                'page_size': min(len(matches), query.page_size),
+                'total': len(matches)
+            },
+            'result': [{
+                'id': spot_id,
+                'lng': lng,
+                'lat': lat,
+                'address': address
+            } for spot_id, lng, lat, address in matches[:query.page_size]]
+        })
+    return results
+
+
+def merge(queries, groups, group_results):
+    """
+    Put the results of every group back in the order of the queries.
+    """
+    results = [None] * len(queries)
+    for group, group_result in zip(groups, group_results):
+        for position, result in zip(group, group_result):
+            results[position] = result
+    return results
+
+
+def search(queries):
+    """
+    :param queries: list of SearchQuery
+    :return: one available-style response per query, in input order
+    """
+    groups = group_queries(queries)
+    return merge(queries, groups, [search_group([queries[position] for position in group]) for group in groups])
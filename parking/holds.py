@@ -0,0 +1,147 @@
+"""
+Expiry of reservation holds.
+
+A hold is a ParkingSpotReservation with a hold token and an expiry date, placed by
+ParkingSpotReservation.hold and confirmed by ParkingSpotReservation.confirm. Searches
+and bookings ignore it once it expired, whether it was deleted yet or not: the queries
+through ParkingSpotReservation.taken_filter, the availability engine and the slot
+bitmaps by the expiry date they keep with the hold.
+
+HoldExpiry deletes the expired holds: a heap of (expiry date, reservation id, database)
+and a thread sleeping until the earliest expiry, so releasing a hold is a heap pop and
+a delete by id instead of a periodic scan for expired rows. The delete sends
+post_delete, which frees the window in the availability engine, the slot bitmaps and
+the cache. Confirmed holds stay in the heap, their delete matches no row.
+
+Every process releases the holds it placed and the ones pending when it started,
+`manage.py archive_reservations` deletes what a stopped process left behind.
+"""
+import heapq
+import logging
+import threading
+
+from django.db import close_old_connections, router
+from django.utils import timezone
+
+from parking import sharding
+
+logger = logging.getLogger(__name__)
+
+
+class HoldExpiry():
+    def __init__(self):
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, reservation_id, expires_at, using=None):
+        with self._condition:
+            heapq.heappush(self._heap, (expires_at, reservation_id, using))
+            # the thread sleeps until the earliest expiry, which may now be this one
+            if self._heap[0][1] == reservation_id:
+                self._condition.notify()
+
+    def pop_due(self, now=None):
+        """
+        :return: dict of database to the ids of the holds which expired
+        """
+        now = now or timezone.now()
+        due = {}
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                _, reservation_id, using = heapq.heappop(self._heap)
+                due.setdefault(using, []).append(reservation_id)
+        return due
+
+    def release_due(self, now=None):
+        """
+        Delete the holds which expired.
+
+        :return: number of holds released
+        """
+        from parking.models import ParkingSpotReservation
+
+        now = now or timezone.now()
+        return sum(ParkingSpotReservation.release_expired(reservation_ids, using, now)
+                   for using, reservation_ids in self.pop_due(now).items())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='parking-hold-expiry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _wait(self):
+        """
+        Sleep until a hold expired.
+
+        :return: False once stopped
+        """
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                remaining = (self._heap[0][0] - timezone.now()).total_seconds()
+                if remaining <= 0:
+                    return True
+                self._condition.wait(remaining)
+            return False
+
+    def _run(self):
+        while self._wait():
+            try:
+                released = self.release_due()
+                logger.debug('Released %s expired holds', released)
+            except Exception:
+                # the popped holds are ignored by the searches anyway, the archive command deletes them
+                logger.exception('Could not release the expired holds')
+            finally:
+                close_old_connections()
+
+
+_expiry = None
+_expiry_lock = threading.Lock()
+
+
+def get_expiry():
+    """
+    Process wide expiry, loaded with the pending holds and started on first use.
+    """
+    global _expiry
+    if _expiry is None:
+        with _expiry_lock:
+            if _expiry is None:
+                _expiry = build_expiry()
+                _expiry.start()
+    return _expiry
+
+
+def build_expiry():
+    from parking.models import ParkingSpotReservation
+
+    expiry = HoldExpiry()
+    for using in sharding.aliases() or [router.db_for_write(ParkingSpotReservation)]:
+        pending = ParkingSpotReservation.objects.using(using).filter(expires_at__isnull=False) \
+            .values_list('id', 'expires_at')
+        for reservation_id, expires_at in pending.iterator():
+            expiry.schedule(reservation_id, expires_at, using)
+    logger.info('Scheduled the expiry of %s holds', len(expiry))
+    return expiry
+
+
+def reset_expiry():
+    global _expiry
+    with _expiry_lock:
+        if _expiry is not None:
+            _expiry.stop()
+        _expiry = None
@@ -0,0 +1,112 @@
+"""
+Cross-process updates of the in-process availability structures and spatial index.
+
+The availability engine, the slot bitmaps and the spatial index follow the writes of
+their own process through the save and delete signals. The writes of the other workers,
+the admin, bulk imports or any other client of the database are read from
+ReservationChange and SpotChange, which SQLite triggers append to: a Journal is the
+position of one structure in such a log, and catch_up and catch_up_spots reload the
+rows written since, one query on the log's primary key when nothing changed.
+
+Change ids have no gaps, SQLite has a single writer and AUTOINCREMENT ids. A gap means
+the changes were pruned before the structure read them, and it is rebuilt.
+"""
+import logging
+import threading
+
+from django.db.models import Max
+
+logger = logging.getLogger(__name__)
+
+# more changes than this since the last poll rebuild the structure instead
+MAX_CHANGES = 1000
+
+
+class Journal():
+    def __init__(self, using, last_id, model=None):
+        """
+        :param model: the ChangeLog followed, defaults to ReservationChange
+        """
+        from parking.models import ReservationChange
+
+        self.using = using
+        self.last_id = last_id
+        self.model = model or ReservationChange
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def at_end(using, model=None):
+        """
+        A journal after the latest change, taken before the structure loads the rows.
+        """
+        journal = Journal(using, 0, model)
+        journal.last_id = journal.model.objects.using(using).aggregate(last_id=Max('id'))['last_id'] or 0
+        return journal
+
+    def poll(self, limit=MAX_CHANGES):
+        """
+        :return: ids of the rows written since the previous poll, None when the
+        structure must be rebuilt
+        """
+        with self._lock:
+            changes = list(self.model.objects.using(self.using).filter(id__gt=self.last_id)
+                           .order_by('id').values_list('id', self.model.changed_field)[:limit + 1])
+            if not changes:
+                return []
+            if len(changes) > limit or changes[0][0] != self.last_id + 1:
+                return None
+            self.last_id = changes[-1][0]
+            return sorted({row_id for _, row_id in changes})
+
+
+def catch_up(structure, journal, chunk_size=500):
+    """
+    Apply the reservations written since the last poll to the structure, an
+    AvailabilityEngine or SlotBitmaps.
+
+    :return: False when the structure must be rebuilt
+    """
+    from parking.models import ParkingSpotReservation
+
+    changed = journal.poll()
+    if changed is None:
+        logger.info('Too many reservation changes to catch up with, rebuilding %s', type(structure).__name__)
+        return False
+    for position in range(0, len(changed), chunk_size):
+        chunk = changed[position:position + chunk_size]
+        current = ParkingSpotReservation.objects.using(journal.using).filter(
+            ParkingSpotReservation.taken_filter(), id__in=chunk,
+        ).values_list('id', 'parkingspot_id', 'start_ts', 'end_ts', 'expires_at')
+        found = set()
+        for reservation_id, spot_id, start, end, expires_at in current:
+            structure.add(reservation_id, spot_id, start, end, expires_at)
+            found.add(reservation_id)
+        for reservation_id in chunk:
+            if reservation_id not in found:
+                structure.remove(reservation_id)
+    return True
+
+
+def catch_up_spots(index, journal, chunk_size=500):
+    """
+    Apply the parking spots written since the last poll to the spatial index.
+
+    :return: False when the index must be rebuilt
+    """
+    from parking.models import ParkingSpot
+
+    changed = journal.poll()
+    if changed is None:
+        logger.info('Too many parking spot changes to catch up with, rebuilding %s', type(index).__name__)
+        return False
+    for position in range(0, len(changed), chunk_size):
+        chunk = changed[position:position + chunk_size]
+        current = ParkingSpot.lean_values(ParkingSpot.objects.using(journal.using).filter(id__in=chunk))
+        found = set()
+        for spot_id, lng, lat, _ in current:
+            index.add(spot_id, lat, lng)
+            found.add(spot_id)
+        for spot_id in chunk:
+            if spot_id not in found:
+                index.remove(spot_id)
+    return True
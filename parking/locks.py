@@ -0,0 +1,53 @@
+"""
+Striped locks serialising the bookings of the same parking spot within a process.
+
+Bookings of different spots only share a lock when their ids hash to the same stripe,
+so contention stays proportional to the bookings per spot instead of the total.
+Across processes SQLite's write lock serialises them, retry_locked retries a write
+which found it taken.
+"""
+import contextlib
+import threading
+import time
+
+from django.db import OperationalError
+
+STRIPES = 64
+
+_locks = [threading.Lock() for _ in range(STRIPES)]
+
+
+def stripe(parkingspot_id):
+    return hash(parkingspot_id) % STRIPES
+
+
+def spot_lock(parkingspot_id):
+    return _locks[stripe(parkingspot_id)]
+
+
+@contextlib.contextmanager
+def spot_locks(parkingspot_ids):
+    """
+    Hold the locks of several spots, always taken in stripe order to avoid deadlocks.
+    """
+    stripes = sorted({stripe(parkingspot_id) for parkingspot_id in parkingspot_ids})
+    with contextlib.ExitStack() as stack:
+        for position in stripes:
+            stack.enter_context(_locks[position])
+        yield
+
+
+def retry_locked(func, attempts=5):
+    """
+    Call func, again after a backoff while SQLite reports the database locked by another
+    connection. func must run its own transaction, which is rolled back when it fails.
+
+    :return: what func returns
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except OperationalError as exc:
+            if 'locked' not in str(exc) or attempt == attempts - 1:
+                raise
+            time.sleep(0.01 * 2 ** attempt)
@@ -0,0 +1,118 @@
+"""
+Logging helpers keeping log formatting and I/O out of the request path.
+
+BackgroundHandler hands the records to a writer thread, which formats and writes
+them. Payload level logs are thinned out by SampleFilter, and payloads are logged as
+a Summary, a few counts and ids rendered only if the record is written.
+"""
+import atexit
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+SUMMARY_IDS = 5
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Queues the records for a writer thread forwarding them to `handler`, a StreamHandler
+    by default. Records are dropped and counted when more than `maxsize` are waiting,
+    so a slow sink never blocks a request.
+
+    Records are formatted by the writer thread, the arguments of a log call must not
+    be mutated after it.
+    """
+
+    def __init__(self, handler=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.handler = handler if handler is not None else logging.StreamHandler()
+        self.dropped = 0
+        self.listener = None
+        # process whose writer thread is running, dictConfig runs before the server forks
+        # its workers and a forked process has no threads, so each one starts its own
+        self._pid = None
+        self._closed = False
+        atexit.register(self.close)
+
+    def start(self):
+        """
+        Start the writer thread of this process, called with the handler lock held.
+        """
+        if self._pid is not None:
+            # forked: the parent's records and its writer thread's queue locks are not ours
+            self.queue = queue.Queue(self.queue.maxsize)
+        self.listener = QueueListener(self.queue, self.handler, respect_handler_level=True)
+        self.listener.start()
+        self._pid = os.getpid()
+
+    def setFormatter(self, fmt):
+        # the target handler formats, dictConfig sets the formatter on this one
+        super().setFormatter(fmt)
+        self.handler.setFormatter(fmt)
+
+    def prepare(self, record):
+        # unlike QueueHandler, leave the formatting to the writer thread
+        return record
+
+    def enqueue(self, record):
+        if self._closed:
+            return
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Wait until the queued records are written.
+        """
+        if self._pid == os.getpid():
+            self.queue.join()
+        self.handler.flush()
+
+    def close(self):
+        with self.lock:
+            if self._pid == os.getpid():
+                self.listener.stop()
+            self._pid = None
+            self._closed = True
+        self.handler.close()
+        super().close()
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps a `rate` fraction of the records at or below `level`, records above it always pass.
+    """
+
+    def __init__(self, rate=1.0, level=logging.INFO):
+        super().__init__()
+        self.rate = float(rate)
+        self.level = logging._checkLevel(level)
+
+    def filter(self, record):
+        return record.levelno > self.level or self.rate >= 1 or random.random() < self.rate
+
+
+class Summary():
+    """
+    Lazy one line summary of a response payload: the hit counts and the first ids of its results.
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        parts = ['%s=%s' % (key, value) for key, value in sorted(self.payload.get('hits', {}).items())
+                 if key != 'next_cursor']
+        results = self.payload.get('result')
+        if results is not None:
+            ids = [str(result['id']) for result in results[:SUMMARY_IDS]]
+            if len(results) > SUMMARY_IDS:
+                ids.append('...')
+            parts.append('results=%s ids=[%s]' % (len(results), ','.join(ids)))
+        return ' '.join(parts)
@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from parking import sharding
+from parking.models import ArchivedReservation, ParkingSpotReservation, ReservationChange, SpotChange
+
+
+class Command(BaseCommand):
+    help = 'Move the reservations which ended to the archive table, in batches, delete the expired holds ' \
+           'and prune the reservation and spot change logs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', help='archive the reservations ending before this ISO timestamp, '
+                                             'defaults to now minus --keep-days')
+        parser.add_argument('--keep-days', type=int, default=1, help='days of ended reservations kept active')
+        parser.add_argument('--batch-size', type=int, default=5000, help='reservations moved per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='only count the reservations to archive')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['before']:
+            before = parse_datetime(options['before'])
+            if before is None:
+                raise CommandError('Invalid --before timestamp: %s' % options['before'])
+            if timezone.is_naive(before):
+                before = timezone.make_aware(before)
+        else:
+            before = now - timedelta(days=options['keep_days'])
+        if before > now:
+            raise CommandError('Reservations which did not end yet can still conflict, --before must be in the past')
+
+        # every shard archives its own reservations
+        databases = sharding.aliases() or [None]
+        if options['dry_run']:
+            ended = [ParkingSpotReservation.objects.using(using).filter(end_ts__lt=before, hold_token__isnull=True)
+                     for using in databases]
+            self.stdout.write('%s reservations ended before %s' % (
+                sum(queryset.count() for queryset in ended), before.isoformat()))
+            return
+
+        started = time.perf_counter()
+        archived = 0
+        for using in databases:
+            # holds whose process stopped before it could release them
+            released = ParkingSpotReservation.release_expired(using=using, now=now)
+            if released:
+                self.stdout.write('%s expired holds released' % released)
+            while True:
+                moved = ArchivedReservation.archive(before, options['batch_size'], using)
+                if not moved:
+                    break
+                archived += moved
+                self.stdout.write('%s reservations archived' % archived)
+            # the workers follow the change logs continuously, a day old changes were read long ago
+            ReservationChange.prune(now - timedelta(days=1), using)
+            SpotChange.prune(now - timedelta(days=1), using)
+
+        self.stdout.write(self.style.SUCCESS('Archived %s reservations ended before %s in %.1fs' % (
+            archived, before.isoformat(), time.perf_counter() - started)))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from parking import snapshot
+
+
+class Command(BaseCommand):
+    help = 'Write the coordinates of every parking spot to the memory-mapped spot snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='snapshot file, defaults to PARKING_SPOT_SNAPSHOT')
+
+    def handle(self, *args, **options):
+        path = options['path'] or snapshot.path()
+        if not path:
+            raise CommandError('No snapshot file, set PARKING_SPOT_SNAPSHOT or pass --path')
+
+        started = time.perf_counter()
+        version, count = snapshot.build(path)
+        self.stdout.write(self.style.SUCCESS('Wrote spot snapshot version %s with %s parking spots to %s in %.1fs' % (
+            version, count, path, time.perf_counter() - started)))
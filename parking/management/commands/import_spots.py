@@ -0,0 +1,101 @@
+import itertools
+import sys
+import time
+from contextlib import ExitStack
+
+from django.contrib.gis.geos import Point
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from parking import sharding, snapshot, spatial_index
+from parking.models import ParkingSpot
+from parking.spot_import import FORMATS, READERS, chunks, detect_format
+
+# relaxed durability for the duration of the load, the previous values are restored afterwards
+IMPORT_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': '-262144',
+    'temp_store': 'MEMORY',
+}
+
+
+class Command(BaseCommand):
+    help = 'Stream parking spots from a CSV (lat,lng,address), GeoJSON or NDJSON file into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='input file, - for stdin')
+        parser.add_argument('--format', choices=FORMATS, help='defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=5000, help='rows per INSERT batch')
+        parser.add_argument('--transaction-size', type=int, default=20,
+                            help='batches committed per transaction')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            file_format = options['format'] or detect_format(path)
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        stream = sys.stdin if path == '-' else open(path, newline='' if file_format == 'csv' else None)
+        databases = sharding.aliases() or [router.db_for_write(ParkingSpot)]
+        previous = self.tune_pragmas(databases)
+        started = time.perf_counter()
+        imported = 0
+        try:
+            spots = (ParkingSpot(location=Point(lng, lat, srid=4326), address=address)
+                     for lat, lng, address in READERS[file_format](stream))
+            batches = chunks(spots, options['batch_size'])
+            while True:
+                committed = imported
+                with ExitStack() as transactions:
+                    for using in databases:
+                        transactions.enter_context(transaction.atomic(using=using))
+                    for batch in itertools.islice(batches, options['transaction_size']):
+                        # every spot goes to the shard of its geohash
+                        for using, spots_of_shard in sharding.group_spots(batch).items():
+                            ParkingSpot.objects.using(using).bulk_create(spots_of_shard)
+                        imported += len(batch)
+                if imported == committed:
+                    break
+                elapsed = time.perf_counter() - started
+                self.stdout.write('%s rows, %.0f rows/s' % (imported, imported / elapsed))
+        except (KeyError, TypeError, ValueError) as exc:
+            raise CommandError('Invalid record after %s rows: %s' % (imported, exc))
+        finally:
+            self.restore_pragmas(previous)
+            if stream is not sys.stdin:
+                stream.close()
+
+        # bulk_create skips the save signals, rebuild the index on its next use
+        spatial_index.reset_index()
+        if snapshot.path():
+            version, count = snapshot.build()
+            self.stdout.write('Wrote spot snapshot version %s with %s parking spots' % (version, count))
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS('Imported %s parking spots in %.1fs (%.0f rows/s)' % (
+            imported, elapsed, imported / elapsed if elapsed else 0)))
+
+    def tune_pragmas(self, databases):
+        """
+        :return: dict of database to the previous values of the pragmas changed on it
+        """
+        previous = {}
+        for using in databases:
+            connection = connections[using]
+            if connection.vendor != 'sqlite' or connection.in_atomic_block:
+                # SQLite refuses to change the synchronous level inside a transaction
+                continue
+            previous[using] = {}
+            with connection.cursor() as cursor:
+                for pragma, value in IMPORT_PRAGMAS.items():
+                    cursor.execute('PRAGMA %s' % pragma)
+                    previous[using][pragma] = cursor.fetchone()[0]
+                    cursor.execute('PRAGMA %s = %s' % (pragma, value))
+        return previous
+
+    def restore_pragmas(self, previous):
+        for using, pragmas in previous.items():
+            with connections[using].cursor() as cursor:
+                for pragma, value in pragmas.items():
+                    cursor.execute('PRAGMA %s = %s' % (pragma, value))
@@ -0,0 +1,20 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from parking import sharding
+
+
+class Command(BaseCommand):
+    help = 'Migrate the shard databases and start the ids of every shard at its own range'
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            raise CommandError('No shards configured, set PARKING_SHARD_FILES')
+
+        for alias in sharding.aliases():
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError('Only SQLite shards are supported, %s is %s' % (alias, connections[alias].vendor))
+            call_command('migrate', database=alias, verbosity=max(0, options['verbosity'] - 1))
+            sharding.seed_id_range(alias)
+            self.stdout.write(self.style.SUCCESS('Initialised %s, ids above %s' % (alias, sharding.id_base(alias))))
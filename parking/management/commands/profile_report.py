@@ -0,0 +1,32 @@
+import pstats
+
+from django.core.management.base import BaseCommand, CommandError
+
+from parking import profiling
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+
+class Command(BaseCommand):
+    help = 'Aggregate the request profiles written by the profiling middleware into the top N functions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='profile directory, defaults to PARKING_PROFILE_DIR')
+        parser.add_argument('--endpoint', help='only the profiles of this endpoint, e.g. parking:available')
+        parser.add_argument('--top', type=int, default=25, help='number of functions to show')
+        parser.add_argument('--sort', choices=SORT_KEYS, default='cumulative')
+
+    def handle(self, *args, **options):
+        directory = options['dir'] or profiling.profile_dir()
+        try:
+            paths = profiling.dumps(directory, options['endpoint'])
+        except OSError as exc:
+            raise CommandError(exc)
+        if not paths:
+            raise CommandError('No profiles found in %s' % directory)
+
+        stats = pstats.Stats(paths[0], stream=self.stdout)
+        for path in paths[1:]:
+            stats.add(path)
+        self.stdout.write('%s profiles from %s' % (len(paths), directory))
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
@@ -0,0 +1,29 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database to the read replica files with the SQLite backup api'
+
+    def handle(self, *args, **options):
+        primary = connections[DEFAULT_DB_ALIAS]
+        if primary.vendor != 'sqlite':
+            raise CommandError('Only SQLite replicas can be synced, replicate other databases with their own tools')
+        aliases = getattr(settings, 'PARKING_READ_REPLICAS', [])
+        if not aliases:
+            raise CommandError('No read replicas configured, set PARKING_READ_REPLICA_FILES')
+
+        primary.ensure_connection()
+        for alias in aliases:
+            started = time.perf_counter()
+            connections[alias].close()
+            target = sqlite3.connect(connections[alias].settings_dict['NAME'])
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(self.style.SUCCESS('Synced %s in %.1fs' % (alias, time.perf_counter() - started)))
@@ -0,0 +1,197 @@
+"""
+Process wide request metrics, rendered in the Prometheus text format by the /metrics endpoint.
+
+MetricsMiddleware records for every endpoint the request latency, the number and the
+time of the SQL queries it ran and whether it went over PARKING_QUERY_BUDGET queries.
+The availability cache counters are read from parking.availability_cache.stats when
+the metrics are rendered.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import ExitStack
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, format_labels(self.labels, label_values), value) for label_values, value in values]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram():
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket, +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [[0] * len(self.buckets), 0, 0]
+            if position < len(self.buckets):
+                counts[0][position] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def count(self, *label_values):
+        counts = self._values.get(label_values)
+        return counts[1] if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, (list(counts[0]), counts[1], counts[2]))
+                            for label_values, counts in self._values.items())
+        samples = []
+        for label_values, (bucket_counts, total, value_sum) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                samples.append(('%s_bucket' % self.name,
+                                format_labels(self.labels + ('le',), label_values + (format_value(bound),)),
+                                cumulative))
+            samples.append(('%s_bucket' % self.name, format_labels(self.labels + ('le',), label_values + ('+Inf',)),
+                            total))
+            samples.append(('%s_sum' % self.name, format_labels(self.labels, label_values), value_sum))
+            samples.append(('%s_count' % self.name, format_labels(self.labels, label_values), total))
+        return samples
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+REQUEST_LATENCY = Histogram('parking_request_duration_seconds', 'Request latency.', ['endpoint', 'method'])
+REQUESTS = Counter('parking_requests_total', 'Requests by response status.', ['endpoint', 'method', 'status'])
+SQL_QUERIES = Histogram('parking_sql_queries_per_request', 'SQL queries run by a request.', ['endpoint'],
+                        buckets=QUERY_COUNT_BUCKETS)
+SQL_DURATION = Histogram('parking_sql_duration_seconds', 'Time a request spent in SQL queries.', ['endpoint'])
+QUERY_BUDGET_EXCEEDED = Counter('parking_query_budget_exceeded_total',
+                                'Requests which ran more SQL queries than PARKING_QUERY_BUDGET.', ['endpoint'])
+RESERVATION_CONFLICTS = Counter('parking_reservation_conflicts_total',
+                                'Reservations rejected because the spot was taken.', ['mode'])
+HOLDS = Counter('parking_reservation_holds_total', 'Reservation holds placed, confirmed and expired.', ['outcome'])
+
+REGISTRY = [REQUEST_LATENCY, REQUESTS, SQL_QUERIES, SQL_DURATION, QUERY_BUDGET_EXCEEDED, RESERVATION_CONFLICTS,
+            HOLDS]
+
+
+class QueryStats():
+    """
+    SQL queries of one request, filled by the execute wrapper of every connection it uses.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.queries += 1
+                self.duration += elapsed
+
+
+_current = contextvars.ContextVar('parking_query_stats', default=None)
+
+
+def current_stats():
+    return _current.get()
+
+
+def set_current_stats(stats):
+    _current.set(stats)
+
+
+def track_queries(stats):
+    """
+    Count the queries run on this thread's database connections into stats.
+
+    :return: a context manager
+    """
+    from django.db import connections
+
+    stack = ExitStack()
+    if stats is not None:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+    return stack
+
+
+def cache_samples():
+    from parking import availability_cache
+
+    values = availability_cache.stats.as_dict()
+    return [('parking_availability_cache_%s_total' % counter, 'counter',
+             'Availability cache %s.' % counter, values[counter])
+            for counter in ('hits', 'misses', 'bypassed', 'invalidations')]
+
+
+def render():
+    """
+    All the metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, labels, format_value(value)))
+    for name, kind, documentation, value in cache_samples():
+        lines.append('# HELP %s %s' % (name, documentation))
+        lines.append('# TYPE %s %s' % (name, kind))
+        lines.append('%s %s' % (name, format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.clear()
@@ -0,0 +1,172 @@
+import cProfile
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from parking import metrics, profiling, routers
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsMiddleware():
+    """
+    Records the latency and the SQL queries of every request in parking.metrics and flags
+    the requests running more than PARKING_QUERY_BUDGET queries with an
+    X-Query-Budget-Exceeded header and a warning.
+
+    Under ASGI the queries are counted by parking.async_views.run_db, which runs them.
+    The queries of a streaming response run after the middleware returns and are not counted.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = metrics.QueryStats()
+        metrics.set_current_stats(stats)
+        started = time.perf_counter()
+        try:
+            with metrics.track_queries(stats):
+                response = self.get_response(request)
+        finally:
+            metrics.set_current_stats(None)
+        return self.record(request, response, stats, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        stats = metrics.QueryStats()
+        metrics.set_current_stats(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.set_current_stats(None)
+        return self.record(request, response, stats, time.perf_counter() - started)
+
+    def record(self, request, response, stats, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match is not None else 'unmatched'
+        metrics.REQUEST_LATENCY.observe(elapsed, endpoint, request.method)
+        metrics.REQUESTS.inc(endpoint, request.method, response.status_code)
+        metrics.SQL_QUERIES.observe(stats.queries, endpoint)
+        metrics.SQL_DURATION.observe(stats.duration, endpoint)
+
+        response['X-Query-Count'] = str(stats.queries)
+        budget = getattr(settings, 'PARKING_QUERY_BUDGET', None)
+        if budget is not None and stats.queries > budget:
+            metrics.QUERY_BUDGET_EXCEEDED.inc(endpoint)
+            response['X-Query-Budget-Exceeded'] = '%s/%s' % (stats.queries, budget)
+            logger.warning('%s %s ran %s SQL queries (%.1fms), over the budget of %s',
+                           request.method, request.path, stats.queries, stats.duration * 1000, budget)
+        return response
+
+
+class ProfilingMiddleware():
+    """
+    Runs the requests picked by parking.profiling under cProfile and dumps their profiles.
+
+    Only the thread handling the request is profiled, the database work of the async views
+    runs in their thread pool and is not part of the profile. Under ASGI that thread is the
+    event loop's, so the profile also holds the steps other requests ran while this one waited.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        profiler = self.start(request)
+        if profiler is None:
+            return self.get_response(request)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.dump(profiler, request, response, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        profiler = self.start(request)
+        if profiler is None:
+            return await self.get_response(request)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+        return self.dump(profiler, request, response, time.perf_counter() - started)
+
+    def start(self, request):
+        """
+        :return: the enabled profiler, None if the request is not profiled
+        """
+        if not profiling.should_profile(request):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already attached to this thread
+            return None
+        return profiler
+
+    def dump(self, profiler, request, response, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match is not None else 'unmatched'
+        path = profiling.dump(profiler, request, endpoint, response.status_code, elapsed)
+        logger.info('Profiled %s %s in %s', request.method, request.path, path)
+        return response
+
+
+class ReadYourWritesMiddleware():
+    """
+    Pins the reads of a client to the primary database for PARKING_READ_YOUR_WRITES_SECONDS
+    after one of its requests wrote, so it sees its booking before the replicas catch up.
+    """
+    cookie = 'parking_primary'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = routers.RoutingState(pinned=self.cookie in request.COOKIES)
+        routers.set_state(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.set_state(None)
+        return self.pin(state, response)
+
+    async def __acall__(self, request):
+        # the state is shared with the pool threads of the async views through the context
+        state = routers.RoutingState(pinned=self.cookie in request.COOKIES)
+        routers.set_state(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            routers.set_state(None)
+        return self.pin(state, response)
+
+    def pin(self, state, response):
+        seconds = getattr(settings, 'PARKING_READ_YOUR_WRITES_SECONDS', 0)
+        if state.wrote and seconds and routers.replicas():
+            response.set_cookie(self.cookie, '1', max_age=seconds, httponly=True)
+        return response
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='parkingspotreservation',
+            index=models.Index(fields=['parkingspot', 'start_ts', 'end_ts'], name='reservation_spot_window_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_spatial_index(apps, schema_editor):
+    """
+    The R*Tree ParkingSpot.bbox_filter searches, databases created before location was
+    indexed don't have it.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT spatial_index_enabled FROM geometry_columns '
+                       'WHERE f_table_name = %s AND f_geometry_column = %s', ['parking_parkingspot', 'location'])
+        row = cursor.fetchone()
+        if row is not None and not row[0]:
+            cursor.execute('SELECT CreateSpatialIndex(%s, %s)', ['parking_parkingspot', 'location'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0002_reservation_spot_window_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_spatial_index, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='parkingspotreservation',
+            name='parkingspot',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='parking.ParkingSpot'),
+        ),
+        migrations.AddIndex(
+            model_name='parkingspotreservation',
+            index=models.Index(fields=['user_id', 'start_ts'], name='reservation_user_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='parkingspotreservation',
+            index=models.Index(fields=['end_ts'], name='reservation_end_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0003_reservation_indexes_spatial_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedReservation',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('user_id', models.IntegerField()),
+                ('start_ts', models.DateTimeField(verbose_name='reservation start date')),
+                ('end_ts', models.DateTimeField(verbose_name='reservation end date')),
+                ('create_date', models.DateTimeField(verbose_name='creation date')),
+                ('archive_date', models.DateTimeField(auto_now_add=True, verbose_name='archival date')),
+                ('parkingspot', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='parking.ParkingSpot')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedreservation',
+            index=models.Index(fields=['user_id', 'start_ts'], name='archive_user_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedreservation',
+            index=models.Index(fields=['parkingspot', 'start_ts'], name='archive_spot_start_idx'),
+        ),
+    ]
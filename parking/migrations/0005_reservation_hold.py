@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0004_archivedreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parkingspotreservation',
+            name='hold_token',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='parkingspotreservation',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='hold expiry date'),
+        ),
+        migrations.AddIndex(
+            model_name='parkingspotreservation',
+            index=models.Index(fields=['expires_at'], name='reservation_expires_idx'),
+        ),
+    ]
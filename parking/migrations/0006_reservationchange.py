@@ -0,0 +1,52 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+TRIGGERS = {
+    'reservation_change_insert': 'AFTER INSERT ON parking_parkingspotreservation BEGIN '
+                                 'INSERT INTO parking_reservationchange (reservation_id, change_date) '
+                                 "VALUES (NEW.id, strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+    'reservation_change_update': 'AFTER UPDATE ON parking_parkingspotreservation BEGIN '
+                                 'INSERT INTO parking_reservationchange (reservation_id, change_date) '
+                                 "VALUES (NEW.id, strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+    # archived reservations ended already, their deletes don't change any availability
+    'reservation_change_delete': 'AFTER DELETE ON parking_parkingspotreservation '
+                                 "WHEN OLD.end_ts >= strftime('%Y-%m-%d %H:%M:%f', 'now') BEGIN "
+                                 'INSERT INTO parking_reservationchange (reservation_id, change_date) '
+                                 "VALUES (OLD.id, strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+}
+
+
+def create_triggers(apps, schema_editor):
+    """
+    The triggers logging the reservation writes to ReservationChange.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, trigger in TRIGGERS.items():
+        schema_editor.execute('CREATE TRIGGER %s %s' % (name, trigger))
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name in TRIGGERS:
+        schema_editor.execute('DROP TRIGGER IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0005_reservation_hold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReservationChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reservation_id', models.IntegerField()),
+                ('change_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='change date')),
+            ],
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
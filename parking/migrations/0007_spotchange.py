@@ -0,0 +1,53 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+TRIGGERS = {
+    'spot_change_insert': 'AFTER INSERT ON parking_parkingspot BEGIN '
+                          'INSERT INTO parking_spotchange (spot_id, change_date) '
+                          "VALUES (NEW.id, strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+    'spot_change_update': 'AFTER UPDATE ON parking_parkingspot BEGIN '
+                          'INSERT INTO parking_spotchange (spot_id, change_date) '
+                          "VALUES (NEW.id, strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+    'spot_change_delete': 'AFTER DELETE ON parking_parkingspot BEGIN '
+                          'INSERT INTO parking_spotchange (spot_id, change_date) '
+                          "VALUES (OLD.id, strftime('%Y-%m-%d %H:%M:%f', 'now')); END",
+}
+
+
+def create_triggers(apps, schema_editor):
+    """
+    The triggers logging the parking spot writes to SpotChange.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name, trigger in TRIGGERS.items():
+        schema_editor.execute('CREATE TRIGGER %s %s' % (name, trigger))
+
+
+def drop_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for name in TRIGGERS:
+        schema_editor.execute('DROP TRIGGER IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parking', '0006_reservationchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpotChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('change_date', models.DateTimeField(default=django.utils.timezone.now, verbose_name='change date')),
+                ('spot_id', models.IntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
@@ -1,15 +1,28 @@
+import heapq
+import operator
+import secrets
+from contextlib import ExitStack
+from datetime import timedelta
+from functools import reduce
+
 import django
+from django.conf import settings
 from django.contrib.gis.db.models import PointField
+from django.contrib.gis.db.models.functions import Distance as GeoDistance
 from django.contrib.gis.geos import fromstr
 from django.contrib.gis.measure import Distance
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q, ForeignObject
+from django.db import connections, models, router, transaction
+from django.db.models import signals
+from django.db.models import Exists, FloatField, Func, OuterRef, Q, ForeignObject
+from django.db.models.expressions import RawSQL
 from django.db.models.options import Options
 from django.db.models.sql.datastructures import Join
 from django.db.models.sql.where import ExtraWhere
 from django.utils import timezone
 
+from parking import availability, holds, locks, metrics, sharding, slots, spatial_index
+
 
 class DbUtils():
     @staticmethod
@@ -73,40 +86,531 @@ class ParkingSpot(models.Model):
         return fromstr("POINT(%s %s)" % (lng, lat))
 
     @staticmethod
-    def within_range(lat, lng, radius_meters, offset, pagesize, start_ts=None, end_ts=None):
-        ref_point = ParkingSpot.create_point(lat, lng)
+    def in_range(lat, lng, radius_meters, use_index=None):
+        """
+        Queryset of the parking spots within the radius.
 
-        queryset = ParkingSpot.objects.filter(
+        The in-memory spatial index turns the radius search into a lookup by id when
+        it is enabled and the candidate set is small enough for an IN clause. Otherwise
+        SpatiaLite computes the distance for every row.
+
+        :param use_index: defaults to the PARKING_SPATIAL_INDEX setting
+        :return:
+        """
+        if use_index is None:
+            use_index = spatial_index.is_enabled()
+
+        if use_index:
+            candidates = spatial_index.get_index().within(lat, lng, radius_meters)
+            if len(candidates) <= getattr(settings, 'PARKING_SPATIAL_INDEX_MAX_CANDIDATES', 900):
+                return ParkingSpot.objects.filter(id__in=[spot_id for spot_id, _ in candidates])
+
+        ref_point = ParkingSpot.create_point(lat, lng)
+        return ParkingSpot.objects.filter(
+            ParkingSpot.bbox_filter([spatial_index.bounding_box(lat, lng, radius_meters)]),
             location__distance_lte=(ref_point, Distance(m=radius_meters))
         )
 
+    @staticmethod
+    def in_ranges(circles, use_index=None):
+        """
+        Queryset of the parking spots within any of the circles, fetched in one query.
+
+        :param circles: iterable of (lat, lng, radius in meters)
+        """
+        circles = list(circles)
+        if use_index is None:
+            use_index = spatial_index.is_enabled()
+
+        if use_index:
+            index = spatial_index.get_index()
+            spot_ids = set()
+            for lat, lng, radius_meters in circles:
+                spot_ids.update(spot_id for spot_id, _ in index.within(lat, lng, radius_meters))
+            if len(spot_ids) <= getattr(settings, 'PARKING_SPATIAL_INDEX_MAX_CANDIDATES', 900):
+                return ParkingSpot.objects.filter(id__in=spot_ids)
+
+        if not circles:
+            return ParkingSpot.objects.none()
+        boxes = [spatial_index.bounding_box(lat, lng, radius_meters) for lat, lng, radius_meters in circles]
+        return ParkingSpot.objects.filter(ParkingSpot.bbox_filter(boxes)).filter(reduce(operator.or_, (
+            Q(location__distance_lte=(ParkingSpot.create_point(lat, lng), Distance(m=radius_meters)))
+            for lat, lng, radius_meters in circles
+        )))
+
+    @staticmethod
+    def bbox_filter(boxes):
+        """
+        Restrict the spots to the bounding boxes with a lookup in SpatiaLite's R*Tree on
+        location, which the distance lookups don't use by themselves. PostGIS uses its GiST
+        index for the distance lookups, so the filter is empty on other backends.
+
+        :param boxes: list of (min lat, max lat, min lng, max lng)
+        :return: Q
+        """
+        connection = connections[router.db_for_read(ParkingSpot)]
+        if connection.vendor != 'sqlite' or not boxes:
+            return Q()
+        rtree = connection.ops.quote_name('idx_%s_location' % ParkingSpot._meta.db_table)
+        where = ' OR '.join(['(xmax >= %s AND xmin <= %s AND ymax >= %s AND ymin <= %s)'] * len(boxes))
+        params = []
+        for min_lat, max_lat, min_lng, max_lng in boxes:
+            params.extend([min_lng, max_lng, min_lat, max_lat])
+        return Q(id__in=RawSQL('SELECT pkid FROM %s WHERE %s' % (rtree, where), params))
+
+    @staticmethod
+    def within_range(lat, lng, radius_meters, offset, pagesize, start_ts=None, end_ts=None, use_index=None,
+                     after_id=None, with_total=True, lean=False, with_distance=False):
+        """
+        Page of the parking spots within the radius, ordered by id.
+
+        :param after_id: keyset cursor, only spots with a greater id are returned
+        :param with_total: skip the COUNT query when False
+        :param pagesize: None for every spot after the offset
+        :param lean: page of (id, lng, lat, address) tuples instead of model instances
+        :param with_distance: list page with the haversine distance in meters, as the `distance`
+        attribute of the spots or a fifth column of the lean rows
+        :return: total (None without with_total) and the page queryset, a list when the spots are sharded
+        """
+        if sharding.needs_scatter():
+            return sharding.within_range(lat, lng, radius_meters, offset, pagesize, start_ts, end_ts, use_index,
+                                         after_id=after_id, with_total=with_total, lean=lean,
+                                         with_distance=with_distance)
+        queryset = ParkingSpot.search(lat, lng, radius_meters, start_ts, end_ts, use_index)
+        total = queryset.count() if with_total else None
+        page = ParkingSpot.page(queryset, offset, pagesize, after_id, lean)
+        if with_distance:
+            page = ParkingSpot.add_distances(lat, lng, page, lean)
+        return total, page
+
+    @staticmethod
+    def add_distances(lat, lng, rows, lean=False):
+        """
+        :return: list of the rows with their distance in meters from the point
+        """
+        if lean:
+            return [row + (spatial_index.haversine_meters(lat, lng, row[2], row[1]),) for row in rows]
+        spots = list(rows)
+        for spot in spots:
+            spot.distance = spatial_index.haversine_meters(lat, lng, spot.location.y, spot.location.x)
+        return spots
+
+    @staticmethod
+    def search(lat, lng, radius_meters, start_ts=None, end_ts=None, use_index=None):
+        """
+        Unordered queryset of the spots within the radius, available during the window if given.
+        """
+        queryset = ParkingSpot.in_range(lat, lng, radius_meters, use_index)
+
         if start_ts is not None and end_ts is not None:
-            join_query = DbUtils.join_to(ParkingSpot, ParkingSpotReservation, 'id', 'id', queryset)
-            queryset = join_query.filter(
-                Q(parkingspotreservation__isnull=True) \
-                | Q(parkingspotreservation__start_ts__gt=end_ts)
-                | Q(parkingspotreservation__end_ts__lt=start_ts)
-            )
+            queryset = ParkingSpotReservation.exclude_reserved(queryset, start_ts, end_ts)
+
+        return queryset
 
-        return queryset.count(), queryset[offset:pagesize]
+    @staticmethod
+    def page(queryset, offset, pagesize, after_id=None, lean=False):
+        queryset = queryset.order_by('id')
+        if after_id is not None:
+            queryset = queryset.filter(id__gt=after_id)
+        if lean:
+            queryset = ParkingSpot.lean_values(queryset)
+
+        return queryset[offset:offset + pagesize if pagesize is not None else None]
+
+    @staticmethod
+    def lean_values(queryset):
+        """
+        (id, lng, lat, address) rows with the coordinates read by SpatiaLite, so no
+        model instance or GEOS point is built per row.
+        """
+        return queryset.annotate(
+            lng=Func('location', function='ST_X', output_field=FloatField()),
+            lat=Func('location', function='ST_Y', output_field=FloatField()),
+        ).values_list('id', 'lng', 'lat', 'address')
+
+    @staticmethod
+    def ring(lat, lng, inner_radius_meters, outer_radius_meters, use_index=None):
+        """
+        Spots farther than the inner radius and within the outer one, closest first.
+
+        :return: list of (spot id, distance in meters)
+        """
+        if use_index is None:
+            use_index = spatial_index.is_enabled()
+
+        if use_index:
+            return [(spot_id, distance) for spot_id, distance
+                    in spatial_index.get_index().within(lat, lng, outer_radius_meters)
+                    if distance > inner_radius_meters]
+
+        ref_point = ParkingSpot.create_point(lat, lng)
+        queryset = ParkingSpot.objects.filter(
+            ParkingSpot.bbox_filter([spatial_index.bounding_box(lat, lng, outer_radius_meters)]),
+            location__distance_lte=(ref_point, Distance(m=outer_radius_meters))
+        )
+        if inner_radius_meters > 0:
+            queryset = queryset.exclude(location__distance_lte=(ref_point, Distance(m=inner_radius_meters)))
+        queryset = queryset.annotate(distance=GeoDistance('location', ref_point)).order_by('distance', 'id')
+        return [(spot_id, distance.m) for spot_id, distance in queryset.values_list('id', 'distance')]
+
+    @staticmethod
+    def nearest(lat, lng, k, start_ts=None, end_ts=None, initial_radius_meters=100, max_radius_meters=50000,
+                use_index=None, chunk_size=500):
+        """
+        The k closest parking spots, closest first, skipping the ones reserved during the
+        window when one is given.
+
+        The search radius doubles ring by ring, and candidates are checked for availability
+        in distance order, so it stops as soon as k spots are found: anything outside the
+        current ring is farther away than what was already found.
+
+        :return: list of (spot, distance in meters)
+        """
+        if sharding.needs_scatter():
+            return sharding.nearest(lat, lng, k, start_ts, end_ts, initial_radius_meters, max_radius_meters,
+                                    use_index, chunk_size)
+        found = []
+        inner, outer = 0, min(max(initial_radius_meters, 1), max_radius_meters)
+        while len(found) < k:
+            candidates = ParkingSpot.ring(lat, lng, inner, outer, use_index)
+            for position in range(0, len(candidates), chunk_size):
+                chunk = candidates[position:position + chunk_size]
+                if start_ts is not None and end_ts is not None:
+                    free = set(ParkingSpotReservation.exclude_reserved(
+                        ParkingSpot.objects.filter(id__in=[spot_id for spot_id, _ in chunk]), start_ts, end_ts
+                    ).values_list('id', flat=True))
+                    chunk = [candidate for candidate in chunk if candidate[0] in free]
+                found.extend(chunk[:k - len(found)])
+                if len(found) >= k:
+                    break
+            if outer >= max_radius_meters:
+                break
+            inner, outer = outer, min(outer * 2, max_radius_meters)
+
+        spots = ParkingSpot.objects.in_bulk([spot_id for spot_id, _ in found])
+        return [(spots[spot_id], distance) for spot_id, distance in found if spot_id in spots]
 
 
 class ParkingSpotReservation(models.Model):
     user_id = models.IntegerField()
-    parkingspot = models.ForeignKey(ParkingSpot, on_delete=models.SET_NULL, blank=True, null=True)
+    # indexed by reservation_spot_window_idx, whose first column it is
+    parkingspot = models.ForeignKey(ParkingSpot, on_delete=models.SET_NULL, blank=True, null=True, db_index=False)
     start_ts = models.DateTimeField('reservation start date')
     end_ts = models.DateTimeField('reservation end date')
     create_date = models.DateTimeField('creation date', auto_now_add=True, blank=True)
+    # set while the reservation is a hold waiting to be confirmed, see hold()
+    hold_token = models.CharField(max_length=32, blank=True, null=True)
+    expires_at = models.DateTimeField('hold expiry date', blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['parkingspot', 'start_ts', 'end_ts'], name='reservation_spot_window_idx'),
+            models.Index(fields=['user_id', 'start_ts'], name='reservation_user_start_idx'),
+            models.Index(fields=['end_ts'], name='reservation_end_idx'),
+            models.Index(fields=['expires_at'], name='reservation_expires_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        if self.end_ts <= self.start_ts:
+        self.validate_window(self.start_ts, self.end_ts)
+        if self.pk is not None:
+            if self.conflicts(self.parkingspot, self.start_ts, self.end_ts):
+                metrics.RESERVATION_CONFLICTS.inc('single')
+                raise ValidationError("Reservation not available.")
+            super().save(*args, **kwargs)
+            return
+
+        # bookings of the same spot wait for each other within the process, and the
+        # conditional insert of _do_insert keeps the check and the write atomic across processes
+        with locks.spot_lock(self.parkingspot_id):
+            if availability.is_enabled() and self.conflicts(self.parkingspot, self.start_ts, self.end_ts):
+                metrics.RESERVATION_CONFLICTS.inc('single')
+                raise ValidationError("Reservation not available.")
+            super().save(*args, **kwargs)
+
+    def _do_insert(self, manager, using, fields, returning_fields, raw):
+        """
+        The INSERT of save(), which only adds the reservation if its window is free.
+        Everything else is Django's save: using, force_insert, update_fields and the signals.
+        """
+        if raw:
+            # fixtures are loaded as they are
+            return super()._do_insert(manager, using, fields, returning_fields, raw)
+        if not self.insert_if_available(fields, using):
+            metrics.RESERVATION_CONFLICTS.inc('single')
+            raise ValidationError("Reservation not available.")
+        return [tuple(getattr(self, field.attname) for field in returning_fields)]
+
+    def insert_if_available(self, fields, using, attempts=5):
+        """
+        INSERT ... SELECT ... WHERE NOT EXISTS (overlapping reservation).
+
+        SQLite runs a write statement under the database's single write lock, so no other
+        connection can book the window between the check and the insert. Concurrent
+        writers wait on the busy timeout and the statement is retried if it expires.
+
+        :param fields: the fields to insert
+        :return: False if an overlapping reservation exists
+        """
+        connection = connections[using]
+        opts = self._meta
+        column = {field.name: field for field in opts.concrete_fields}
+
+        def prep(name, value):
+            return column[name].get_db_prep_value(value, connection)
+
+        table = connection.ops.quote_name(opts.db_table)
+        sql = 'INSERT INTO %s (%s) SELECT %s WHERE NOT EXISTS (' \
+              'SELECT 1 FROM %s WHERE parkingspot_id = %%s AND start_ts <= %%s AND end_ts >= %%s ' \
+              'AND (expires_at IS NULL OR expires_at > %%s))' % (
+                  table, ', '.join(connection.ops.quote_name(field.column) for field in fields),
+                  ', '.join(['%s'] * len(fields)), table)
+        params = [field.get_db_prep_save(field.pre_save(self, True), connection) for field in fields]
+        params += [self.parkingspot_id, prep('end_ts', self.end_ts), prep('start_ts', self.start_ts),
+                   prep('expires_at', timezone.now())]
+
+        def insert():
+            with transaction.atomic(using=using), connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                if cursor.rowcount != 1:
+                    return False
+                if self.pk is None:
+                    self.pk = connection.ops.last_insert_id(cursor, opts.db_table, opts.pk.column)
+                return True
+
+        return locks.retry_locked(insert, attempts)
+
+    @staticmethod
+    def validate_window(start, end):
+        if end <= start:
             raise ValidationError("End timestamp can't before start timestamp.")
-        elif self.start_ts < django.utils.timezone.now():
+        elif start < django.utils.timezone.now():
             raise ValidationError("Start timestamp can't be in the past.")
-        elif self.overlapping_reservations_exist(self.parkingspot, self.start_ts, self.end_ts) is not None:
-            raise ValidationError("Reservation not available.")
+
+    @staticmethod
+    def hold(user_id, parkingspot, start, end, ttl_seconds=None):
+        """
+        Hold the parking spot for the window while the user completes the booking.
+
+        A hold is a reservation with a token and an expiry date, booked like any other,
+        so searches and bookings treat the window as taken until the hold expires.
+        parking.holds deletes it then, unless confirm() turned it into a reservation.
+
+        :param ttl_seconds: defaults to the PARKING_HOLD_SECONDS setting
+        :return: the held ParkingSpotReservation
+        """
+        if ttl_seconds is None:
+            ttl_seconds = getattr(settings, 'PARKING_HOLD_SECONDS', 120)
+        reservation = ParkingSpotReservation(user_id=user_id, parkingspot=parkingspot, start_ts=start, end_ts=end,
+                                             hold_token=secrets.token_hex(16),
+                                             expires_at=timezone.now() + timedelta(seconds=ttl_seconds))
+        reservation.save()
+        holds.get_expiry().schedule(reservation.id, reservation.expires_at, reservation._state.db)
+        metrics.HOLDS.inc('held')
+        return reservation
+
+    @staticmethod
+    def confirm(reservation_id, hold_token):
+        """
+        Turn a hold into a reservation. The hold already keeps other bookings out of the
+        window, so no overlap check runs: the update only clears the token and expiry of
+        a hold which did not expire.
+
+        :return: the confirmed ParkingSpotReservation
+        """
+        # reservation ids fall in the id range of their spot's shard
+        using = sharding.database_for_spot(reservation_id) or router.db_for_write(ParkingSpotReservation)
+        held = ParkingSpotReservation.objects.using(using).filter(id=reservation_id, hold_token=hold_token,
+                                                                  expires_at__gt=timezone.now())
+        if not held.update(hold_token=None, expires_at=None):
+            raise ValidationError("Hold expired or not found.")
+        reservation = ParkingSpotReservation.objects.using(using).get(pk=reservation_id)
+        signals.post_save.send(sender=ParkingSpotReservation, instance=reservation, created=False,
+                               update_fields={'hold_token', 'expires_at'}, raw=False, using=using)
+        metrics.HOLDS.inc('confirmed')
+        return reservation
+
+    @staticmethod
+    def release_expired(reservation_ids=None, using=None, now=None, chunk_size=500):
+        """
+        Delete the holds which expired, through the expiry index.
+
+        :param reservation_ids: only release these holds, any expired hold if None
+        :return: number of holds released
+        """
+        using = using or router.db_for_write(ParkingSpotReservation)
+        expired = ParkingSpotReservation.objects.using(using).filter(expires_at__lte=now or timezone.now())
+        if reservation_ids is None:
+            released, _ = expired.delete()
         else:
-            super().save(*args, **kwargs)
+            released = 0
+            for position in range(0, len(reservation_ids), chunk_size):
+                count, _ = expired.filter(id__in=reservation_ids[position:position + chunk_size]).delete()
+                released += count
+        if released:
+            metrics.HOLDS.inc('expired', amount=released)
+        return released
+
+    @staticmethod
+    def bulk_reserve(items, atomic=True):
+        """
+        Reserve many parking spots at once.
+
+        Conflicts with existing reservations are fetched with a single query and checked,
+        together with the conflicts between the items themselves, by an AvailabilityEngine.
+        Items are accepted first come first served and inserted with one bulk_create.
+
+        :param items: list of (user_id, parkingspot_id, start_ts, end_ts)
+        :param atomic: insert nothing if any item fails
+        :return: the saved ParkingSpotReservation or the ValidationError of every item, in order.
+        When an atomic batch is rejected the items without an error are None.
+        """
+        results = [None] * len(items)
+        # the checks read the primary, a replica may not have the latest bookings yet,
+        # and the shard of each spot when they are sharded
+        groups = {}
+        for position, (_, parkingspot_id, _, _) in enumerate(items):
+            using = sharding.database_for_spot(parkingspot_id) or router.db_for_write(ParkingSpotReservation)
+            groups.setdefault(using, []).append(position)
+        spots = {}
+        for using, positions in groups.items():
+            spots.update(ParkingSpot.objects.using(using).in_bulk({items[position][1] for position in positions}))
+
+        windows = set()
+        for position, (user_id, parkingspot_id, start, end) in enumerate(items):
+            try:
+                ParkingSpotReservation.validate_window(start, end)
+                if parkingspot_id not in spots:
+                    raise ValidationError("Parking spot not available.")
+                windows.add(position)
+            except ValidationError as validationerr:
+                results[position] = validationerr
+
+        # SQLite transactions are serialisable: once this one read the existing reservations,
+        # a concurrent writer's booking makes its first write fail with "database is locked"
+        # and the whole check is retried. The locks order the threads of this process.
+        # A batch spanning shards is checked under all their transactions, but they commit
+        # one after the other.
+        def reserve():
+            with ExitStack() as stack:
+                stack.enter_context(locks.spot_locks(spots))
+                for using in groups:
+                    stack.enter_context(transaction.atomic(using=using))
+
+                for using, positions in groups.items():
+                    positions = [position for position in positions if position in windows]
+                    if not positions:
+                        continue
+                    batch_start = min(items[position][2] for position in positions)
+                    batch_end = max(items[position][3] for position in positions)
+                    engine = availability.AvailabilityEngine(batch_start)
+                    existing = ParkingSpotReservation.objects.using(using).filter(
+                        ParkingSpotReservation.overlap_filter(batch_start, batch_end),
+                        parkingspot_id__in={items[position][1] for position in positions},
+                    ).values_list('id', 'parkingspot_id', 'start_ts', 'end_ts')
+                    for reservation in existing:
+                        engine.add(*reservation)
+
+                    for position in positions:
+                        user_id, parkingspot_id, start, end = items[position]
+                        if engine.is_free(parkingspot_id, start, end):
+                            engine.add(('item', position), parkingspot_id, start, end)
+                            results[position] = ParkingSpotReservation(user_id=user_id,
+                                                                       parkingspot=spots[parkingspot_id],
+                                                                       start_ts=start, end_ts=end)
+                        else:
+                            results[position] = ValidationError("Reservation not available.")
+
+                if atomic and any(isinstance(result, ValidationError) for result in results):
+                    return []
+
+                created = []
+                for using, positions in groups.items():
+                    group = [results[position] for position in positions
+                             if isinstance(results[position], ParkingSpotReservation)]
+                    ParkingSpotReservation.objects.using(using).bulk_create(group)
+                    if any(reservation.pk is None for reservation in group):
+                        # backends without RETURNING leave the primary keys unset, the windows are unique per spot
+                        saved = ParkingSpotReservation.objects.using(using).filter(
+                            parkingspot_id__in={reservation.parkingspot_id for reservation in group},
+                            start_ts__in={reservation.start_ts for reservation in group},
+                        ).values_list('parkingspot_id', 'start_ts', 'end_ts', 'id')
+                        ids = {(spot_id, start, end): reservation_id for spot_id, start, end, reservation_id in saved}
+                        for reservation in group:
+                            reservation.pk = ids.get((reservation.parkingspot_id, reservation.start_ts,
+                                                      reservation.end_ts))
+                    created.extend(group)
+                return created
+
+        created = locks.retry_locked(reserve)
+        rejected = [position for position in windows if isinstance(results[position], ValidationError)]
+        if rejected:
+            metrics.RESERVATION_CONFLICTS.inc('bulk', amount=len(rejected))
+        if atomic and any(isinstance(result, ValidationError) for result in results):
+            return [result if isinstance(result, ValidationError) else None for result in results]
+
+        # bulk_create skips the post_save signal
+        for reservation in created:
+            signals.post_save.send(sender=ParkingSpotReservation, instance=reservation, created=True,
+                                   update_fields=None, raw=False, using=reservation._state.db)
+        return results
+
+    @staticmethod
+    def conflicts(parkingspot, start, end):
+        """
+        Is the parking spot already reserved for part of the window?
+        Answered by the availability engine when it is enabled and tracks the window.
+        """
+        if availability.is_enabled():
+            engine = availability.get_engine()
+            if engine.covers(start):
+                return not engine.is_free(parkingspot.id, start, end)
+        return ParkingSpotReservation.overlapping_reservations_exist(parkingspot, start, end) is not None
+
+    @staticmethod
+    def exclude_reserved(queryset, start_ts, end_ts):
+        """
+        Narrow a ParkingSpot queryset to the spots without a reservation overlapping the window.
+        The slot bitmaps, for windows aligned to slots, or the availability engine filter the
+        whole candidate set in one batch call when they are enabled and the candidate set fits
+        an IN clause.
+        """
+        checker = None
+        if slots.is_enabled():
+            checker = slots.get_bitmaps()
+            if not checker.covers(start_ts, end_ts):
+                checker = None
+        if checker is None and availability.is_enabled():
+            checker = availability.get_engine()
+            if not checker.covers(start_ts):
+                checker = None
+        if checker is not None:
+            limit = getattr(settings, 'PARKING_AVAILABILITY_MAX_CANDIDATES', 900)
+            spot_ids = list(queryset.values_list('id', flat=True)[:limit + 1])
+            if len(spot_ids) <= limit:
+                return queryset.filter(id__in=checker.free_spots(spot_ids, start_ts, end_ts))
+
+        # anti-join: one probe of the (parkingspot, start_ts, end_ts) index per candidate spot
+        reserved = ParkingSpotReservation.objects.filter(
+            ParkingSpotReservation.overlap_filter(start_ts, end_ts),
+            parkingspot=OuterRef('pk'),
+        )
+        return queryset.annotate(reserved=Exists(reserved)).filter(reserved=False)
+
+    @staticmethod
+    def overlap_filter(start, end):
+        """
+        Reservations sharing at least one instant with the window, ends included, and
+        holds which did not expire.
+        """
+        return Q(start_ts__lte=end) & Q(end_ts__gte=start) & ParkingSpotReservation.taken_filter()
+
+    @staticmethod
+    def taken_filter(now=None):
+        """
+        Reservations and unexpired holds. An expired hold frees its window right away,
+        even before it is deleted.
+        """
+        return Q(expires_at__isnull=True) | Q(expires_at__gt=now or timezone.now())
 
     @staticmethod
     def overlapping_reservations_exist(parkingspot, start, end):
@@ -124,21 +628,146 @@ class ParkingSpotReservation(models.Model):
         :param end:
         :return:
         """
-        # TODO fix race conditions - stored procedure? Perform a shopping cart like transaction?
-        # TODO cache query set results
-        try:
-            result = ParkingSpotReservation.objects.filter(
+        # a check on its own races with concurrent bookings, save() books with a conditional insert
+        # and hold() / confirm() keep the window while the user completes the booking
+        # 1 | 2 | 3 | 4 all start before the window ends and end after the window starts
+        # read from the primary, a replica may not have the latest bookings yet
+        using = router.db_for_write(ParkingSpotReservation, instance=parkingspot)
+        return ParkingSpotReservation.objects.using(using).filter(
+            Q(parkingspot__exact=parkingspot),
+            ParkingSpotReservation.overlap_filter(start, end)
+        ).first()
+
+    @staticmethod
+    def history(user_id, limit=50, before_ts=None, before_id=None):
+        """
+        The user's reservations, newest first, read from the active table and the archive.
+        Holds are left out until they are confirmed.
+
+        :param before_ts: only the reservations starting before it
+        :param before_id: with before_ts, also the reservations starting at before_ts with a smaller id,
+        the keyset of the last reservation of the previous page
+        :return: list of dicts with the reservation fields and `archived`
+        """
+        if sharding.needs_scatter():
+            return sharding.history(user_id, limit, before_ts, before_id)
+        fields = ('id', 'parkingspot_id', 'start_ts', 'end_ts', 'create_date')
+        rows = []
+        for model, archived in ((ParkingSpotReservation, False), (ArchivedReservation, True)):
+            queryset = model.objects.filter(user_id=user_id)
+            if model is ParkingSpotReservation:
+                queryset = queryset.filter(ParkingSpotReservation.taken_filter(), hold_token__isnull=True)
+            if before_ts is not None and before_id is not None:
+                queryset = queryset.filter(Q(start_ts__lt=before_ts) | Q(start_ts=before_ts, id__lt=before_id))
+            elif before_ts is not None:
+                queryset = queryset.filter(start_ts__lt=before_ts)
+            rows.append([{'id': row['id'], 'user_id': user_id, 'parkingspot': row['parkingspot_id'],
+                          'start_ts': row['start_ts'], 'end_ts': row['end_ts'],
+                          'create_date': row['create_date'], 'archived': archived}
+                         for row in queryset.order_by('-start_ts', '-id').values(*fields)[:limit]])
+        merged = heapq.merge(*rows, key=lambda row: (row['start_ts'], row['id']), reverse=True)
+        return list(merged)[:limit]
+
+
+class ArchivedReservation(models.Model):
+    """
+    Reservations which ended, moved out of ParkingSpotReservation by the
+    archive_reservations command so the availability queries only read bookings
+    that can still conflict. Keeps the id of the reservation.
+    """
+    id = models.IntegerField(primary_key=True)
+    user_id = models.IntegerField()
+    parkingspot = models.ForeignKey(ParkingSpot, on_delete=models.SET_NULL, blank=True, null=True, db_index=False)
+    start_ts = models.DateTimeField('reservation start date')
+    end_ts = models.DateTimeField('reservation end date')
+    create_date = models.DateTimeField('creation date')
+    archive_date = models.DateTimeField('archival date', auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', 'start_ts'], name='archive_user_start_idx'),
+            models.Index(fields=['parkingspot', 'start_ts'], name='archive_spot_start_idx'),
+        ]
+
+    @staticmethod
+    def archive(before, batch_size=5000, using=None):
+        """
+        Move one batch of the reservations which ended before the given time to the archive.
+
+        Ended reservations can't conflict with a booking, which can't start in the past,
+        so they are removed by a plain DELETE, without the delete signals keeping the
+        availability engine and cache up to date.
+
+        :param using: the shard to archive, defaults to the primary
+        :return: number of reservations moved
+        """
+        using = using or router.db_for_write(ParkingSpotReservation)
+        with transaction.atomic(using=using):
+            ended = ParkingSpotReservation.objects.using(using).filter(end_ts__lt=before, hold_token__isnull=True) \
+                .order_by('end_ts')
+            rows = list(ended.values_list('id', 'user_id', 'parkingspot_id', 'start_ts', 'end_ts',
+                                          'create_date')[:batch_size])
+            if not rows:
+                return 0
+            ArchivedReservation.objects.using(using).bulk_create([
+                ArchivedReservation(id=reservation_id, user_id=user_id, parkingspot_id=parkingspot_id,
+                                    start_ts=start_ts, end_ts=end_ts, create_date=create_date)
+                for reservation_id, user_id, parkingspot_id, start_ts, end_ts, create_date in rows
+            ])
+            connection = connections[using]
+            table = connection.ops.quote_name(ParkingSpotReservation._meta.db_table)
+            with connection.cursor() as cursor:
+                for position in range(0, len(rows), 500):
+                    ids = [row[0] for row in rows[position:position + 500]]
+                    cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (table, ', '.join(['%s'] * len(ids))), ids)
+        return len(rows)
+
+
+class ChangeLog(models.Model):
+    """
+    Ids of the rows written to a table, appended by SQLite triggers whatever process or
+    tool wrote them. The in-process structures of every worker follow it, see parking.journal.
+    """
+    change_date = models.DateTimeField('change date', default=timezone.now)
+
+    # the field holding the id of the written row
+    changed_field = None
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def prune(cls, before, using=None):
+        """
+        Delete the changes older than the given time, always keeping the newest one so a
+        follower which missed the pruned changes notices the gap.
+
+        :return: number of changes deleted
+        """
+        changes = cls.objects.using(using or router.db_for_write(cls))
+        newest = changes.order_by('-id').values_list('id', flat=True).first()
+        if newest is None:
+            return 0
+        deleted, _ = changes.filter(change_date__lt=before, id__lt=newest).delete()
+        return deleted
+
+
+class ReservationChange(ChangeLog):
+    """
+    Written reservations, logged on every insert, update and delete of ParkingSpotReservation
+    and followed by the availability engine and the slot bitmaps. Deletes of reservations
+    which already ended don't change any availability and are not logged.
+    """
+    reservation_id = models.IntegerField()
+
+    changed_field = 'reservation_id'
 
-                Q(parkingspot__exact=parkingspot),
 
-                # does the reservation overlap with any existing reservations?
-                # 1 | 2 would catch 4
-                # The following is 1 | 2 | 3
-                (Q(start_ts__lte=end) & Q(end_ts__gte=end)) \
-                | (Q(start_ts__lte=start) & Q(end_ts__gte=start)) \
-                | (Q(start_ts__gte=start) & Q(end_ts__lte=end))
-            )[0:1].get()
-        except:
-            result = None
+class SpotChange(ChangeLog):
+    """
+    Written parking spots, logged on every insert, update and delete of ParkingSpot, bulk
+    imports included, and followed by the spatial index.
+    """
+    spot_id = models.IntegerField()
 
-        return result
+    changed_field = 'spot_id'
@@ -0,0 +1,98 @@
+"""
+Opt-in cProfile of single requests.
+
+A request is profiled when it is picked by PARKING_PROFILE_SAMPLE_RATE or carries a
+valid X-Parking-Profile token, see make_token. Every profile is written to
+PARKING_PROFILE_DIR as a pstats dump next to a JSON file describing the request, and
+`manage.py profile_report` aggregates the dumps into the hottest functions.
+"""
+import json
+import logging
+import os
+import random
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'HTTP_X_PARKING_PROFILE'
+
+TOKEN_SALT = 'parking.profiling'
+
+
+def make_token():
+    """
+    A value for the X-Parking-Profile header, valid for PARKING_PROFILE_TOKEN_MAX_AGE seconds.
+    """
+    return signing.TimestampSigner(salt=TOKEN_SALT).sign('profile')
+
+
+def valid_token(token):
+    try:
+        signing.TimestampSigner(salt=TOKEN_SALT).unsign(
+            token, max_age=getattr(settings, 'PARKING_PROFILE_TOKEN_MAX_AGE', 3600))
+    except signing.BadSignature:
+        logger.debug('Ignoring invalid profiling token')
+        return False
+    return True
+
+
+def should_profile(request):
+    token = request.META.get(HEADER)
+    if token:
+        return valid_token(token)
+    rate = getattr(settings, 'PARKING_PROFILE_SAMPLE_RATE', 0)
+    return rate > 0 and random.random() < rate
+
+
+def profile_dir():
+    return getattr(settings, 'PARKING_PROFILE_DIR', None) or os.path.join(settings.BASE_DIR, 'profiles')
+
+
+def dump(profiler, request, endpoint, status, duration):
+    """
+    Write the profile and its request description.
+
+    :return: path of the pstats dump
+    """
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    # the random part keeps the dumps of concurrent requests, threads and workers apart
+    base = os.path.join(directory, '%s-%s-%s-%s' % (time.strftime('%Y%m%d%H%M%S'), re.sub(r'[^\w.-]', '_', endpoint),
+                                                    os.getpid(), uuid.uuid4().hex[:12]))
+
+    profiler.dump_stats(base + '.prof')
+    with open(base + '.json', 'w') as description:
+        json.dump({
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'params': request.GET.dict(),
+            'status': status,
+            'duration': duration,
+        }, description)
+    return base + '.prof'
+
+
+def dumps(directory, endpoint=None):
+    """
+    The pstats dumps of the directory, optionally only those of one endpoint.
+    """
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.prof'):
+            continue
+        path = os.path.join(directory, name)
+        if endpoint is not None:
+            try:
+                with open(path[:-len('.prof')] + '.json') as description:
+                    if json.load(description).get('endpoint') != endpoint:
+                        continue
+            except (OSError, ValueError):
+                continue
+        paths.append(path)
+    return paths
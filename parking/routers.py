@@ -0,0 +1,98 @@
+"""
+Database router sending reads to the read replicas and writes to the primary.
+
+PARKING_READ_REPLICAS names the replica database aliases; without replicas every query
+goes to the primary. Reads are pinned to the primary for the rest of a request after it
+wrote a reservation or spot, and ReadYourWritesMiddleware extends the pin to the same
+client's requests for PARKING_READ_YOUR_WRITES_SECONDS. Checks which guard writes, like
+the overlap check of a booking, read from the primary themselves.
+
+use_database pins every query of a block to one database, parking.sharding uses it to
+run a search on each shard.
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PRIMARY = DEFAULT_DB_ALIAS
+
+
+class RoutingState():
+    """
+    Routing of one request.
+    """
+
+    def __init__(self, pinned=False, database=None):
+        self.pinned = pinned
+        self.wrote = False
+        # every query goes to this alias when set
+        self.database = database
+
+
+_current = contextvars.ContextVar('parking_routing_state', default=None)
+
+
+def current_state():
+    return _current.get()
+
+
+def set_state(state):
+    _current.set(state)
+
+
+def current_database():
+    state = current_state()
+    return state.database if state is not None else None
+
+
+@contextmanager
+def use_database(alias):
+    """
+    Send the queries of the block to the alias, whatever the routers would pick.
+    """
+    previous = current_state()
+    set_state(RoutingState(pinned=previous is not None and previous.pinned, database=alias))
+    try:
+        yield
+    finally:
+        set_state(previous)
+
+
+def record_write():
+    state = current_state()
+    if state is not None:
+        state.wrote = True
+
+
+def replicas():
+    return getattr(settings, 'PARKING_READ_REPLICAS', [])
+
+
+class ReadReplicaRouter():
+    def db_for_read(self, model, **hints):
+        database = current_database()
+        if database is not None:
+            return database
+        aliases = replicas()
+        if not aliases:
+            return None
+        state = current_state()
+        if state is not None and (state.pinned or state.wrote):
+            return PRIMARY
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        return current_database() or PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY} | set(replicas())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are copies of the primary
+        return db not in replicas()
@@ -0,0 +1,339 @@
+"""
+Geo sharding of the parking spots and their reservations.
+
+PARKING_SHARDS lists the shard database aliases with the geohash prefixes each one
+owns, spots outside every prefix go to the first shard. Every shard hands out spot
+and reservation ids from its own range of SHARD_ID_SPAN ids (`manage.py init_shards`
+seeds the sequences), so the id of a spot tells its shard without a lookup.
+ShardRouter sends a spot to its shard and a reservation to the shard of its spot.
+
+A search runs on the shards its circle overlaps, in parallel in a pool of
+PARKING_SHARD_THREADS threads, and the pages of the shards are merged by id.
+"""
+import contextvars
+import heapq
+import itertools
+import math
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+
+from parking import metrics, routers, spatial_index
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+SHARD_ID_SPAN = 10 ** 12
+
+# circles covering more geohash cells are sent to every shard
+MAX_CIRCLE_CELLS = 4096
+
+SHARDED_MODELS = ('parkingspot', 'parkingspotreservation', 'archivedreservation')
+
+
+def encode(lat, lng, precision):
+    """
+    Geohash of the point.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, value, bits, even = [], 0, 0, True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        if coordinate >= middle:
+            value = value * 2 + 1
+            interval[0] = middle
+        else:
+            value *= 2
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            value, bits = 0, 0
+    return ''.join(chars)
+
+
+def cell_degrees(precision):
+    """
+    :return: (lat, lng) size of the geohash cells of the precision
+    """
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def shards():
+    return getattr(settings, 'PARKING_SHARDS', [])
+
+
+def is_enabled():
+    return bool(shards())
+
+
+def needs_scatter():
+    """
+    Is sharding enabled and the caller not already running on one shard?
+    """
+    return is_enabled() and routers.current_database() is None
+
+
+def aliases():
+    return [alias for alias, _ in shards()]
+
+
+def _prefixes():
+    return {prefix: alias for alias, prefixes in shards() for prefix in prefixes}
+
+
+def _alias_for_geohash(geohash, prefixes):
+    for length in range(len(geohash), 0, -1):
+        alias = prefixes.get(geohash[:length])
+        if alias is not None:
+            return alias
+    return shards()[0][0]
+
+
+def alias_for_point(lat, lng):
+    prefixes = _prefixes()
+    precision = max([len(prefix) for prefix in prefixes] or [1])
+    return _alias_for_geohash(encode(lat, lng, precision), prefixes)
+
+
+def aliases_for_circle(lat, lng, radius_meters):
+    """
+    The shards owning a geohash cell the circle's bounding box touches, in PARKING_SHARDS order.
+    """
+    prefixes = _prefixes()
+    precision = max([len(prefix) for prefix in prefixes] or [1])
+    lat_step, lng_step = cell_degrees(precision)
+    min_lat, max_lat, min_lng, max_lng = spatial_index.bounding_box(lat, lng, radius_meters)
+    rows = range(max(0, int(math.floor((min_lat + 90) / lat_step))),
+                 min(int(180 / lat_step) - 1, int(math.floor((max_lat + 90) / lat_step))) + 1)
+    columns = range(int(math.floor((min_lng + 180) / lng_step)), int(math.floor((max_lng + 180) / lng_step)) + 1)
+    if len(rows) * len(columns) > MAX_CIRCLE_CELLS:
+        return aliases()
+
+    found = set()
+    for row in rows:
+        for column in columns:
+            # the center of the cell, longitudes wrapped around the antimeridian
+            cell_lng = ((column + 0.5) * lng_step) % 360 - 180
+            found.add(_alias_for_geohash(encode(-90 + (row + 0.5) * lat_step, cell_lng, precision), prefixes))
+    return [alias for alias in aliases() if alias in found]
+
+
+def id_base(alias):
+    """
+    The ids of the shard's spots and reservations are greater than this.
+    """
+    return aliases().index(alias) * SHARD_ID_SPAN
+
+
+def database_for_spot(spot_id):
+    """
+    The shard of the spot id, None without sharding. Ids outside every range, which
+    can't exist, map to the first shard.
+    """
+    if not is_enabled():
+        return None
+    names = aliases()
+    try:
+        position = (int(spot_id) - 1) // SHARD_ID_SPAN
+    except (TypeError, ValueError):
+        return names[0]
+    return names[position] if 0 <= position < len(names) else names[0]
+
+
+def alias_for_instance(instance):
+    """
+    The shard of a spot or of a reservation's spot.
+    """
+    if hasattr(instance, 'parkingspot_id'):
+        return database_for_spot(instance.parkingspot_id) if instance.parkingspot_id is not None else None
+    if instance.pk is not None:
+        return database_for_spot(instance.pk)
+    if instance.location is not None:
+        return alias_for_point(instance.location.y, instance.location.x)
+    return None
+
+
+def group_spots(spots):
+    """
+    Split new spots by shard.
+
+    :return: dict of shard alias, None without sharding, to its spots
+    """
+    if not is_enabled():
+        return {None: list(spots)}
+    groups = {}
+    for spot in spots:
+        groups.setdefault(alias_for_instance(spot), []).append(spot)
+    return groups
+
+
+def seed_id_range(alias):
+    """
+    Start the SQLite AUTOINCREMENT sequences of the shard's spots and reservations at its id range.
+    """
+    from parking.models import ParkingSpot, ParkingSpotReservation
+
+    connection = connections[alias]
+    base = id_base(alias)
+    with transaction.atomic(using=alias), connection.cursor() as cursor:
+        for model in (ParkingSpot, ParkingSpotReservation):
+            table = model._meta.db_table
+            cursor.execute('UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s', [base, table])
+            if cursor.rowcount == 0:
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, base])
+
+
+class ShardRouter():
+    """
+    Routes a spot, or a reservation, given as the instance hint to its shard. Queries
+    without an instance are left to the next router, the sharded queries set their
+    shard with routers.use_database.
+    """
+
+    def _route(self, model, hints):
+        database = routers.current_database()
+        if database is not None:
+            return database
+        if not is_enabled() or model._meta.app_label != 'parking' or model._meta.model_name not in SHARDED_MODELS:
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._state.db in aliases():
+            return instance._state.db
+        return alias_for_instance(instance)
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        names = aliases()
+        if obj1._state.db in names and obj2._state.db in names:
+            return obj1._state.db == obj2._state.db
+        return None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'PARKING_SHARD_THREADS', 8),
+                                               thread_name_prefix='parking-shard')
+    return _executor
+
+
+def scatter(func, databases):
+    """
+    Run func once per database, with every query sent to that database, in parallel.
+    Their queries count towards the request's metrics.
+
+    :return: the results in the order of databases
+    """
+    databases = list(databases)
+    stats = metrics.current_stats()
+    if len(databases) == 1:
+        with routers.use_database(databases[0]):
+            return [func()]
+
+    def call(alias):
+        try:
+            with routers.use_database(alias), metrics.track_queries(stats):
+                return func()
+        finally:
+            close_old_connections()
+
+    # the pool threads see the caller's context, e.g. its routing
+    futures = [get_executor().submit(contextvars.copy_context().run, call, alias) for alias in databases]
+    return [future.result() for future in futures]
+
+
+def within_range(lat, lng, radius_meters, offset, pagesize, start_ts=None, end_ts=None, use_index=None,
+                 after_id=None, with_total=True, lean=False, with_distance=False):
+    """
+    ParkingSpot.within_range over the shards the circle overlaps. Every shard returns
+    its first offset + pagesize spots, a keyset cursor keeps that small.
+
+    :return: total and the list of spots of the page
+    """
+    from parking.models import ParkingSpot
+
+    limit = offset + pagesize if pagesize is not None else None
+
+    def search():
+        total, page = ParkingSpot.within_range(lat, lng, radius_meters, 0, limit, start_ts, end_ts, use_index,
+                                               after_id=after_id, with_total=with_total, lean=lean,
+                                               with_distance=with_distance)
+        return total, list(page)
+
+    results = scatter(search, aliases_for_circle(lat, lng, radius_meters))
+    key = operator.itemgetter(0) if lean else operator.attrgetter('id')
+    merged = heapq.merge(*[page for _, page in results], key=key)
+    total = sum(total for total, _ in results) if with_total else None
+    return total, list(itertools.islice(merged, offset, limit))
+
+
+def nearest(lat, lng, k, start_ts=None, end_ts=None, initial_radius_meters=100, max_radius_meters=50000,
+            use_index=None, chunk_size=500):
+    """
+    ParkingSpot.nearest over the shards within the maximum radius.
+    """
+    from parking.models import ParkingSpot
+
+    def search():
+        return ParkingSpot.nearest(lat, lng, k, start_ts, end_ts, initial_radius_meters, max_radius_meters,
+                                   use_index, chunk_size)
+
+    results = scatter(search, aliases_for_circle(lat, lng, max_radius_meters))
+    merged = heapq.merge(*results, key=lambda found: (found[1], found[0].id))
+    return list(itertools.islice(merged, k))
+
+
+def search_group(queries):
+    """
+    batch.search_group over the shards of the group's circles.
+    """
+    from parking import batch
+
+    databases = set()
+    for query in queries:
+        databases.update(aliases_for_circle(query.lat, query.lng, query.radius))
+    shard_results = scatter(lambda: batch.search_group(queries), [alias for alias in aliases() if alias in databases])
+
+    results = []
+    for query, per_shard in zip(queries, zip(*shard_results)):
+        rows = list(itertools.islice(heapq.merge(*[result['result'] for result in per_shard],
+                                                 key=operator.itemgetter('id')), query.page_size))
+        results.append({
+            'hits': {
+                'offset': 0,
+                'page_size': len(rows),
+                'total': sum(result['hits']['total'] for result in per_shard)
+            },
+            'result': rows
+        })
+    return results
+
+
+def history(user_id, limit=50, before_ts=None, before_id=None):
+    """
+    ParkingSpotReservation.history over every shard.
+    """
+    from parking.models import ParkingSpotReservation
+
+    results = scatter(lambda: ParkingSpotReservation.history(user_id, limit, before_ts, before_id), aliases())
+    merged = heapq.merge(*results, key=lambda row: (row['start_ts'], row['id']), reverse=True)
+    return list(itertools.islice(merged, limit))
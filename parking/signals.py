@@ -0,0 +1,59 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from parking import availability, availability_cache, routers, slots, spatial_index
+from parking.models import ParkingSpot, ParkingSpotReservation
+
+
+@receiver(pre_save, sender=ParkingSpot)
+def parkingspot_saving(sender, instance, using=None, **kwargs):
+    # the cache needs the old location to invalidate the searches around it
+    if instance.pk is not None and availability_cache.get_backend() is not None:
+        instance._previous_location = ParkingSpot.objects.using(using).filter(pk=instance.pk) \
+            .values_list('location', flat=True).first()
+
+
+@receiver(post_save, sender=ParkingSpot)
+def parkingspot_saved(sender, instance, using=None, **kwargs):
+    routers.record_write()
+    # a spot rolled back with its transaction must not stay in the index
+    transaction.on_commit(lambda: spatial_index.spot_saved(instance), using=using)
+    previous_location = getattr(instance, '_previous_location', None)
+    # a search repopulating the cache before the commit would store the old spots again
+    transaction.on_commit(lambda: availability_cache.spot_written(instance, previous_location), using=using)
+
+
+@receiver(post_delete, sender=ParkingSpot)
+def parkingspot_deleted(sender, instance, using=None, **kwargs):
+    routers.record_write()
+    # delete() clears the primary key before the transaction commits
+    spot_id = instance.pk
+    transaction.on_commit(lambda: spatial_index.spot_deleted(spot_id), using=using)
+    transaction.on_commit(lambda: availability_cache.spot_written(instance), using=using)
+
+
+def reservation_committed(reservation):
+    availability.reservation_saved(reservation)
+    slots.reservation_saved(reservation)
+    availability_cache.reservation_written(reservation)
+
+
+@receiver(post_save, sender=ParkingSpotReservation)
+def reservation_saved(sender, instance, using=None, **kwargs):
+    routers.record_write()
+    # a booking rolled back must not leave its window taken, nor its change log row to correct it
+    transaction.on_commit(lambda: reservation_committed(instance), using=using)
+
+
+@receiver(post_delete, sender=ParkingSpotReservation)
+def reservation_deleted(sender, instance, using=None, **kwargs):
+    routers.record_write()
+    reservation_id = instance.pk
+
+    def committed():
+        availability.reservation_deleted(reservation_id)
+        slots.reservation_deleted(reservation_id)
+        availability_cache.reservation_written(instance)
+
+    transaction.on_commit(committed, using=using)
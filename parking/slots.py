@@ -0,0 +1,286 @@
+"""
+Slot bitmaps of the upcoming reservations of every parking spot.
+
+Time is cut into SLOT_SECONDS slots. Every slot contributes two bits to a spot's
+bitmap: one for the instant the slot starts at and one for the open interval up to
+the next slot. A reservation sets the bits of every boundary and interval it touches.
+A window aligned to slot boundaries is a contiguous run of bits, and it overlaps a
+reservation exactly when the two bit sets intersect, ends included as in
+ParkingSpotReservation.overlap_filter. This makes the availability check a bitwise
+AND per candidate spot. With NumPy installed, large candidate sets are checked in one
+vectorised AND over a matrix of the bitmaps.
+
+Windows which are not aligned, or reach beyond DAYS from now, are not covered and
+are answered by the exact interval checks. Holds stay out of the bitmaps: they are kept
+per spot with their expiry date, and only the ones which did not expire are checked.
+"""
+import logging
+import math
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import router
+from django.utils import timezone
+
+from parking import journal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+SLOT_SECONDS = 15 * 60
+
+DAYS = 7
+
+# smaller candidate sets are checked with Python ints
+NUMPY_MIN_CANDIDATES = 64
+
+
+def atom(instant):
+    """
+    Position of the instant in the sequence boundary 0, interval 0, boundary 1, ...
+    counted from the epoch.
+    """
+    seconds = instant.timestamp()
+    slot = int(math.floor(seconds / SLOT_SECONDS))
+    return 2 * slot if slot * SLOT_SECONDS == seconds else 2 * slot + 1
+
+
+def is_aligned(instant):
+    return instant.timestamp() % SLOT_SECONDS == 0
+
+
+def slot_start(instant):
+    return datetime.fromtimestamp(math.floor(instant.timestamp() / SLOT_SECONDS) * SLOT_SECONDS, dt_timezone.utc)
+
+
+class SlotBitmaps():
+    def __init__(self, now=None, days=DAYS, use_numpy=None):
+        """
+        :param now: the bitmaps start at the slot containing it
+        :param use_numpy: defaults to whether NumPy is installed
+        """
+        self.slots = days * 24 * 3600 // SLOT_SECONDS
+        self.bits = 2 * self.slots + 1
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        # position in the ReservationChange log of the process wide bitmaps
+        self.journal = None
+        self._words = (self.bits + 63) // 64
+        self._ranges = {}
+        # spot id -> reservation id -> (first atom, last atom, expiry date) of the holds
+        self._holds = {}
+        self._spot_by_reservation = {}
+        self._masks = {}
+        self._rows = {}
+        self._matrix = None
+        # spot id -> row of the matrix, -1 for spots without reservations
+        self._row_of_spot = None
+        self._lock = threading.RLock()
+        self._move_origin(slot_start(now or timezone.now()))
+
+    def __len__(self):
+        return len(self._spot_by_reservation)
+
+    def _move_origin(self, origin):
+        self.origin = origin
+        self.end = origin + timedelta(seconds=self.slots * SLOT_SECONDS)
+        self._origin_atom = atom(origin)
+        for spot_id, ranges in list(self._ranges.items()):
+            for reservation_id, (_, hi) in list(ranges.items()):
+                if hi < self._origin_atom:
+                    del ranges[reservation_id]
+                    del self._spot_by_reservation[reservation_id]
+            if not ranges:
+                del self._ranges[spot_id]
+        for spot_id, holds in list(self._holds.items()):
+            for reservation_id, (_, hi, _) in list(holds.items()):
+                if hi < self._origin_atom:
+                    del holds[reservation_id]
+                    del self._spot_by_reservation[reservation_id]
+            if not holds:
+                del self._holds[spot_id]
+        self._masks = {}
+        self._rows = {}
+        self._matrix = None
+        self._row_of_spot = None
+        for spot_id in self._ranges:
+            self._refresh(spot_id)
+
+    def advance(self, now=None):
+        """
+        Start the bitmaps at the current slot, dropping the reservations which ended before it.
+        """
+        origin = slot_start(now or timezone.now())
+        with self._lock:
+            if origin > self.origin:
+                self._move_origin(origin)
+
+    def _range_mask(self, lo, hi):
+        lo, hi = max(lo, self._origin_atom), min(hi, self._origin_atom + self.bits - 1)
+        if lo > hi:
+            return 0
+        return ((1 << (hi - lo + 1)) - 1) << (lo - self._origin_atom)
+
+    def _refresh(self, spot_id):
+        mask = 0
+        for lo, hi in self._ranges.get(spot_id, {}).values():
+            mask |= self._range_mask(lo, hi)
+        if mask:
+            self._masks[spot_id] = mask
+        else:
+            self._masks.pop(spot_id, None)
+        if self.use_numpy:
+            self._set_row(spot_id, mask)
+
+    def _set_row(self, spot_id, mask):
+        row = self._rows.get(spot_id)
+        if row is None:
+            if not mask:
+                return
+            row = self._rows[spot_id] = len(self._rows)
+            if self._matrix is None or row >= len(self._matrix):
+                grown = numpy.zeros((max(64, 2 * row), self._words), dtype=numpy.uint64)
+                if self._matrix is not None:
+                    grown[:len(self._matrix)] = self._matrix
+                self._matrix = grown
+            if self._row_of_spot is None or spot_id >= len(self._row_of_spot):
+                grown = numpy.full(max(1024, 2 * spot_id + 1), -1, dtype=numpy.int64)
+                if self._row_of_spot is not None:
+                    grown[:len(self._row_of_spot)] = self._row_of_spot
+                self._row_of_spot = grown
+            self._row_of_spot[spot_id] = row
+        self._matrix[row] = self._to_words(mask)
+
+    def _to_words(self, mask):
+        return numpy.frombuffer(mask.to_bytes(self._words * 8, 'little'), dtype='<u8')
+
+    def add(self, reservation_id, spot_id, start, end, expires_at=None):
+        """
+        :param expires_at: expiry date of a hold, None for a reservation
+        """
+        with self._lock:
+            self.remove(reservation_id)
+            if spot_id is None or end < self.origin:
+                return
+            self._spot_by_reservation[reservation_id] = spot_id
+            if expires_at is not None:
+                self._holds.setdefault(spot_id, {})[reservation_id] = (atom(start), atom(end), expires_at)
+                return
+            self._ranges.setdefault(spot_id, {})[reservation_id] = (atom(start), atom(end))
+            self._refresh(spot_id)
+
+    def remove(self, reservation_id):
+        with self._lock:
+            spot_id = self._spot_by_reservation.pop(reservation_id, None)
+            if spot_id is None:
+                return
+            holds = self._holds.get(spot_id)
+            if holds is not None and holds.pop(reservation_id, None) is not None:
+                if not holds:
+                    del self._holds[spot_id]
+                return
+            ranges = self._ranges[spot_id]
+            del ranges[reservation_id]
+            if not ranges:
+                del self._ranges[spot_id]
+            self._refresh(spot_id)
+
+    def covers(self, start, end):
+        """
+        Can the window be answered from the bitmaps?
+        """
+        self.advance()
+        return is_aligned(start) and is_aligned(end) and self.origin <= start <= end <= self.end
+
+    def free_spots(self, spot_ids, start, end):
+        """
+        The subset of spot_ids without a reservation overlapping the window, which must be covered.
+        """
+        with self._lock:
+            if not self.covers(start, end):
+                raise ValueError('Window %s - %s is not covered by the slot bitmaps' % (start, end))
+            lo, hi = atom(start), atom(end)
+            window = self._range_mask(lo, hi)
+            if self.use_numpy and self._matrix is not None and len(spot_ids) >= NUMPY_MIN_CANDIDATES:
+                free = self._free_spots_numpy(spot_ids, window)
+            else:
+                masks = self._masks
+                free = [spot_id for spot_id in spot_ids if not masks.get(spot_id, 0) & window]
+            if not self._holds:
+                return free
+            now, holds = timezone.now(), self._holds
+            return [spot_id for spot_id in free if spot_id not in holds or not any(
+                hold_lo <= hi and hold_hi >= lo and expires_at > now
+                for hold_lo, hold_hi, expires_at in holds[spot_id].values())]
+
+    def _free_spots_numpy(self, spot_ids, window):
+        ids = numpy.asarray(spot_ids, dtype=numpy.int64)
+        rows = numpy.full(len(ids), -1, dtype=numpy.int64)
+        known = (ids >= 0) & (ids < len(self._row_of_spot))
+        rows[known] = self._row_of_spot[ids[known]]
+        taken = numpy.zeros(len(ids), dtype=bool)
+        tracked = rows >= 0
+        taken[tracked] = (self._matrix[rows[tracked]] & self._to_words(window)).any(axis=1)
+        return [spot_id for spot_id, spot_taken in zip(spot_ids, taken.tolist()) if not spot_taken]
+
+
+_bitmaps = None
+_bitmaps_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'PARKING_SLOT_BITMAPS', False)
+
+
+def get_bitmaps():
+    """
+    Process wide bitmaps, loaded from the database on first use and brought up to date
+    with the reservations written by the other processes on every use.
+    """
+    global _bitmaps
+    bitmaps = _bitmaps
+    if bitmaps is not None and journal.catch_up(bitmaps, bitmaps.journal):
+        return bitmaps
+    with _bitmaps_lock:
+        # unless another thread rebuilt it meanwhile
+        if _bitmaps is bitmaps:
+            _bitmaps = build_bitmaps()
+        return _bitmaps
+
+
+def build_bitmaps(now=None):
+    from parking.models import ParkingSpotReservation
+
+    bitmaps = SlotBitmaps(now)
+    # loaded from the primary, the structures guard bookings
+    using = router.db_for_write(ParkingSpotReservation)
+    # taken first, the writes made while loading are caught up with afterwards
+    bitmaps.journal = journal.Journal.at_end(using)
+    reservations = ParkingSpotReservation.objects.using(using) \
+        .filter(ParkingSpotReservation.taken_filter(), end_ts__gte=bitmaps.origin) \
+        .values_list('id', 'parkingspot_id', 'start_ts', 'end_ts', 'expires_at')
+    for reservation in reservations.iterator():
+        bitmaps.add(*reservation)
+    logger.info('Built slot bitmaps with %s reservations', len(bitmaps))
+    return bitmaps
+
+
+def reset_bitmaps():
+    global _bitmaps
+    with _bitmaps_lock:
+        _bitmaps = None
+
+
+def reservation_saved(reservation):
+    if _bitmaps is not None:
+        _bitmaps.add(reservation.id, reservation.parkingspot_id, reservation.start_ts, reservation.end_ts,
+                     reservation.expires_at)
+
+
+def reservation_deleted(reservation_id):
+    if _bitmaps is not None:
+        _bitmaps.remove(reservation_id)
@@ -0,0 +1,263 @@
+"""
+Memory-mapped snapshot of the parking spot coordinates.
+
+`manage.py build_spot_snapshot` writes the id, lat, lng and Web Mercator x/y of every
+spot as packed little endian columns to PARKING_SPOT_SNAPSHOT. The spots are sorted into
+bands of BAND_METERS of projected y, and by x within a band, so a radius search bisects
+the bands its circle overlaps and only computes the haversine distance of the spots in
+its x range. Workers map the file read only and read the columns in place, the page
+cache holds a single copy for all of them.
+
+A new version replaces the file with a rename. A mapped snapshot keeps reading the
+version it opened, SnapshotIndex.refresh switches to the file on disk when it changed.
+The header keeps the position of the SpotChange log the snapshot was built at, the
+spatial index catches up with the spots written since, by any process, when it maps it.
+"""
+import bisect
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from django.conf import settings
+
+from parking.spatial_index import OverlayIndex, bounding_box, haversine_meters
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PSNP'
+FORMAT_VERSION = 3
+# magic, format version, snapshot version, spots, bands, band height, last SpotChange id
+HEADER = struct.Struct('<4sIQQQdq')
+HEADER_SIZE = 64
+
+BAND_METERS = 1000.0
+
+MERCATOR_RADIUS = 6378137.0
+MAX_MERCATOR_LAT = 85.05112878
+
+
+def project(lat, lng):
+    """
+    Web Mercator x/y in meters, latitudes clamped to the Mercator range.
+    """
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    return (MERCATOR_RADIUS * math.radians(lng),
+            MERCATOR_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)))
+
+
+def path():
+    return getattr(settings, 'PARKING_SPOT_SNAPSHOT', None)
+
+
+def read_version(snapshot_path):
+    """
+    Version of the snapshot file, 0 if there is none.
+    """
+    try:
+        with open(snapshot_path, 'rb') as source:
+            magic, _, version, _, _, _, _ = HEADER.unpack(source.read(HEADER.size))
+    except (OSError, struct.error):
+        return 0
+    return version if magic == MAGIC else 0
+
+
+def layout(spots):
+    """
+    The columns of a snapshot of the spots.
+
+    :param spots: iterable of (id, lat, lng)
+    :return: arrays of the ids, lats, lngs, xs, ys, bands and band starts
+    """
+    rows = []
+    for spot_id, lat, lng in spots:
+        x, y = project(lat, lng)
+        rows.append((int(math.floor(y / BAND_METERS)), x, spot_id, lat, lng, y))
+    rows.sort()
+
+    bands, starts = array('q'), array('q')
+    for position, row in enumerate(rows):
+        if not bands or bands[-1] != row[0]:
+            bands.append(row[0])
+            starts.append(position)
+    starts.append(len(rows))
+
+    return [array('q', [row[2] for row in rows]), array('d', [row[3] for row in rows]),
+            array('d', [row[4] for row in rows]), array('d', [row[1] for row in rows]),
+            array('d', [row[5] for row in rows]), bands, starts]
+
+
+def write(snapshot_path, spots, version=None, change_id=0):
+    """
+    Write a snapshot next to the file and rename it over the file.
+
+    :param spots: iterable of (id, lat, lng)
+    :param version: defaults to the version of the current file plus one
+    :param change_id: the last SpotChange before the spots were read
+    :return: the version written
+    """
+    columns = layout(spots)
+    bands = columns[5]
+    if sys.byteorder != 'little':
+        for column in columns:
+            column.byteswap()
+
+    if version is None:
+        version = read_version(snapshot_path) + 1
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, version, len(columns[0]), len(bands), BAND_METERS, change_id)
+    descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(snapshot_path)),
+                                             prefix='.spot-snapshot-')
+    try:
+        with os.fdopen(descriptor, 'wb') as target:
+            target.write(header.ljust(HEADER_SIZE, b'\0'))
+            for column in columns:
+                column.tofile(target)
+            target.flush()
+            os.fsync(target.fileno())
+        # readers see either the old or the new file, never a partial one
+        os.replace(temporary, snapshot_path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return version
+
+
+class SpotSnapshot():
+    """
+    A snapshot file mapped read only, its columns are memoryviews over the mapping.
+    """
+
+    def __init__(self, snapshot_path):
+        with open(snapshot_path, 'rb') as source:
+            self.stat = os.fstat(source.fileno())
+            self._mmap = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, self.version, self.count, band_count, self.band_meters, self.change_id = \
+            HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError('%s is not a spot snapshot of format %s' % (snapshot_path, FORMAT_VERSION))
+        if sys.byteorder != 'little':
+            raise ValueError('Spot snapshots are little endian')
+        if len(self._mmap) != HEADER_SIZE + 8 * (5 * self.count + 2 * band_count + 1):
+            raise ValueError('%s is truncated' % snapshot_path)
+
+        view = memoryview(self._mmap)
+        size = 8 * self.count
+        self.ids, self.lats, self.lngs, self.xs, self.ys = [
+            view[HEADER_SIZE + position * size:HEADER_SIZE + (position + 1) * size].cast(code)
+            for position, code in enumerate('qdddd')]
+        bands_offset = HEADER_SIZE + 5 * size
+        self.bands = view[bands_offset:bands_offset + 8 * band_count].cast('q')
+        self.starts = view[bands_offset + 8 * band_count:].cast('q')
+
+    def __len__(self):
+        return self.count
+
+    def x_ranges(self, min_lng, max_lng):
+        if max_lng - min_lng >= 360:
+            return [(-math.inf, math.inf)]
+        ranges = [(max(min_lng, -180.0), min(max_lng, 180.0))]
+        # a box crossing the antimeridian is searched on both sides
+        if min_lng < -180:
+            ranges.append((min_lng + 360, 180.0))
+        elif max_lng > 180:
+            ranges.append((-180.0, max_lng - 360))
+        return [(project(0, low)[0], project(0, high)[0]) for low, high in ranges]
+
+    def within(self, lat, lng, radius_meters):
+        """
+        Spots inside the circle, closest first.
+
+        :return: list of (spot_id, distance in meters)
+        """
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_meters)
+        min_y, max_y = project(min_lat, 0)[1], project(max_lat, 0)[1]
+        first = bisect.bisect_left(self.bands, int(math.floor(min_y / self.band_meters)))
+        last = bisect.bisect_right(self.bands, int(math.floor(max_y / self.band_meters)))
+        x_ranges = self.x_ranges(min_lng, max_lng)
+        ids, lats, lngs, xs, ys, starts = self.ids, self.lats, self.lngs, self.xs, self.ys, self.starts
+
+        result = []
+        for band in range(first, last):
+            start, end = starts[band], starts[band + 1]
+            for min_x, max_x in x_ranges:
+                low = bisect.bisect_left(xs, min_x, start, end)
+                for position in range(low, bisect.bisect_right(xs, max_x, low, end)):
+                    if min_y <= ys[position] <= max_y:
+                        distance = haversine_meters(lat, lng, lats[position], lngs[position])
+                        if distance <= radius_meters:
+                            result.append((ids[position], distance))
+        result.sort(key=lambda item: (item[1], item[0]))
+        return result
+
+
+class SnapshotIndex(OverlayIndex):
+    """
+    The spatial index of a snapshot, searched by a VectorIndex over its columns when
+    vectorised, with the spots this process wrote since it was built on top.
+    """
+
+    def __init__(self, snapshot_path, cell_degrees=0.01, check_seconds=5, vectorised=False):
+        self.path = snapshot_path
+        self.check_seconds = check_seconds
+        self.vectorised = vectorised
+        self.snapshot = SpotSnapshot(snapshot_path)
+        super().__init__(self._searcher(self.snapshot), cell_degrees)
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _searcher(self, spot_snapshot):
+        if self.vectorised:
+            from parking.vector_index import VectorIndex
+
+            return VectorIndex.from_snapshot(spot_snapshot)
+        return spot_snapshot
+
+    def refresh(self):
+        """
+        Switch to the snapshot on disk if it was replaced, checked every check_seconds.
+        """
+        now = time.monotonic()
+        if now - self._checked < self.check_seconds:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return
+            current = self.snapshot.stat
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == (current.st_ino, current.st_mtime_ns,
+                                                                  current.st_size):
+                return
+            try:
+                spot_snapshot = SpotSnapshot(self.path)
+            except (OSError, ValueError):
+                logger.exception('Keeping spot snapshot version %s', self.snapshot.version)
+                return
+            self.snapshot, self.base = spot_snapshot, self._searcher(spot_snapshot)
+            logger.info('Switched to spot snapshot version %s with %s parking spots',
+                        self.snapshot.version, len(self.snapshot))
+
+
+def build(snapshot_path=None):
+    """
+    Snapshot the spots of the primary.
+
+    :return: the version and the number of spots written
+    """
+    from django.db import router
+    from parking import journal
+    from parking.models import ParkingSpot, SpotChange
+
+    using = router.db_for_write(ParkingSpot)
+    # taken first, the spots written while reading are caught up with by the index
+    change_id = journal.Journal.at_end(using, SpotChange).last_id
+    spots = ParkingSpot.lean_values(ParkingSpot.objects.using(using))
+    rows = [(spot_id, lat, lng) for spot_id, lng, lat, _ in spots.iterator()]
+    return write(snapshot_path or path(), rows, change_id=change_id), len(rows)
@@ -0,0 +1,255 @@
+"""
+In-process grid index over parking spot coordinates.
+
+Spots are bucketed into fixed size lat/lng cells. A radius search only visits the
+cells overlapped by the circle's bounding box and then applies an exact haversine
+check, so the cost depends on the local spot density instead of the table size.
+When PARKING_SPOT_SNAPSHOT names a snapshot file, the index searches the memory-mapped
+snapshot instead of loading the spots, see parking.snapshot. With NumPy installed the
+spots are searched as arrays by parking.vector_index. The spots written by the other
+processes are read from the SpotChange log, see parking.journal.
+"""
+import logging
+import math
+import os
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import router
+
+from parking import journal
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def haversine_meters(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance between two points in meters.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lng, radius_meters):
+    """
+    Lat/lng box enclosing the circle. Longitude spans the whole globe when the circle
+    reaches a pole.
+
+    :return: (min_lat, max_lat, min_lng, max_lng)
+    """
+    angular_radius = radius_meters / EARTH_RADIUS_METERS
+    dlat = math.degrees(angular_radius)
+    min_lat, max_lat = lat - dlat, lat + dlat
+    cos_lat = math.cos(math.radians(lat))
+    if min_lat <= -90 or max_lat >= 90 or math.sin(angular_radius) >= cos_lat:
+        return max(-90.0, min_lat), min(90.0, max_lat), lng - 180.0, lng + 180.0
+    dlng = math.degrees(math.asin(math.sin(angular_radius) / cos_lat))
+    return min_lat, max_lat, lng - dlng, lng + dlng
+
+
+class GridIndex():
+    def __init__(self, cell_degrees=0.01):
+        self.cell_degrees = cell_degrees
+        # position in the SpotChange log of the process wide index
+        self.journal = None
+        self._cells = defaultdict(dict)
+        self._spots = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._spots)
+
+    def __contains__(self, spot_id):
+        return spot_id in self._spots
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_degrees)), int(math.floor(lng / self.cell_degrees))
+
+    def add(self, spot_id, lat, lng):
+        with self._lock:
+            self.remove(spot_id)
+            self._spots[spot_id] = (lat, lng)
+            self._cells[self._cell(lat, lng)][spot_id] = (lat, lng)
+
+    def remove(self, spot_id):
+        with self._lock:
+            coords = self._spots.pop(spot_id, None)
+            if coords is None:
+                return
+            cell_key = self._cell(*coords)
+            cell = self._cells[cell_key]
+            cell.pop(spot_id, None)
+            if not cell:
+                del self._cells[cell_key]
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._spots.clear()
+
+    def _candidate_cells(self, min_lat, max_lat, min_lng, max_lng):
+        min_row, min_col = self._cell(min_lat, min_lng)
+        max_row, max_col = self._cell(max_lat, max_lng)
+        cell_count = (max_row - min_row + 1) * (max_col - min_col + 1)
+        if cell_count > len(self._cells):
+            # cheaper to walk the occupied cells than the empty part of the box
+            return [cell for key, cell in self._cells.items()
+                    if min_row <= key[0] <= max_row and min_col <= key[1] <= max_col]
+        return [self._cells[key] for key in
+                ((row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1))
+                if key in self._cells]
+
+    def within(self, lat, lng, radius_meters):
+        """
+        Spots inside the circle, closest first.
+
+        :return: list of (spot_id, distance in meters)
+        """
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_meters)
+        result = []
+        with self._lock:
+            if max_lng - min_lng >= 360:
+                cells = list(self._cells.values())
+            elif min_lng < -180 or max_lng > 180:
+                # the box crosses the antimeridian, search both halves
+                cells = self._candidate_cells(min_lat, max_lat, max(min_lng, -180.0), min(max_lng, 180.0))
+                wrapped = (min_lng + 360, 180.0) if min_lng < -180 else (-180.0, max_lng - 360)
+                cells += self._candidate_cells(min_lat, max_lat, *wrapped)
+            else:
+                cells = self._candidate_cells(min_lat, max_lat, min_lng, max_lng)
+            for cell in cells:
+                for spot_id, (spot_lat, spot_lng) in cell.items():
+                    distance = haversine_meters(lat, lng, spot_lat, spot_lng)
+                    if distance <= radius_meters:
+                        result.append((spot_id, distance))
+        result.sort(key=lambda item: (item[1], item[0]))
+        return result
+
+
+class OverlayIndex():
+    """
+    A read only index, e.g. a memory-mapped snapshot, with the spots saved or deleted
+    since it was built in a small GridIndex on top.
+    """
+
+    def __init__(self, base, cell_degrees=0.01):
+        self.base = base
+        self.changes = GridIndex(cell_degrees)
+        # position in the SpotChange log of the process wide index
+        self.journal = None
+        # spots whose entry in base is outdated
+        self._changed = set()
+
+    def add(self, spot_id, lat, lng):
+        self._changed.add(spot_id)
+        self.changes.add(spot_id, lat, lng)
+
+    def remove(self, spot_id):
+        self._changed.add(spot_id)
+        self.changes.remove(spot_id)
+
+    def within(self, lat, lng, radius_meters):
+        changed = self._changed
+        result = [item for item in self.base.within(lat, lng, radius_meters) if item[0] not in changed]
+        if changed:
+            result.extend(self.changes.within(lat, lng, radius_meters))
+            result.sort(key=lambda item: (item[1], item[0]))
+        return result
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'PARKING_SPATIAL_INDEX', False)
+
+
+def get_index():
+    """
+    Process wide index, loaded from the spot snapshot or the database on first use and
+    brought up to date with the spots written by the other processes on every use.
+    """
+    global _index
+    index = _index
+    if index is None or not journal.catch_up_spots(index, index.journal):
+        with _index_lock:
+            # unless another thread built it meanwhile
+            if _index is index:
+                _index = build_index()
+            index = _index
+    refresh = getattr(index, 'refresh', None)
+    if refresh is not None:
+        refresh()
+    return index
+
+
+def is_vectorised():
+    from parking import vector_index
+
+    return getattr(settings, 'PARKING_SPATIAL_INDEX_NUMPY', True) and vector_index.is_available()
+
+
+def build_index():
+    from parking import snapshot, vector_index
+    from parking.models import ParkingSpot, SpotChange
+
+    # loaded from the primary, which logs the spot changes
+    using = router.db_for_write(ParkingSpot)
+    cell_degrees = getattr(settings, 'PARKING_SPATIAL_INDEX_CELL_DEGREES', 0.01)
+    snapshot_path = snapshot.path()
+    if snapshot_path and os.path.exists(snapshot_path):
+        try:
+            index = snapshot.SnapshotIndex(snapshot_path, cell_degrees,
+                                           getattr(settings, 'PARKING_SPOT_SNAPSHOT_CHECK_SECONDS', 5),
+                                           is_vectorised())
+        except (OSError, ValueError):
+            logger.exception('Building the spatial index from the database instead of the spot snapshot')
+        else:
+            # the spots created, moved or deleted since the snapshot was built, by any process
+            index.journal = journal.Journal(using, index.snapshot.change_id, SpotChange)
+            if journal.catch_up_spots(index, index.journal):
+                logger.info('Mapped spot snapshot version %s with %s parking spots',
+                            index.snapshot.version, len(index.snapshot))
+                return index
+            logger.warning('Spot snapshot version %s is too far behind the spot changes, building the spatial '
+                           'index from the database, run `manage.py build_spot_snapshot`', index.snapshot.version)
+
+    # taken first, the writes made while loading are caught up with afterwards
+    spot_journal = journal.Journal.at_end(using, SpotChange)
+    if is_vectorised():
+        rows = ParkingSpot.lean_values(ParkingSpot.objects.using(using)).iterator()
+        base = vector_index.VectorIndex.from_spots((spot_id, lat, lng) for spot_id, lng, lat, _ in rows)
+        logger.info('Built vectorised spatial index with %s parking spots', len(base))
+        index = OverlayIndex(base, cell_degrees)
+        index.journal = spot_journal
+        return index
+
+    index = GridIndex(cell_degrees)
+    index.journal = spot_journal
+    for spot_id, location in ParkingSpot.objects.using(using).values_list('id', 'location').iterator():
+        index.add(spot_id, location.y, location.x)
+    logger.info('Built spatial index with %s parking spots', len(index))
+    return index
+
+
+def reset_index():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def spot_saved(spot):
+    if _index is not None:
+        _index.add(spot.id, spot.location.y, spot.location.x)
+
+
+def spot_deleted(spot_id):
+    if _index is not None:
+        _index.remove(spot_id)
@@ -0,0 +1,105 @@
+"""
+Streaming readers for bulk parking spot imports.
+
+Every reader is a generator of (lat, lng, address) tuples that holds at most one
+record, or one read buffer for GeoJSON, in memory, so an import runs in constant
+memory whatever the size of the input file.
+"""
+import csv
+import itertools
+import json
+
+FORMATS = ('csv', 'geojson', 'ndjson')
+
+
+def detect_format(path):
+    for extension, file_format in (('.csv', 'csv'), ('.geojson', 'geojson'),
+                                   ('.ndjson', 'ndjson'), ('.jsonl', 'ndjson')):
+        if path.lower().endswith(extension):
+            return file_format
+    raise ValueError('Can\'t tell the format of %s, pass --format' % path)
+
+
+def from_feature(feature):
+    lng, lat = feature['geometry']['coordinates'][:2]
+    return float(lat), float(lng), (feature.get('properties') or {}).get('address', '')
+
+
+def from_record(record):
+    if record.get('type') == 'Feature':
+        return from_feature(record)
+    return float(record['lat']), float(record['lng']), record.get('address', '')
+
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield float(row['lat']), float(row['lng']), row.get('address', '')
+
+
+def read_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield from_record(json.loads(line))
+
+
+def read_geojson(stream, buffer_size=1 << 16):
+    """
+    Incrementally decode the features of a FeatureCollection without loading the
+    whole document.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = stream.read(buffer_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    # skip to the opening bracket of the features array
+    while True:
+        start = buffer.find('"features"')
+        if start != -1:
+            bracket = buffer.find('[', start)
+            if bracket != -1:
+                position = bracket + 1
+                break
+        if eof:
+            raise ValueError('No "features" array found')
+        position = max(0, len(buffer) - len('"features"'))
+        fill()
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            feature, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise
+            fill()
+            continue
+        position = end
+        yield from_feature(feature)
+
+
+READERS = {
+    'csv': read_csv,
+    'geojson': read_geojson,
+    'ndjson': read_ndjson,
+}
+
+
+def chunks(records, size):
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
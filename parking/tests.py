@@ -1,16 +1,44 @@
+import cProfile
+import io
 import json
 import logging
+import os
+import random
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from unittest import mock
 
-from django.test import TestCase
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.db.models import signals
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, SimpleTestCase, TransactionTestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
-from parking.models import ParkingSpot, ParkingSpotReservation
+from parking import async_views, availability, availability_cache, batch, holds, locks, metrics, profiling, routers, \
+    sharding, slots, snapshot, spatial_index, vector_index, views
+from parking.log import BackgroundHandler, SampleFilter, Summary
+from parking.middleware import MetricsMiddleware, ProfilingMiddleware, ReadYourWritesMiddleware
+from parking.models import ArchivedReservation, ParkingSpot, ParkingSpotReservation, ReservationChange, SpotChange
 
 logger = logging.getLogger(__name__)
 from django.utils.dateparse import parse_datetime
 
+# save() refuses windows in the past, the fixture reservations are on a day in the future
+FIXTURE_DAY = (timezone.now() + timedelta(days=30)).strftime('%Y-%m-%d')
 
-def create_parking_spots_and_reservations():
+
+def at(time):
+    return '%sT%s' % (FIXTURE_DAY, time)
+
+
+def create_parking_spots():
     ParkingSpot.objects.create(location=ParkingSpot.create_point(37.781533, -122.39661),
                                address='468 3rd St, San Francisco, CA 94107, USA')
     ParkingSpot.objects.create(location=ParkingSpot.create_point(37.781345, -122.396861),
@@ -21,9 +49,13 @@ def create_parking_spots_and_reservations():
                                address='161-169 Stillman St, San Francisco, CA 94107, USA')
     ParkingSpot.objects.create(location=ParkingSpot.create_point(37.8079996, -122.4177434),
                                address='Fisherman\'s Wharf, San Francisco, CA, USA')
+
+
+def create_parking_spots_and_reservations():
+    create_parking_spots()
     ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=1),
-                                          start_ts=parse_datetime('2018-10-03T19:00:00Z'),
-                                          end_ts=parse_datetime('2018-10-03T20:00:00Z'))
+                                          start_ts=parse_datetime(at('19:00:00Z')),
+                                          end_ts=parse_datetime(at('20:00:00Z')))
 
 
 class ParkingModelTests(TestCase):
@@ -45,12 +77,352 @@ class ParkingModelTests(TestCase):
         self.assertEqual(result[1][0].location.x, lng)
         self.assertEqual(result[1][0].location.y, lat)
 
+    def test_lean_rows_match_models(self):
+        create_parking_spots()
+        _, spots = ParkingSpot.within_range(37.781533, -122.39661, 5000, 0, 10)
+        _, rows = ParkingSpot.within_range(37.781533, -122.39661, 5000, 0, 10, lean=True)
+        self.assertEqual(list(rows), [(spot.id, spot.location.x, spot.location.y, spot.address) for spot in spots])
+
     def test_list_spots_outside_radius(self):
         lat = 22
         lng = -22
         self.assertEqual(len(ParkingSpot.within_range(lat, lng, 10, 0, 10)[1]), 0)
 
 
+class GridIndexTests(SimpleTestCase):
+    def test_within_radius_closest_first(self):
+        index = spatial_index.GridIndex()
+        index.add(1, 37.781533, -122.39661)
+        index.add(2, 37.781345, -122.396861)
+        index.add(3, 37.8079996, -122.4177434)
+
+        result = index.within(37.781533, -122.39661, 50)
+        self.assertEqual([spot_id for spot_id, _ in result], [1, 2])
+        self.assertEqual(result[0][1], 0)
+
+    def test_move_and_remove(self):
+        index = spatial_index.GridIndex()
+        index.add(1, 37.781533, -122.39661)
+        index.add(1, 22, -22)
+        self.assertEqual(index.within(37.781533, -122.39661, 50), [])
+        self.assertEqual(len(index.within(22, -22, 1)), 1)
+
+        index.remove(1)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.within(22, -22, 1), [])
+
+    def test_antimeridian(self):
+        index = spatial_index.GridIndex()
+        index.add(1, 0, 179.9999)
+        self.assertEqual(len(index.within(0, -179.9999, 100)), 1)
+
+
+class SpatialIndexTests(TestCase):
+    def setUp(self):
+        spatial_index.reset_index()
+
+    def tearDown(self):
+        spatial_index.reset_index()
+
+    def assertSameSpots(self, lat, lng, radius):
+        indexed = ParkingSpot.in_range(lat, lng, radius, use_index=True)
+        scanned = ParkingSpot.in_range(lat, lng, radius, use_index=False)
+        self.assertEqual(sorted(indexed.values_list('id', flat=True)),
+                         sorted(scanned.values_list('id', flat=True)))
+
+    def test_index_matches_sql(self):
+        create_parking_spots()
+
+        for radius in (1, 10, 50, 100, 5000):
+            self.assertSameSpots(37.781533, -122.39661, radius)
+        self.assertSameSpots(22, -22, 10)
+
+    def test_index_follows_saves_and_deletes(self):
+        create_parking_spots()
+        spatial_index.get_index()
+
+        # the index follows committed writes only
+        with self.captureOnCommitCallbacks(execute=True):
+            spot = ParkingSpot.objects.create(location=ParkingSpot.create_point(22, -22), address='new')
+        self.assertEqual(list(ParkingSpot.in_range(22, -22, 10, use_index=True)), [spot])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            spot.delete()
+        self.assertEqual(list(ParkingSpot.in_range(22, -22, 10, use_index=True)), [])
+
+    def test_index_follows_other_processes(self):
+        create_parking_spots()
+        index = spatial_index.get_index()
+        # bulk_create and raw SQL send no signals, like an import or the writes of another worker
+        ParkingSpot.objects.bulk_create([ParkingSpot(location=ParkingSpot.create_point(22, -22), address='imported')])
+        spot = ParkingSpot.objects.get(address='imported')
+        self.assertEqual(list(ParkingSpot.in_range(22, -22, 10, use_index=True)), [spot])
+        self.assertIs(spatial_index.get_index(), index)
+
+        ParkingSpot.objects.filter(pk=spot.pk).update(location=ParkingSpot.create_point(40, -70))
+        self.assertEqual(list(ParkingSpot.in_range(22, -22, 10, use_index=True)), [])
+        self.assertEqual(list(ParkingSpot.in_range(40, -70, 10, use_index=True)), [spot])
+
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM parking_parkingspot WHERE id = %s', [spot.pk])
+        self.assertEqual(spatial_index.get_index().within(40, -70, 10), [])
+        self.assertIs(spatial_index.get_index(), index)
+
+    def test_index_rebuilt_after_pruned_changes(self):
+        create_parking_spots()
+        index = spatial_index.get_index()
+        ParkingSpot.objects.bulk_create([ParkingSpot(location=ParkingSpot.create_point(22, -22), address='imported'),
+                                         ParkingSpot(location=ParkingSpot.create_point(40, -70), address='imported')])
+        self.assertGreater(SpotChange.prune(timezone.now() + timedelta(minutes=1)), 0)
+        rebuilt = spatial_index.get_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(len(rebuilt.within(22, -22, 10)), 1)
+
+    def test_index_ignores_rolled_back_spots(self):
+        spatial_index.get_index()
+        with self.assertRaises(ValueError), transaction.atomic():
+            ParkingSpot.objects.create(location=ParkingSpot.create_point(22, -22), address='new')
+            raise ValueError()
+        self.assertEqual(spatial_index.get_index().within(22, -22, 10), [])
+
+
+class SpotScheduleTests(SimpleTestCase):
+    def test_closed_intervals(self):
+        schedule = availability.SpotSchedule()
+        schedule.add(1, 10, 20)
+        schedule.add(2, 40, 50)
+
+        self.assertTrue(schedule.is_free(0, 9))
+        self.assertTrue(schedule.is_free(21, 39))
+        self.assertFalse(schedule.is_free(0, 10))
+        self.assertFalse(schedule.is_free(20, 30))
+        self.assertFalse(schedule.is_free(12, 15))
+        self.assertFalse(schedule.is_free(0, 100))
+
+    def test_overlapping_reservations(self):
+        schedule = availability.SpotSchedule()
+        schedule.add(1, 0, 100)
+        schedule.add(2, 10, 20)
+        self.assertFalse(schedule.is_free(50, 60))
+
+        schedule.remove(1)
+        self.assertTrue(schedule.is_free(50, 60))
+
+    def test_prune(self):
+        engine = availability.AvailabilityEngine(0)
+        engine.add(1, 1, 10, 20)
+        engine.add(2, 1, 40, 50)
+        engine.prune(30)
+
+        self.assertEqual(len(engine), 1)
+        self.assertFalse(engine.covers(20))
+        self.assertEqual(engine.free_spots([1, 2], 45, 60), [2])
+
+
+class AvailabilityEngineTests(TestCase):
+    def setUp(self):
+        availability.reset_engine()
+        create_parking_spots()
+        self.base = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.spot = ParkingSpot.objects.get(pk=2)
+        for start, end in ((1, 2), (4, 6), (6, 7), (10, 12)):
+            ParkingSpotReservation.objects.create(user_id=1, parkingspot=self.spot,
+                                                  start_ts=self.base + timedelta(hours=start),
+                                                  end_ts=self.base + timedelta(hours=end))
+
+    def tearDown(self):
+        availability.reset_engine()
+
+    def test_engine_matches_orm(self):
+        engine = availability.get_engine()
+        for start in range(0, 14):
+            for length in (1, 2, 5):
+                start_ts = self.base + timedelta(hours=start, minutes=30)
+                end_ts = start_ts + timedelta(hours=length)
+                for window in ((start_ts, end_ts), (start_ts - timedelta(minutes=30), end_ts)):
+                    expected = ParkingSpotReservation.overlapping_reservations_exist(self.spot, *window) is None
+                    self.assertEqual(engine.is_free(self.spot.id, *window), expected, window)
+
+    def test_engine_follows_writes(self):
+        engine = availability.get_engine()
+        start_ts, end_ts = self.base + timedelta(hours=20), self.base + timedelta(hours=21)
+        self.assertTrue(engine.is_free(self.spot.id, start_ts, end_ts))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = ParkingSpotReservation.objects.create(user_id=1, parkingspot=self.spot,
+                                                                start_ts=start_ts, end_ts=end_ts)
+        self.assertFalse(engine.is_free(self.spot.id, start_ts, end_ts))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.delete()
+        self.assertTrue(engine.is_free(self.spot.id, start_ts, end_ts))
+
+    def test_rolled_back_booking_leaves_engine_free(self):
+        engine = availability.get_engine()
+        start_ts, end_ts = self.base + timedelta(hours=20), self.base + timedelta(hours=21)
+        with self.captureOnCommitCallbacks(execute=True), self.assertRaises(ValueError):
+            with transaction.atomic():
+                ParkingSpotReservation.objects.create(user_id=1, parkingspot=self.spot,
+                                                      start_ts=start_ts, end_ts=end_ts)
+                raise ValueError('rolled back')
+        self.assertIs(availability.get_engine(), engine)
+        self.assertTrue(engine.is_free(self.spot.id, start_ts, end_ts))
+
+    def test_engine_follows_other_processes(self):
+        engine = availability.get_engine()
+        start_ts, end_ts = self.base + timedelta(hours=20), self.base + timedelta(hours=21)
+        # bulk_create and raw SQL send no signals, like the writes of another worker
+        ParkingSpotReservation.objects.bulk_create([
+            ParkingSpotReservation(user_id=2, parkingspot=self.spot, start_ts=start_ts, end_ts=end_ts),
+        ])
+        self.assertTrue(engine.is_free(self.spot.id, start_ts, end_ts))
+        self.assertIs(availability.get_engine(), engine)
+        self.assertFalse(engine.is_free(self.spot.id, start_ts, end_ts))
+
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM parking_parkingspotreservation WHERE start_ts = %s', [start_ts])
+        self.assertIs(availability.get_engine(), engine)
+        self.assertTrue(engine.is_free(self.spot.id, start_ts, end_ts))
+
+    def test_engine_rebuilt_after_pruned_changes(self):
+        engine = availability.get_engine()
+        ParkingSpotReservation.objects.bulk_create([
+            ParkingSpotReservation(user_id=2, parkingspot=self.spot, start_ts=self.base + timedelta(hours=hour),
+                                   end_ts=self.base + timedelta(hours=hour, minutes=30))
+            for hour in (20, 22)
+        ])
+        self.assertEqual(ReservationChange.prune(timezone.now() + timedelta(minutes=1)), 1)
+        rebuilt = availability.get_engine()
+        self.assertIsNot(rebuilt, engine)
+        self.assertFalse(rebuilt.is_free(self.spot.id, self.base + timedelta(hours=20),
+                                         self.base + timedelta(hours=21)))
+
+    @override_settings(PARKING_AVAILABILITY_ENGINE=True)
+    def test_within_range_batch_filter(self):
+        start_ts, end_ts = self.base + timedelta(hours=5), self.base + timedelta(hours=5, minutes=30)
+        total, spots = ParkingSpot.within_range(37.781533, -122.39661, 50, 0, 10, start_ts, end_ts)
+        self.assertEqual([spot.id for spot in spots], [1])
+
+        with self.assertRaises(ValidationError):
+            ParkingSpotReservation.objects.create(user_id=1, parkingspot=self.spot,
+                                                  start_ts=start_ts, end_ts=end_ts)
+
+
+class AntiJoinTests(TestCase):
+    def test_count_not_inflated_by_reservation_history(self):
+        create_parking_spots()
+        base = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        for spot_id in (1, 2):
+            for hour in range(0, 10, 2):
+                ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=spot_id),
+                                                      start_ts=base + timedelta(hours=hour),
+                                                      end_ts=base + timedelta(hours=hour + 1))
+
+        free_window = (base + timedelta(hours=20), base + timedelta(hours=21))
+        total, spots = ParkingSpot.within_range(37.781533, -122.39661, 50, 0, 10, *free_window)
+        self.assertEqual(total, 2)
+        self.assertEqual(sorted(spot.id for spot in spots), [1, 2])
+
+        busy_window = (base + timedelta(hours=2, minutes=30), base + timedelta(hours=5))
+        total, spots = ParkingSpot.within_range(37.781533, -122.39661, 50, 0, 10, *busy_window)
+        self.assertEqual(total, 0)
+
+
+class NearestTests(TestCase):
+    def setUp(self):
+        spatial_index.reset_index()
+        create_parking_spots()
+
+    def tearDown(self):
+        spatial_index.reset_index()
+
+    def test_nearest_ordered_by_distance(self):
+        for use_index in (False, True):
+            result = ParkingSpot.nearest(37.780604, -122.397851, 3, use_index=use_index)
+            self.assertEqual([spot.id for spot, _ in result], [4, 3, 2])
+            distances = [distance for _, distance in result]
+            self.assertEqual(distances, sorted(distances))
+            self.assertAlmostEqual(distances[0], 0, places=3)
+
+    def test_nearest_widens_search(self):
+        result = ParkingSpot.nearest(37.8079996, -122.4177434, 2, initial_radius_meters=10)
+        self.assertEqual([spot.id for spot, _ in result], [5, 1])
+
+    def test_nearest_limited_by_max_radius(self):
+        result = ParkingSpot.nearest(37.8079996, -122.4177434, 5, max_radius_meters=1000)
+        self.assertEqual([spot.id for spot, _ in result], [5])
+
+    def test_nearest_skips_reserved_spots(self):
+        start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        end_ts = start_ts + timedelta(hours=1)
+        ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=4),
+                                              start_ts=start_ts, end_ts=end_ts)
+
+        result = ParkingSpot.nearest(37.780604, -122.397851, 2, start_ts, end_ts)
+        self.assertEqual([spot.id for spot, _ in result], [3, 2])
+
+    def test_nearest_view(self):
+        response = self.client.get(reverse('parking:nearest'), {'lat': 37.781533, 'lng': -122.39661, 'k': 2})
+        self.assertEqual(response.status_code, 200)
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['hits']['page_size'], 2)
+        self.assertEqual([result['id'] for result in json_data['result']], [1, 2])
+        self.assertIn('distance', json_data['result'][0])
+
+
+class BatchSearchTests(TestCase):
+    def test_batch_matches_individual_searches(self):
+        create_parking_spots()
+        start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        end_ts = start_ts + timedelta(hours=1)
+        ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=1),
+                                              start_ts=start_ts, end_ts=end_ts)
+
+        queries = [
+            {'lat': 37.781533, 'lng': -122.39661, 'radius': 50},
+            {'lat': 22, 'lng': -22, 'radius': 10},
+            {'lat': 37.781533, 'lng': -122.39661, 'radius': 50,
+             'start_ts': start_ts.isoformat(), 'end_ts': end_ts.isoformat()},
+            {'lat': 37.8079996, 'lng': -122.4177434, 'radius': 5000, 'page_size': 2},
+        ]
+        response = self.client.post(reverse('parking:batch_available'), json.dumps({'queries': queries}), 'json')
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)['results']
+        self.assertEqual(len(results), len(queries))
+
+        for query, result in zip(queries, results):
+            total, spots = ParkingSpot.within_range(query['lat'], query['lng'], query['radius'],
+                                                    0, query.get('page_size', 10),
+                                                    parse_datetime(query.get('start_ts', '')),
+                                                    parse_datetime(query.get('end_ts', '')))
+            self.assertEqual(result['hits']['total'], total)
+            self.assertEqual([spot['id'] for spot in result['result']], [spot.id for spot in spots])
+
+    def test_grouping(self):
+        queries = [batch.SearchQuery(37.78, -122.39, 100, None, None, 10),
+                   batch.SearchQuery(37.7805, -122.39, 100, None, None, 10),
+                   batch.SearchQuery(40, -70, 100, None, None, 10)]
+        self.assertEqual(batch.group_queries(queries), [[0, 1], [2]])
+
+    def test_one_candidate_fetch_per_group(self):
+        create_parking_spots()
+        start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        queries = [batch.SearchQuery(37.781533 + position * 0.00001, -122.39661, 50, start_ts,
+                                     start_ts + timedelta(hours=1), 10) for position in range(batch.MAX_GROUP_SIZE)]
+        # the candidates of every circle, then the reservations of the shared window
+        with self.assertNumQueries(2):
+            results = batch.search_group(queries)
+        self.assertEqual(results[0]['hits']['total'], 2)
+
+    def test_invalid_batch(self):
+        response = self.client.post(reverse('parking:batch_available'), json.dumps({'queries': [{'lat': 1}]}),
+                                    'json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('parking:batch_available'), json.dumps({'queries': [
+            {'lat': 37.781533, 'lng': -122.39661, 'radius': 50, 'page_size': -1}]}), 'json')
+        self.assertEqual(response.status_code, 400)
+
+
 class ParkingIndexViewTests(TestCase):
     def request_available(self, lat, lng, radius,
                           offset=0, page_size=10,
@@ -115,8 +487,8 @@ class ParkingIndexViewTests(TestCase):
         create_parking_spots_and_reservations()
 
         response = self.request_available(lat=37.781533, lng=(-122.39661), radius=50,
-                                          start_ts='2018-10-03T18:30:00Z',
-                                          end_ts='2018-10-03T19:30:00Z')
+                                          start_ts=at('18:30:00Z'),
+                                          end_ts=at('19:30:00Z'))
         self.assertEqual(response.status_code, 200)
 
         json_data = json.loads(response.content)
@@ -126,8 +498,8 @@ class ParkingIndexViewTests(TestCase):
         create_parking_spots_and_reservations()
 
         response = self.request_available(lat=37.781533, lng=(-122.39661), radius=50,
-                                          start_ts='2018-10-03T19:30:00Z',
-                                          end_ts='2018-10-03T20:30:00Z')
+                                          start_ts=at('19:30:00Z'),
+                                          end_ts=at('20:30:00Z'))
         self.assertEqual(response.status_code, 200)
 
         json_data = json.loads(response.content)
@@ -137,8 +509,8 @@ class ParkingIndexViewTests(TestCase):
         create_parking_spots_and_reservations()
 
         response = self.request_available(lat=37.781533, lng=(-122.39661), radius=50,
-                                          start_ts='2018-10-03T19:30:00Z',
-                                          end_ts='2018-10-03T19:45:00Z')
+                                          start_ts=at('19:30:00Z'),
+                                          end_ts=at('19:45:00Z'))
         self.assertEqual(response.status_code, 200)
 
         json_data = json.loads(response.content)
@@ -148,13 +520,64 @@ class ParkingIndexViewTests(TestCase):
         create_parking_spots_and_reservations()
 
         response = self.request_available(lat=37.781533, lng=(-122.39661), radius=50,
-                                          start_ts='2018-10-03T15:30:00Z',
-                                          end_ts='2018-10-03T22:45:00Z')
+                                          start_ts=at('15:30:00Z'),
+                                          end_ts=at('22:45:00Z'))
         self.assertEqual(response.status_code, 200)
 
         json_data = json.loads(response.content)
         self.assertEquals(json_data['hits']['total'], 1)
 
+    def test_keyset_pagination(self):
+        create_parking_spots()
+
+        response = self.client.get(reverse('parking:available'), {'lat': 37.781533, 'lng': -122.39661,
+                                                                  'radius': 5000, 'page_size': 2})
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['hits']['total'], 5)
+        ids = [result['id'] for result in json_data['result']]
+
+        while 'next_cursor' in json_data['hits']:
+            response = self.client.get(reverse('parking:available'), {'lat': 37.781533, 'lng': -122.39661,
+                                                                      'radius': 5000, 'page_size': 2,
+                                                                      'cursor': json_data['hits']['next_cursor']})
+            self.assertEqual(response.status_code, 200)
+            json_data = json.loads(response.content)
+            self.assertNotIn('total', json_data['hits'])
+            ids += [result['id'] for result in json_data['result']]
+
+        self.assertEqual(ids, [1, 2, 3, 4, 5])
+
+    def test_offset_pagination(self):
+        create_parking_spots()
+
+        response = self.client.get(reverse('parking:available'), {'lat': 37.781533, 'lng': -122.39661,
+                                                                  'radius': 5000, 'offset': 2, 'page_size': 2})
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['hits']['offset'], 2)
+        self.assertEqual([result['id'] for result in json_data['result']], [3, 4])
+
+    def test_ndjson_stream(self):
+        create_parking_spots()
+
+        response = self.client.get(reverse('parking:available'), {'lat': 37.781533, 'lng': -122.39661,
+                                                                  'radius': 5000, 'format': 'ndjson'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines], [1, 2, 3, 4, 5])
+        self.assertEqual(json.loads(lines[0])['lat'], 37.781533)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('parking:available'), {'lat': 1, 'lng': 1, 'radius': 1,
+                                                                  'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_negative_paging(self):
+        for params in ({'page_size': -1}, {'offset': -1}):
+            response = self.client.get(reverse('parking:available'), dict({'lat': 1, 'lng': 1, 'radius': 1}, **params))
+            self.assertEqual(response.status_code, 400)
+
+
 class ReservationViewTests(TestCase):
     def test_make_invalid_reservation(self):
         request_payload = {
@@ -184,8 +607,8 @@ class ReservationViewTests(TestCase):
         request_payload = {
             "user_id": 1,
             "parkingspot_id": 1,
-            "start_ts": "2018-10-03T22:00:00Z",
-            "end_ts": "2018-10-03T23:00:00Z"
+            "start_ts": at("22:00:00Z"),
+            "end_ts": at("23:00:00Z")
         }
         response = self.client.post(reverse('parking:reserve'), json.dumps(request_payload), 'json')
         json_data = json.loads(response.content)
@@ -203,8 +626,8 @@ class ReservationViewTests(TestCase):
         request_payload = {
             "user_id": 1,
             "parkingspot_id": 1,
-            "start_ts": "2018-10-03T19:00:00Z",
-            "end_ts": "2018-10-03T20:00:00Z"
+            "start_ts": at("19:00:00Z"),
+            "end_ts": at("20:00:00Z")
         }
         self.client.post(reverse('parking:reserve'), json.dumps(request_payload), 'json')
         response = self.client.post(reverse('parking:reserve'), json.dumps(request_payload), 'json')
@@ -270,3 +693,1293 @@ Bonus
     
     
 """
+
+
+class BulkReservationViewTests(TestCase):
+    def setUp(self):
+        create_parking_spots()
+        self.start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+
+    def item(self, parkingspot_id, start_hour, end_hour):
+        return {
+            'user_id': 1,
+            'parkingspot_id': parkingspot_id,
+            'start_ts': (self.start + timedelta(hours=start_hour)).isoformat(),
+            'end_ts': (self.start + timedelta(hours=end_hour)).isoformat()
+        }
+
+    def request_bulk(self, mode, items):
+        return self.client.post(reverse('parking:bulk_reserve'),
+                                json.dumps({'mode': mode, 'reservations': items}), 'json')
+
+    def test_bulk_reservation(self):
+        response = self.request_bulk('atomic', [self.item(1, 0, 1), self.item(1, 2, 3), self.item(2, 0, 1)])
+        self.assertEqual(response.status_code, 200)
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['reserved'], 3)
+        self.assertEqual([result['parkingspot_reservation']['parkingspot'] for result in json_data['results']],
+                         [1, 1, 2])
+        self.assertEqual(ParkingSpotReservation.objects.count(), 3)
+
+    def test_atomic_rejects_whole_batch(self):
+        ParkingSpotReservation.objects.create(user_id=2, parkingspot=ParkingSpot.objects.get(pk=2),
+                                              start_ts=self.start, end_ts=self.start + timedelta(hours=1))
+
+        response = self.request_bulk('atomic', [self.item(1, 0, 1), self.item(2, 0, 1)])
+        self.assertEqual(response.status_code, 400)
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['reserved'], 0)
+        self.assertEqual(json_data['results'][1]['exception'], 'Reservation not available.')
+        self.assertEqual(ParkingSpotReservation.objects.count(), 1)
+
+    def test_partial_reports_every_item(self):
+        response = self.request_bulk('partial', [self.item(1, 0, 2), self.item(1, 1, 3), self.item(99, 0, 1),
+                                                 self.item(3, 1, 0), self.item(3, 0, 1)])
+        self.assertEqual(response.status_code, 200)
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['reserved'], 2)
+        self.assertEqual([result.get('exception') for result in json_data['results']],
+                         [None, 'Reservation not available.', 'Parking spot not available.',
+                          "End timestamp can't before start timestamp.", None])
+        self.assertEqual(sorted(ParkingSpotReservation.objects.values_list('parkingspot_id', flat=True)), [1, 3])
+
+    def test_malformed_items(self):
+        naive = dict(self.item(2, 0, 1), start_ts=(self.start + timedelta(hours=1)).replace(tzinfo=None).isoformat())
+        items = [self.item(1, 0, 1), dict(self.item(2, 0, 1), user_id='one'), naive, dict(self.item(3, 0, 1),
+                                                                                           parkingspot_id=None)]
+        response = self.request_bulk('atomic', items)
+        self.assertEqual(response.status_code, 400)
+        results = json.loads(response.content)['results']
+        self.assertEqual(results[0]['exception'], 'Batch rejected.')
+        self.assertTrue(all(result['exception'].startswith('Invalid reservation') for result in results[1:]))
+        self.assertFalse(ParkingSpotReservation.objects.exists())
+
+        response = self.request_bulk('partial', items)
+        self.assertEqual(response.status_code, 200)
+        json_data = json.loads(response.content)
+        self.assertEqual(json_data['reserved'], 1)
+        self.assertEqual(json_data['results'][0]['parkingspot_reservation']['parkingspot'], 1)
+
+
+class ConcurrentReservationTests(TransactionTestCase):
+    def test_no_double_booking(self):
+        create_parking_spots()
+        start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        booked = []
+
+        def book(user_id):
+            for spot_id in (1, 2):
+                try:
+                    ParkingSpotReservation(user_id=user_id, parkingspot_id=spot_id,
+                                           start_ts=start_ts + timedelta(minutes=user_id),
+                                           end_ts=start_ts + timedelta(hours=1)).save()
+                    booked.append(spot_id)
+                except ValidationError:
+                    pass
+            connection.close()
+
+        workers = [threading.Thread(target=book, args=(user_id,)) for user_id in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sorted(booked), [1, 2])
+        self.assertEqual(ParkingSpotReservation.objects.count(), 2)
+
+
+class ReservationSaveTests(TestCase):
+    def setUp(self):
+        create_parking_spots()
+        self.start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+
+    def reservation(self, **kwargs):
+        return ParkingSpotReservation(user_id=1, parkingspot_id=1, start_ts=self.start_ts,
+                                      end_ts=self.start_ts + timedelta(hours=1), **kwargs)
+
+    def test_save_goes_through_django(self):
+        sent = []
+
+        def receiver(sender, instance, **kwargs):
+            sent.append(instance.pk)
+
+        signals.pre_save.connect(receiver, sender=ParkingSpotReservation)
+        self.addCleanup(signals.pre_save.disconnect, receiver, sender=ParkingSpotReservation)
+        reservation = self.reservation()
+        reservation.save(using='default', force_insert=True)
+        self.assertEqual(sent, [None])
+        self.assertEqual(reservation._state.db, 'default')
+        self.assertFalse(reservation._state.adding)
+        self.assertIsNotNone(reservation.create_date)
+        self.assertTrue(ParkingSpotReservation.objects.filter(pk=reservation.pk).exists())
+
+        with self.assertRaises(ValidationError):
+            self.reservation().save()
+        with self.assertRaises(ValueError):
+            self.reservation().save(update_fields=['user_id'])
+
+    def test_retry_locked(self):
+        calls = []
+
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'written'
+
+        self.assertEqual(locks.retry_locked(write), 'written')
+        self.assertEqual(len(calls), 3)
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            locks.retry_locked(write, attempts=2)
+        calls.clear()
+        with self.assertRaises(OperationalError):
+            locks.retry_locked(lambda: connection.cursor().execute('SELECT * FROM missing_table'))
+
+
+class ImportSpotsCommandTests(TestCase):
+    def import_spots(self, content, suffix, *args):
+        with tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False) as spots_file:
+            spots_file.write(content)
+        self.addCleanup(os.remove, spots_file.name)
+        call_command('import_spots', spots_file.name, '--batch-size', '2', '--transaction-size', '1', *args,
+                     stdout=io.StringIO())
+
+    def assertImported(self):
+        self.assertEqual(ParkingSpot.objects.count(), 3)
+        spot = ParkingSpot.objects.get(address='Fisherman\'s Wharf')
+        self.assertEqual((spot.location.y, spot.location.x), (37.8079996, -122.4177434))
+
+    def test_import_csv(self):
+        self.import_spots('lat,lng,address\n'
+                          '37.781533,-122.39661,468 3rd St\n'
+                          '37.781345,-122.396861,"125a Stillman St, San Francisco"\n'
+                          '37.8079996,-122.4177434,Fisherman\'s Wharf\n', '.csv')
+        self.assertImported()
+
+    def test_import_ndjson(self):
+        self.import_spots('{"lat": 37.781533, "lng": -122.39661, "address": "468 3rd St"}\n'
+                          '{"lat": 37.781345, "lng": -122.396861, "address": "125a Stillman St"}\n'
+                          '{"lat": 37.8079996, "lng": -122.4177434, "address": "Fisherman\'s Wharf"}\n', '.txt',
+                          '--format', 'ndjson')
+        self.assertImported()
+
+    def test_import_geojson(self):
+        features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                     'properties': {'address': address}}
+                    for lat, lng, address in ((37.781533, -122.39661, '468 3rd St'),
+                                              (37.781345, -122.396861, '125a Stillman St'),
+                                              (37.8079996, -122.4177434, 'Fisherman\'s Wharf'))]
+        self.import_spots(json.dumps({'type': 'FeatureCollection', 'features': features}), '.geojson')
+        self.assertImported()
+
+    def test_invalid_record(self):
+        with self.assertRaises(CommandError):
+            self.import_spots('lat,lng,address\nnorth,west,nowhere\n', '.csv')
+
+    def test_malformed_geojson(self):
+        for feature in ({'type': 'Feature', 'geometry': None}, {'type': 'Feature'}, ['not', 'a', 'feature'],
+                        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [1]}}):
+            with self.subTest(feature=feature), self.assertRaises(CommandError):
+                self.import_spots(json.dumps({'type': 'FeatureCollection', 'features': [feature]}), '.geojson')
+
+
+class LocalCacheBackendTests(SimpleTestCase):
+    def test_lru_eviction(self):
+        backend = availability_cache.LocalBackend(max_entries=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual((backend.get('a'), backend.get('b'), backend.get('c')), (1, None, 3))
+
+    def test_ttl(self):
+        backend = availability_cache.LocalBackend(ttl=-1)
+        backend.set('a', 1)
+        self.assertIsNone(backend.get('a'))
+
+    def test_versions(self):
+        backend = availability_cache.LocalBackend()
+        backend.bump([(1, 1)])
+        self.assertEqual(backend.versions([(1, 1), (1, 2)]), [1, 0])
+
+
+@override_settings(PARKING_AVAILABILITY_CACHE='local')
+class AvailabilityCacheTests(TestCase):
+    def setUp(self):
+        availability_cache.reset_backend()
+        availability_cache.stats = availability_cache.Stats()
+        create_parking_spots()
+        self.start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.end_ts = self.start_ts + timedelta(hours=1)
+
+    def tearDown(self):
+        availability_cache.reset_backend()
+
+    def search(self):
+        total, spots = availability_cache.within_range(37.781533, -122.39661, 50, 0, 10, self.start_ts, self.end_ts)
+        return [spot.id for spot in spots]
+
+    def reserve(self, parkingspot_id):
+        with self.captureOnCommitCallbacks(execute=True):
+            ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=parkingspot_id),
+                                                  start_ts=self.start_ts, end_ts=self.end_ts)
+
+    def test_hit_after_miss(self):
+        self.assertEqual(self.search(), [1, 2])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search(), [1, 2])
+        self.assertEqual(availability_cache.stats.hits, 1)
+        self.assertEqual(availability_cache.stats.misses, 1)
+
+    def test_reservation_invalidates_its_cell(self):
+        self.assertEqual(self.search(), [1, 2])
+        self.reserve(1)
+        self.assertEqual(self.search(), [2])
+        self.assertEqual(availability_cache.stats.misses, 2)
+
+    def test_distant_reservation_keeps_entries(self):
+        self.search()
+        self.reserve(5)
+        self.search()
+        self.assertEqual(availability_cache.stats.hits, 1)
+
+    def test_moved_spot_invalidates_both_cells(self):
+        self.search()
+        spot = ParkingSpot.objects.get(pk=5)
+        spot.location = ParkingSpot.create_point(37.781533, -122.39661)
+        with self.captureOnCommitCallbacks(execute=True):
+            spot.save()
+        self.assertEqual(self.search(), [1, 2, 5])
+
+
+class AsyncViewTests(TransactionTestCase):
+    def setUp(self):
+        create_parking_spots()
+        self.factory = RequestFactory()
+
+    def assertSameResponse(self, request, async_view, view):
+        async_response = async_to_sync(async_view)(request)
+        response = view(request)
+        self.assertEqual(async_response.status_code, response.status_code)
+        self.assertEqual(json.loads(async_response.content), json.loads(response.content))
+
+    def test_available(self):
+        for params in ({'lat': 37.781533, 'lng': -122.39661, 'radius': 5000, 'page_size': 2},
+                       {'lat': 37.781533, 'lng': -122.39661, 'radius': 5000, 'total': 'false'},
+                       {'lat': 1, 'lng': 1, 'radius': 1, 'cursor': 'not-a-cursor'}):
+            request = self.factory.get(reverse('parking:available'), params)
+            self.assertSameResponse(request, async_views.available, views.available)
+
+    def test_batch_available(self):
+        queries = [{'lat': 37.781533, 'lng': -122.39661, 'radius': 50},
+                   {'lat': 37.8079996, 'lng': -122.4177434, 'radius': 10}]
+        request = self.factory.post(reverse('parking:batch_available'), json.dumps({'queries': queries}),
+                                    'application/json')
+        self.assertSameResponse(request, async_views.batch_available, views.batch_available)
+
+    @mock.patch.object(views, 'STREAM_CHUNK_SIZE', 2)
+    def test_ndjson_stream(self):
+        async def read(response):
+            return [chunk async for chunk in response]
+
+        for params in ({'lat': 37.781533, 'lng': -122.39661, 'radius': 5000, 'format': 'ndjson'},
+                       {'lat': 37.781533, 'lng': -122.39661, 'radius': 5000, 'format': 'ndjson', 'page_size': 3},
+                       {'lat': 37.781533, 'lng': -122.39661, 'radius': 5000, 'format': 'ndjson', 'offset': 1}):
+            request = self.factory.get(reverse('parking:available'), params)
+            response = async_to_sync(async_views.available)(request)
+            self.assertTrue(response.is_async)
+            chunks = async_to_sync(read)(response)
+            self.assertLessEqual(max(chunk.count(b'\n') for chunk in chunks), 2)
+            self.assertEqual(b''.join(chunks), b''.join(views.available(request).streaming_content))
+
+    def test_make_reservation(self):
+        start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        request = self.factory.post(reverse('parking:reserve'), json.dumps({
+            'user_id': 1,
+            'parkingspot_id': 1,
+            'start_ts': start_ts.isoformat(),
+            'end_ts': (start_ts + timedelta(hours=1)).isoformat()
+        }), 'application/json')
+        response = async_to_sync(async_views.make_reservation)(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ParkingSpotReservation.objects.count(), 1)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_render_histogram(self):
+        histogram = metrics.Histogram('latency_seconds', 'Latency.', ['endpoint'], buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'available')
+        histogram.observe(0.5, 'available')
+        histogram.observe(5, 'available')
+        self.assertEqual(histogram.samples(), [
+            ('latency_seconds_bucket', '{endpoint="available",le="0.1"}', 1),
+            ('latency_seconds_bucket', '{endpoint="available",le="1.0"}', 2),
+            ('latency_seconds_bucket', '{endpoint="available",le="+Inf"}', 3),
+            ('latency_seconds_sum', '{endpoint="available"}', 5.55),
+            ('latency_seconds_count', '{endpoint="available"}', 3),
+        ])
+
+    def test_escape_labels(self):
+        self.assertEqual(metrics.format_labels(('path',), ('a"b\\c',)), '{path="a\\"b\\\\c"}')
+
+
+class MetricsMiddlewareTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+        create_parking_spots()
+
+    def test_records_requests(self):
+        response = self.client.get(reverse('parking:available'),
+                                   {'lat': 37.781533, 'lng': -122.39661, 'radius': 50})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertEqual(metrics.REQUESTS.value('parking:available', 'GET', 200), 1)
+        self.assertEqual(metrics.SQL_QUERIES.count('parking:available'), 1)
+
+        body = self.client.get(reverse('metrics')).content.decode('utf-8')
+        self.assertIn('parking_request_duration_seconds_count{endpoint="parking:available",method="GET"} 1', body)
+        self.assertIn('parking_availability_cache_hits_total', body)
+
+    @override_settings(PARKING_QUERY_BUDGET=0)
+    def test_async_chain(self):
+        async def view(request):
+            return HttpResponse()
+
+        middleware = MetricsMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertEqual(response['X-Query-Count'], '0')
+        self.assertEqual(metrics.REQUESTS.value('unmatched', 'GET', 200), 1)
+
+    def test_query_budget(self):
+        with self.assertLogs('parking.middleware', 'WARNING'):
+            response = self.client.get(reverse('parking:available'),
+                                       {'lat': 37.781533, 'lng': -122.39661, 'radius': 50})
+        self.assertIn('X-Query-Budget-Exceeded', response)
+        self.assertEqual(metrics.QUERY_BUDGET_EXCEEDED.value('parking:available'), 1)
+
+    def test_counts_conflicts(self):
+        start_ts = timezone.now() + timedelta(days=1)
+        payload = json.dumps({
+            'user_id': 1,
+            'parkingspot_id': 1,
+            'start_ts': start_ts.isoformat(),
+            'end_ts': (start_ts + timedelta(hours=1)).isoformat()
+        })
+        self.assertEqual(self.client.post(reverse('parking:reserve'), payload, 'json').status_code, 200)
+        self.assertEqual(self.client.post(reverse('parking:reserve'), payload, 'json').status_code, 400)
+        self.assertEqual(metrics.RESERVATION_CONFLICTS.value('single'), 1)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        create_parking_spots()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def get_available(self, **headers):
+        return self.client.get(reverse('parking:available'),
+                               {'lat': 37.781533, 'lng': -122.39661, 'radius': 50}, **headers)
+
+    def test_sampled_request_is_dumped(self):
+        with override_settings(PARKING_PROFILE_SAMPLE_RATE=1, PARKING_PROFILE_DIR=self.directory):
+            self.assertEqual(self.get_available().status_code, 200)
+        names = sorted(os.listdir(self.directory))
+        self.assertEqual(len(names), 2)
+        with open(os.path.join(self.directory, names[0])) as description:
+            self.assertEqual(json.load(description)['params']['radius'], '50')
+
+        out = io.StringIO()
+        call_command('profile_report', dir=self.directory, endpoint='parking:available', top=10, stdout=out)
+        self.assertIn('1 profiles', out.getvalue())
+        self.assertIn('available', out.getvalue())
+
+    def test_signed_header(self):
+        with override_settings(PARKING_PROFILE_SAMPLE_RATE=0, PARKING_PROFILE_DIR=self.directory):
+            self.get_available(HTTP_X_PARKING_PROFILE='profile:forged')
+            self.assertEqual(os.listdir(self.directory), [])
+            self.get_available(HTTP_X_PARKING_PROFILE=profiling.make_token())
+        self.assertEqual(len(profiling.dumps(self.directory)), 1)
+
+    def test_report_without_profiles(self):
+        with self.assertRaises(CommandError):
+            call_command('profile_report', dir=self.directory, stdout=io.StringIO())
+
+    def test_concurrent_dumps(self):
+        request = RequestFactory().get('/')
+
+        def profile():
+            profiling.dump(cProfile.Profile(), request, 'parking:available', 200, 0.1)
+
+        with override_settings(PARKING_PROFILE_DIR=self.directory):
+            workers = [threading.Thread(target=profile) for _ in range(8)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        self.assertEqual(len(profiling.dumps(self.directory)), 8)
+
+    def test_async_chain(self):
+        async def view(request):
+            return HttpResponse()
+
+        middleware = ProfilingMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        with override_settings(PARKING_PROFILE_SAMPLE_RATE=1, PARKING_PROFILE_DIR=self.directory):
+            async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertEqual(len(profiling.dumps(self.directory)), 1)
+
+
+class LogTests(SimpleTestCase):
+    def make_record(self, level=logging.INFO, msg='Returning %s', args=()):
+        return logging.LogRecord('parking.payloads', level, __file__, 1, msg, args, None)
+
+    def test_background_handler(self):
+        stream = io.StringIO()
+        handler = BackgroundHandler(logging.StreamHandler(stream))
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        try:
+            handler.handle(self.make_record(args=(Summary({'result': [{'id': 1}]}),)))
+            handler.flush()
+            self.assertEqual(stream.getvalue(), 'INFO Returning results=1 ids=[1]\n')
+        finally:
+            handler.close()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_background_handler_in_forked_worker(self):
+        with tempfile.NamedTemporaryFile('r', suffix='.log') as log_file:
+            handler = BackgroundHandler(logging.FileHandler(log_file.name))
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.assertIsNone(handler.listener)
+            handler.handle(self.make_record(msg='parent'))
+            handler.flush()
+            pid = os.fork()
+            if pid == 0:
+                handler.handle(self.make_record(msg='child'))
+                handler.flush()
+                os._exit(0)
+            os.waitpid(pid, 0)
+            handler.close()
+            self.assertEqual(log_file.read(), 'parent\nchild\n')
+
+    def test_sample_filter(self):
+        never = SampleFilter(rate=0)
+        self.assertFalse(never.filter(self.make_record()))
+        self.assertTrue(never.filter(self.make_record(logging.WARNING)))
+        self.assertTrue(SampleFilter(rate=1).filter(self.make_record()))
+
+    def test_summary(self):
+        payload = {
+            'hits': {'offset': 0, 'page_size': 7, 'total': 12, 'next_cursor': 'eyJpZCI6IDd9'},
+            'result': [{'id': spot_id} for spot_id in range(1, 8)]
+        }
+        self.assertEqual(str(Summary(payload)), 'offset=0 page_size=7 total=12 results=7 ids=[1,2,3,4,5,...]')
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite syntax')
+class QueryPlanTests(TestCase):
+    """
+    The hot queries must search indexes, a SCAN of a table reads every row.
+    """
+
+    def setUp(self):
+        create_parking_spots()
+        self.start_ts = timezone.now() + timedelta(days=1)
+        self.end_ts = self.start_ts + timedelta(hours=1)
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        scans = [detail for detail in plan if detail.startswith('SCAN') and 'VIRTUAL TABLE' not in detail
+                 and detail != 'SCAN CONSTANT ROW']
+        self.assertEqual(scans, [], plan)
+        return ' '.join(plan)
+
+    def test_within_range_searches_rtree(self):
+        queryset = ParkingSpot.search(37.781533, -122.39661, 500, use_index=False)
+        self.assertIn('idx_parking_parkingspot_location', self.explain(queryset))
+        self.assertIn('idx_parking_parkingspot_location',
+                      self.explain(ParkingSpot.page(queryset, 0, 10, after_id=1, lean=True)))
+
+    def test_in_ranges_searches_rtree(self):
+        queryset = ParkingSpot.in_ranges([(37.781533, -122.39661, 500), (37.8079996, -122.4177434, 100)],
+                                         use_index=False)
+        self.assertIn('idx_parking_parkingspot_location', self.explain(queryset))
+
+    @override_settings(PARKING_AVAILABILITY_ENGINE=False)
+    def test_available_probes_window_index(self):
+        queryset = ParkingSpot.search(37.781533, -122.39661, 500, self.start_ts, self.end_ts, use_index=False)
+        self.assertIn('reservation_spot_window_idx', self.explain(ParkingSpot.page(queryset, 0, 10)))
+
+    def test_conflict_check_probes_window_index(self):
+        queryset = ParkingSpotReservation.objects.filter(
+            ParkingSpotReservation.overlap_filter(self.start_ts, self.end_ts), parkingspot_id=1)[:1]
+        self.assertIn('reservation_spot_window_idx', self.explain(queryset))
+
+    def test_user_reservations_use_user_index(self):
+        queryset = ParkingSpotReservation.objects.filter(user_id=1).order_by('start_ts')
+        self.assertIn('reservation_user_start_idx', self.explain(queryset))
+
+    def test_hold_release_uses_expiry_index(self):
+        queryset = ParkingSpotReservation.objects.filter(expires_at__lte=timezone.now())
+        self.assertIn('reservation_expires_idx', self.explain(queryset))
+
+
+class ArchiveReservationsTests(TestCase):
+    def setUp(self):
+        create_parking_spots()
+        now = timezone.now().replace(microsecond=0)
+        # save() refuses windows in the past
+        ParkingSpotReservation.objects.bulk_create([
+            ParkingSpotReservation(user_id=1, parkingspot_id=1, start_ts=now - timedelta(days=10 - day),
+                                   end_ts=now - timedelta(days=10 - day, hours=-1))
+            for day in range(3)
+        ] + [
+            ParkingSpotReservation(user_id=2, parkingspot_id=2, start_ts=now - timedelta(days=5),
+                                   end_ts=now - timedelta(days=4)),
+        ])
+        self.future = ParkingSpotReservation(user_id=1, parkingspot_id=1, start_ts=now + timedelta(days=1),
+                                             end_ts=now + timedelta(days=1, hours=1))
+        self.future.save()
+
+    def test_archive(self):
+        out = io.StringIO()
+        call_command('archive_reservations', batch_size=2, stdout=out)
+        self.assertIn('Archived 4 reservations', out.getvalue())
+        self.assertEqual(list(ParkingSpotReservation.objects.values_list('id', flat=True)), [self.future.id])
+        self.assertEqual(ArchivedReservation.objects.count(), 4)
+        self.assertEqual(ArchivedReservation.objects.get(user_id=2).parkingspot_id, 2)
+
+    def test_dry_run(self):
+        out = io.StringIO()
+        call_command('archive_reservations', dry_run=True, stdout=out)
+        self.assertIn('4 reservations', out.getvalue())
+        self.assertEqual(ArchivedReservation.objects.count(), 0)
+
+    def test_before_in_future(self):
+        with self.assertRaises(CommandError):
+            call_command('archive_reservations', before=(timezone.now() + timedelta(days=1)).isoformat())
+
+    def test_history(self):
+        ArchivedReservation.archive(timezone.now())
+
+        history = ParkingSpotReservation.history(1)
+        self.assertEqual([reservation['archived'] for reservation in history], [False, True, True, True])
+        starts = [reservation['start_ts'] for reservation in history]
+        self.assertEqual(starts, sorted(starts, reverse=True))
+
+        response = self.client.get(reverse('parking:history'), {'user_id': 1, 'limit': 2})
+        json_data = json.loads(response.content)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json_data['result'][0]['id'], self.future.id)
+        next_before = json_data['hits']['next_before']
+        self.assertRegex(next_before, r'^[0-9T:.-]+Z,[0-9]+$')
+        # usable as is in a query string, without encoding
+        response = self.client.get('%s?user_id=1&limit=2&before=%s' % (reverse('parking:history'), next_before))
+        self.assertEqual(len(json.loads(response.content)['result']), 2)
+        self.assertTrue(all(reservation['archived'] for reservation in json.loads(response.content)['result']))
+
+    def test_history_pages_through_ties(self):
+        # five reservations starting at the same time, archived and active ones, split over pages of two
+        start_ts = timezone.now().replace(microsecond=0) - timedelta(days=2)
+        ParkingSpotReservation.objects.bulk_create([
+            ParkingSpotReservation(user_id=3, parkingspot_id=spot_id, start_ts=start_ts,
+                                   end_ts=start_ts + timedelta(days=spot_id % 2 * 3, hours=1))
+            for spot_id in range(1, 6)
+        ])
+        ArchivedReservation.archive(timezone.now())
+        expected = [reservation['id'] for reservation in ParkingSpotReservation.history(3)]
+        self.assertEqual(len(expected), 5)
+
+        paged, before = [], None
+        while True:
+            params = {'user_id': 3, 'limit': 2}
+            if before is not None:
+                params['before'] = before
+            json_data = json.loads(self.client.get(reverse('parking:history'), params).content)
+            paged.extend(reservation['id'] for reservation in json_data['result'])
+            before = json_data['hits'].get('next_before')
+            if before is None:
+                break
+        self.assertEqual(paged, expected)
+
+
+class SlotBitmapsTests(SimpleTestCase):
+    def setUp(self):
+        self.bitmaps = slots.SlotBitmaps(use_numpy=False)
+        self.slot = timedelta(seconds=slots.SLOT_SECONDS)
+        self.t0 = self.bitmaps.origin + 4 * self.slot
+
+    def test_ends_conflict(self):
+        self.bitmaps.add(1, 10, self.t0, self.t0 + 2 * self.slot)
+        self.assertEqual(self.bitmaps.free_spots([10, 11], self.t0 + 2 * self.slot, self.t0 + 3 * self.slot), [11])
+        self.assertEqual(self.bitmaps.free_spots([10, 11], self.t0 - self.slot, self.t0), [11])
+        self.assertEqual(self.bitmaps.free_spots([10], self.t0 + 3 * self.slot, self.t0 + 4 * self.slot), [10])
+
+    def test_unaligned_reservation(self):
+        self.bitmaps.add(1, 10, self.t0 + timedelta(minutes=5), self.t0 + timedelta(minutes=10))
+        self.assertEqual(self.bitmaps.free_spots([10], self.t0, self.t0 + self.slot), [])
+        self.assertEqual(self.bitmaps.free_spots([10], self.t0 + self.slot, self.t0 + 2 * self.slot), [10])
+
+    def test_remove(self):
+        self.bitmaps.add(1, 10, self.t0, self.t0 + self.slot)
+        self.bitmaps.add(2, 10, self.t0 + 4 * self.slot, self.t0 + 5 * self.slot)
+        self.bitmaps.remove(1)
+        self.assertEqual(self.bitmaps.free_spots([10], self.t0, self.t0 + self.slot), [10])
+        self.assertEqual(self.bitmaps.free_spots([10], self.t0 + 4 * self.slot, self.t0 + 4 * self.slot), [])
+
+    def test_covers(self):
+        self.assertTrue(self.bitmaps.covers(self.t0, self.t0 + self.slot))
+        self.assertFalse(self.bitmaps.covers(self.t0 + timedelta(minutes=1), self.t0 + self.slot))
+        self.assertFalse(self.bitmaps.covers(self.bitmaps.origin - self.slot, self.t0))
+        self.assertFalse(self.bitmaps.covers(self.t0, self.bitmaps.end + self.slot))
+        with self.assertRaises(ValueError):
+            self.bitmaps.free_spots([10], self.t0 + timedelta(minutes=1), self.t0 + self.slot)
+
+    @unittest.skipIf(slots.numpy is None, 'NumPy is not installed')
+    def test_numpy_matches_ints(self):
+        vectorised = slots.SlotBitmaps(now=self.bitmaps.origin, use_numpy=True)
+        for reservation_id in range(300):
+            start = self.t0 + timedelta(minutes=7 * reservation_id)
+            for bitmaps in (self.bitmaps, vectorised):
+                bitmaps.add(reservation_id, reservation_id % 100, start, start + timedelta(minutes=40))
+        spot_ids = list(range(120))
+        for offset in range(0, 200, 3):
+            start = self.t0 + offset * self.slot
+            self.assertEqual(vectorised.free_spots(spot_ids, start, start + 2 * self.slot),
+                             self.bitmaps.free_spots(spot_ids, start, start + 2 * self.slot))
+
+
+@override_settings(PARKING_SLOT_BITMAPS=True)
+class SlotBitmapsSearchTests(TestCase):
+    def setUp(self):
+        slots.reset_bitmaps()
+        create_parking_spots()
+        self.start_ts = slots.slot_start(timezone.now()) + timedelta(days=1)
+        self.end_ts = self.start_ts + timedelta(hours=1)
+        ParkingSpotReservation(user_id=1, parkingspot_id=1, start_ts=self.start_ts + timedelta(minutes=50),
+                               end_ts=self.end_ts + timedelta(minutes=50)).save()
+
+    def tearDown(self):
+        slots.reset_bitmaps()
+
+    def search(self, start_ts, end_ts):
+        return list(ParkingSpot.search(37.781533, -122.39661, 5000, start_ts, end_ts, use_index=False)
+                    .order_by('id').values_list('id', flat=True))
+
+    def test_aligned_window(self):
+        self.assertEqual(self.search(self.start_ts, self.end_ts), [2, 3, 4, 5])
+        self.assertEqual(len(slots.get_bitmaps()), 1)
+        self.assertEqual(self.search(self.end_ts + timedelta(hours=1), self.end_ts + timedelta(hours=2)),
+                         [1, 2, 3, 4, 5])
+
+    def test_unaligned_window_falls_back(self):
+        self.assertEqual(self.search(self.start_ts + timedelta(minutes=1), self.start_ts + timedelta(minutes=40)),
+                         [1, 2, 3, 4, 5])
+
+    def test_follows_other_processes(self):
+        self.assertEqual(self.search(self.start_ts, self.end_ts), [2, 3, 4, 5])
+        # no post_save, as for a booking made by another worker
+        ParkingSpotReservation.objects.bulk_create([
+            ParkingSpotReservation(user_id=2, parkingspot_id=2, start_ts=self.start_ts, end_ts=self.end_ts),
+        ])
+        self.assertEqual(self.search(self.start_ts, self.end_ts), [3, 4, 5])
+
+
+@override_settings(PARKING_READ_REPLICAS=['replica_0', 'replica_1'])
+class ReadReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = routers.ReadReplicaRouter()
+
+    def tearDown(self):
+        routers.set_state(None)
+
+    def test_reads_go_to_replicas(self):
+        self.assertIn(self.router.db_for_read(ParkingSpot), ['replica_0', 'replica_1'])
+        self.assertEqual(self.router.db_for_write(ParkingSpotReservation), 'default')
+        self.assertFalse(self.router.allow_migrate('replica_0', 'parking'))
+        self.assertTrue(self.router.allow_migrate('default', 'parking'))
+
+    def test_read_your_writes(self):
+        routers.set_state(routers.RoutingState())
+        self.assertNotEqual(self.router.db_for_read(ParkingSpotReservation), 'default')
+        routers.record_write()
+        self.assertEqual(self.router.db_for_read(ParkingSpotReservation), 'default')
+
+        routers.set_state(routers.RoutingState(pinned=True))
+        self.assertEqual(self.router.db_for_read(ParkingSpot), 'default')
+
+    @override_settings(PARKING_READ_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertIsNone(self.router.db_for_read(ParkingSpot))
+
+
+class ReadYourWritesMiddlewareTests(TestCase):
+    def setUp(self):
+        create_parking_spots()
+
+    # the primary doubles as the replica, so the queries run against the test database
+    @override_settings(PARKING_READ_REPLICAS=['default'], PARKING_READ_YOUR_WRITES_SECONDS=5)
+    def test_booking_pins_client(self):
+        response = self.client.get(reverse('parking:available'), {'lat': 37.781533, 'lng': -122.39661, 'radius': 50})
+        self.assertNotIn(ReadYourWritesMiddleware.cookie, response.cookies)
+
+        start_ts = timezone.now() + timedelta(days=1)
+        response = self.client.post(reverse('parking:reserve'), json.dumps({
+            'user_id': 1,
+            'parkingspot_id': 1,
+            'start_ts': start_ts.isoformat(),
+            'end_ts': (start_ts + timedelta(hours=1)).isoformat()
+        }), 'json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.cookies[ReadYourWritesMiddleware.cookie]['max-age'], 5)
+
+    @override_settings(PARKING_READ_REPLICAS=['default'], PARKING_READ_YOUR_WRITES_SECONDS=5)
+    def test_async_chain(self):
+        async def view(request):
+            # the writes of the async views happen in their thread pool
+            await async_views.run_db(routers.record_write)
+            return HttpResponse()
+
+        middleware = ReadYourWritesMiddleware(view)
+        self.assertTrue(iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().post('/'))
+        self.assertEqual(response.cookies[ReadYourWritesMiddleware.cookie]['max-age'], 5)
+
+    def test_sync_replicas_without_replicas(self):
+        with self.assertRaises(CommandError):
+            call_command('sync_replicas', stdout=io.StringIO())
+
+
+@override_settings(PARKING_SHARDS=[('west', ['9q', 'c2']), ('east', ['dr'])])
+class ShardingTests(SimpleTestCase):
+    def tearDown(self):
+        routers.set_state(None)
+
+    def test_geohash(self):
+        self.assertEqual(sharding.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(sharding.encode(37.7749, -122.4194, 5), '9q8yy')
+
+    def test_shard_of_point(self):
+        self.assertEqual(sharding.alias_for_point(37.7749, -122.4194), 'west')
+        self.assertEqual(sharding.alias_for_point(40.7128, -74.0060), 'east')
+        # outside every prefix
+        self.assertEqual(sharding.alias_for_point(51.5074, -0.1278), 'west')
+
+    def test_shards_of_circle(self):
+        self.assertEqual(sharding.aliases_for_circle(37.7749, -122.4194, 1000), ['west'])
+        self.assertEqual(sharding.aliases_for_circle(40.7128, -74.0060, 1000), ['east'])
+        self.assertEqual(sharding.aliases_for_circle(39.0, -98.0, 2000000), ['west', 'east'])
+
+    def test_spot_id_ranges(self):
+        self.assertEqual(sharding.database_for_spot(1), 'west')
+        self.assertEqual(sharding.database_for_spot(sharding.SHARD_ID_SPAN + 1), 'east')
+        self.assertEqual(sharding.id_base('east'), sharding.SHARD_ID_SPAN)
+
+    def test_router(self):
+        router = sharding.ShardRouter()
+        spot = ParkingSpot(location=ParkingSpot.create_point(40.7128, -74.0060))
+        self.assertEqual(router.db_for_write(ParkingSpot, instance=spot), 'east')
+        reservation = ParkingSpotReservation(user_id=1, parkingspot_id=sharding.SHARD_ID_SPAN + 5)
+        self.assertEqual(router.db_for_write(ParkingSpotReservation, instance=reservation), 'east')
+        self.assertIsNone(router.db_for_read(ParkingSpot))
+        with routers.use_database('west'):
+            self.assertEqual(router.db_for_read(ParkingSpot), 'west')
+
+    def test_scatter(self):
+        self.assertEqual(sharding.scatter(routers.current_database, ['west', 'east']), ['west', 'east'])
+        self.assertIsNone(routers.current_database())
+
+
+class ShardedSearchTests(TestCase):
+    """
+    The test database as the only shard, the sharded paths must answer like the plain ones.
+    """
+    shards = [('default', ['9q'])]
+
+    def setUp(self):
+        create_parking_spots()
+        self.start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.end_ts = self.start_ts + timedelta(hours=1)
+        ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=1),
+                                              start_ts=self.start_ts, end_ts=self.end_ts)
+
+    def test_search_matches_unsharded(self):
+        args = (37.781533, -122.39661, 5000, 1, 2, self.start_ts, self.end_ts)
+        total, page = ParkingSpot.within_range(*args, lean=True)
+        expected_nearest = ParkingSpot.nearest(37.781533, -122.39661, 3)
+        with override_settings(PARKING_SHARDS=self.shards):
+            self.assertEqual(ParkingSpot.within_range(*args, lean=True), (total, list(page)))
+            self.assertEqual(ParkingSpot.nearest(37.781533, -122.39661, 3), expected_nearest)
+
+            response = self.client.get(reverse('parking:available'), {
+                'lat': 37.781533, 'lng': -122.39661, 'radius': 5000, 'format': 'ndjson'})
+            self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 5)
+
+    def test_reservations_go_to_shard_of_spot(self):
+        with override_settings(PARKING_SHARDS=self.shards):
+            response = self.client.post(reverse('parking:reserve'), json.dumps({
+                'user_id': 1,
+                'parkingspot_id': 2,
+                'start_ts': self.start_ts.isoformat(),
+                'end_ts': self.end_ts.isoformat()
+            }), 'json')
+            self.assertEqual(response.status_code, 200)
+            results = ParkingSpotReservation.bulk_reserve([(1, 1, self.start_ts, self.end_ts),
+                                                           (1, 3, self.start_ts, self.end_ts)], atomic=False)
+            self.assertIsInstance(results[0], ValidationError)
+            self.assertIsInstance(results[1], ParkingSpotReservation)
+            self.assertEqual([row['parkingspot'] for row in ParkingSpotReservation.history(1)], [3, 2, 1])
+
+    def test_init_shards_without_shards(self):
+        with self.assertRaises(CommandError):
+            call_command('init_shards', stdout=io.StringIO())
+
+
+@unittest.skipUnless('test_shard' in settings.DATABASES, 'needs the test_shard database of parking_demo.test_settings')
+class TwoShardSearchTests(TransactionTestCase):
+    """
+    The spots split over the test database and a second one. The shards are searched in
+    the thread pool, so the test data is committed. Pages merged across the shards must
+    hold the spots of the unsharded search.
+    """
+    databases = {'default', 'test_shard'}
+
+    def setUp(self):
+        create_parking_spots()
+        self.start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.end_ts = self.start_ts + timedelta(hours=1)
+        ParkingSpotReservation.objects.create(user_id=1, parkingspot=ParkingSpot.objects.get(pk=2),
+                                              start_ts=self.start_ts, end_ts=self.end_ts)
+        self.expected = self.search()
+
+        # every other spot goes to the second shard, which owns the geohash of its location
+        prefixes = ([], [])
+        for position, spot in enumerate(ParkingSpot.objects.order_by('id')):
+            prefixes[position % 2].append(sharding.encode(spot.location.y, spot.location.x, 9))
+        self.shards = [('default', prefixes[0]), ('test_shard', prefixes[1])]
+        ParkingSpotReservation.objects.all().delete()
+        ParkingSpot.objects.all().delete()
+        with override_settings(PARKING_SHARDS=self.shards):
+            for alias in sharding.aliases():
+                sharding.seed_id_range(alias)
+            create_parking_spots()
+            spot = ParkingSpot.objects.using('test_shard').get(address='125a Stillman St, San Francisco, CA 94107, USA')
+            ParkingSpotReservation.objects.create(user_id=1, parkingspot=spot,
+                                                  start_ts=self.start_ts, end_ts=self.end_ts)
+
+    def page_through(self, radius, keyset, pagesize=2):
+        rows, offset, after_id = [], 0, None
+        while True:
+            total, page = ParkingSpot.within_range(37.781533, -122.39661, radius, offset, pagesize,
+                                                   self.start_ts, self.end_ts, after_id=after_id, lean=True)
+            rows.extend(page)
+            if len(page) < pagesize:
+                return total, rows
+            if keyset:
+                after_id = page[-1][0]
+            else:
+                offset += pagesize
+
+    def search(self):
+        queries = [batch.SearchQuery(37.781533, -122.39661, 5000, self.start_ts, self.end_ts, 10),
+                   batch.SearchQuery(37.781533, -122.39661, 50, None, None, 10),
+                   batch.SearchQuery(37.8079996, -122.4177434, 5000, None, None, 2)]
+        return {
+            'pages': [self.page_through(radius, keyset) for radius in (50, 5000) for keyset in (False, True)],
+            'nearest': [(spot.address, round(distance, 6))
+                        for spot, distance in ParkingSpot.nearest(37.781533, -122.39661, 3)],
+            'groups': batch.search_group(queries),
+        }
+
+    def test_matches_unsharded(self):
+        self.assertEqual(ParkingSpot.objects.using('test_shard').count(), 2)
+        with override_settings(PARKING_SHARDS=self.shards):
+            found = self.search()
+
+        for (total, rows), (expected_total, expected_rows) in zip(found['pages'], self.expected['pages']):
+            self.assertEqual(total, expected_total)
+            self.assertEqual(sorted(row[3] for row in rows), sorted(row[3] for row in expected_rows))
+            # merged by id, without duplicates at the page boundaries
+            self.assertEqual([row[0] for row in rows], sorted({row[0] for row in rows}))
+        self.assertTrue(any(row[0] > sharding.SHARD_ID_SPAN for row in found['pages'][-1][1]))
+
+        self.assertEqual(found['nearest'], self.expected['nearest'])
+
+        for result, expected in zip(found['groups'], self.expected['groups']):
+            self.assertEqual(result['hits'], expected['hits'])
+            if expected['hits']['total'] <= expected['hits']['page_size']:
+                self.assertEqual(sorted(spot['address'] for spot in result['result']),
+                                 sorted(spot['address'] for spot in expected['result']))
+
+
+class SpotSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spots.bin')
+        rnd = random.Random(5)
+        self.spots = [(spot_id, 37.78 + rnd.uniform(-0.05, 0.05), -122.4 + rnd.uniform(-0.05, 0.05))
+                      for spot_id in range(1, 1001)]
+        self.spots += [(1001, 0.0, 179.9999), (1002, 0.0, -179.9999)]
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def test_matches_grid_index(self):
+        snapshot.write(self.path, self.spots)
+        mapped = snapshot.SpotSnapshot(self.path)
+        index = spatial_index.GridIndex()
+        for spot in self.spots:
+            index.add(*spot)
+
+        self.assertEqual(len(mapped), len(self.spots))
+        for lat, lng, radius in [(37.78, -122.4, 100), (37.78, -122.4, 1000), (37.8, -122.43, 3000),
+                                 (0, -179.9999, 100), (22, -22, 10)]:
+            expected = index.within(lat, lng, radius)
+            found = mapped.within(lat, lng, radius)
+            self.assertEqual([spot_id for spot_id, _ in found], [spot_id for spot_id, _ in expected])
+            for (_, distance), (_, expected_distance) in zip(found, expected):
+                self.assertAlmostEqual(distance, expected_distance)
+
+    def test_new_version_is_picked_up(self):
+        self.assertEqual(snapshot.write(self.path, self.spots[:10]), 1)
+        index = snapshot.SnapshotIndex(self.path, check_seconds=0)
+        self.assertEqual(index.snapshot.version, 1)
+
+        self.assertEqual(snapshot.write(self.path, self.spots), 2)
+        index.refresh()
+        self.assertEqual(index.snapshot.version, 2)
+        self.assertEqual(len(index.snapshot), len(self.spots))
+        # a temporary file is renamed over the snapshot
+        self.assertEqual(os.listdir(self.directory), ['spots.bin'])
+
+    def test_changes_since_the_snapshot(self):
+        snapshot.write(self.path, [(1, 22.0, -22.0), (2, 22.0, -22.00001)])
+        index = snapshot.SnapshotIndex(self.path)
+        index.remove(1)
+        index.add(2, 40.0, -70.0)
+        index.add(3, 22.0, -22.0)
+        self.assertEqual([spot_id for spot_id, _ in index.within(22, -22, 10)], [3])
+        self.assertEqual([spot_id for spot_id, _ in index.within(40, -70, 10)], [2])
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as other:
+            other.write(b'not a snapshot' * 10)
+        with self.assertRaises(ValueError):
+            snapshot.SpotSnapshot(self.path)
+
+
+class SpotSnapshotSearchTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spots.bin')
+        spatial_index.reset_index()
+
+    def tearDown(self):
+        spatial_index.reset_index()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rmdir(self.directory)
+
+    def test_index_searches_snapshot(self):
+        create_parking_spots()
+        call_command('build_spot_snapshot', path=self.path, stdout=io.StringIO())
+
+        with override_settings(PARKING_SPOT_SNAPSHOT=self.path):
+            self.assertIsInstance(spatial_index.get_index(), snapshot.SnapshotIndex)
+            for radius in (10, 100, 5000):
+                indexed = ParkingSpot.in_range(37.781533, -122.39661, radius, use_index=True)
+                scanned = ParkingSpot.in_range(37.781533, -122.39661, radius, use_index=False)
+                self.assertEqual(sorted(indexed.values_list('id', flat=True)),
+                                 sorted(scanned.values_list('id', flat=True)))
+
+            with self.captureOnCommitCallbacks(execute=True):
+                spot = ParkingSpot.objects.create(location=ParkingSpot.create_point(22, -22), address='new')
+            self.assertEqual(list(ParkingSpot.in_range(22, -22, 10, use_index=True)), [spot])
+
+    def test_snapshot_catches_up_with_later_writes(self):
+        create_parking_spots()
+        call_command('build_spot_snapshot', path=self.path, stdout=io.StringIO())
+        self.assertEqual(snapshot.SpotSnapshot(self.path).change_id, SpotChange.objects.latest('id').id)
+        # written by other workers or the admin after the snapshot was built
+        spot = ParkingSpot.objects.create(location=ParkingSpot.create_point(22, -22), address='new')
+        ParkingSpot.objects.filter(pk=1).update(location=ParkingSpot.create_point(40, -70))
+
+        with override_settings(PARKING_SPOT_SNAPSHOT=self.path):
+            self.assertIsInstance(spatial_index.get_index(), snapshot.SnapshotIndex)
+            self.assertEqual(list(ParkingSpot.in_range(22, -22, 10, use_index=True)), [spot])
+            self.assertEqual(list(ParkingSpot.in_range(40, -70, 10, use_index=True).values_list('id', flat=True)),
+                             [1])
+            self.assertNotIn(1, ParkingSpot.in_range(37.781533, -122.39661, 10, use_index=True)
+                             .values_list('id', flat=True))
+
+    def test_snapshot_behind_pruned_changes_is_not_mapped(self):
+        create_parking_spots()
+        call_command('build_spot_snapshot', path=self.path, stdout=io.StringIO())
+        ParkingSpot.objects.bulk_create([ParkingSpot(location=ParkingSpot.create_point(22, -22), address='new'),
+                                         ParkingSpot(location=ParkingSpot.create_point(40, -70), address='new')])
+        SpotChange.prune(timezone.now() + timedelta(minutes=1))
+
+        with override_settings(PARKING_SPOT_SNAPSHOT=self.path):
+            index = spatial_index.get_index()
+            self.assertNotIsInstance(index, snapshot.SnapshotIndex)
+            self.assertEqual(len(index.within(22, -22, 10)), 1)
+
+    def test_command_needs_a_path(self):
+        with self.assertRaises(CommandError):
+            call_command('build_spot_snapshot', stdout=io.StringIO())
+
+
+@unittest.skipUnless(vector_index.is_available(), 'NumPy is not installed')
+class VectorIndexTests(SimpleTestCase):
+    def setUp(self):
+        rnd = random.Random(7)
+        self.spots = [(spot_id, 37.78 + rnd.uniform(-0.05, 0.05), -122.4 + rnd.uniform(-0.05, 0.05))
+                      for spot_id in range(1, 2001)]
+        self.spots += [(2001, 0.0, 179.9999), (2002, 0.0, -179.9999), (2003, 89.9, 10.0)]
+
+    def test_matches_grid_index(self):
+        index = vector_index.VectorIndex.from_spots(self.spots)
+        grid = spatial_index.GridIndex()
+        for spot in self.spots:
+            grid.add(*spot)
+
+        for lat, lng, radius in [(37.78, -122.4, 100), (37.78, -122.4, 1000), (37.8, -122.43, 3000),
+                                 (0, 179.9999, 100), (89.9, -170, 50000), (22, -22, 10)]:
+            expected = grid.within(lat, lng, radius)
+            found = index.within(lat, lng, radius)
+            self.assertEqual([spot_id for spot_id, _ in found], [spot_id for spot_id, _ in expected])
+            for (_, distance), (_, expected_distance) in zip(found, expected):
+                self.assertAlmostEqual(distance, expected_distance, places=6)
+
+    def test_shares_snapshot_memory(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'spots.bin')
+        try:
+            snapshot.write(path, self.spots)
+            mapped = snapshot.SpotSnapshot(path)
+            index = vector_index.VectorIndex.from_snapshot(mapped)
+            self.assertFalse(index.lats.flags.owndata)
+            self.assertEqual(index.within(37.78, -122.4, 1000), mapped.within(37.78, -122.4, 1000))
+            del index, mapped
+        finally:
+            os.remove(path)
+            os.rmdir(directory)
+
+    def test_empty(self):
+        index = vector_index.VectorIndex.from_spots([])
+        self.assertEqual(index.within(37.78, -122.4, 1000), [])
+
+
+@unittest.skipUnless(vector_index.is_available(), 'NumPy is not installed')
+class VectorSearchTests(TestCase):
+    def setUp(self):
+        spatial_index.reset_index()
+
+    def tearDown(self):
+        spatial_index.reset_index()
+
+    def test_matches_distance_lookup(self):
+        rnd = random.Random(11)
+        ParkingSpot.objects.bulk_create(
+            ParkingSpot(location=ParkingSpot.create_point(37.78 + rnd.uniform(-0.02, 0.02),
+                                                          -122.4 + rnd.uniform(-0.02, 0.02)),
+                        address='spot %s' % number)
+            for number in range(500))
+        self.assertIsInstance(spatial_index.get_index().base, vector_index.VectorIndex)
+
+        for radius in (50, 300, 1000):
+            indexed = set(ParkingSpot.in_range(37.78, -122.4, radius, use_index=True).values_list('id', flat=True))
+            scanned = set(ParkingSpot.in_range(37.78, -122.4, radius, use_index=False).values_list('id', flat=True))
+            # haversine is spherical, the distance lookup ellipsoidal: they only disagree at the edge
+            for spot in ParkingSpot.objects.filter(id__in=indexed ^ scanned):
+                distance = spatial_index.haversine_meters(37.78, -122.4, spot.location.y, spot.location.x)
+                self.assertAlmostEqual(distance / radius, 1, delta=0.005)
+
+    def test_page_with_distances(self):
+        create_parking_spots()
+        _, page = ParkingSpot.within_range(37.781533, -122.39661, 100, 0, 10, use_index=True,
+                                           lean=True, with_distance=True)
+        self.assertEqual([row[0] for row in page], [1, 2, 3])
+        self.assertEqual(page[0][4], 0)
+        self.assertTrue(all(0 < row[4] <= 100 for row in page[1:]))
+
+        _, page = ParkingSpot.within_range(37.781533, -122.39661, 100, 0, 10, use_index=True, with_distance=True)
+        rows = ParkingSpot.lean_values(ParkingSpot.objects.filter(id__in=[1, 2, 3]).order_by('id'))
+        self.assertEqual([spot.distance for spot in page],
+                         [row[4] for row in ParkingSpot.add_distances(37.781533, -122.39661, rows, lean=True)])
+
+
+class HoldTests(TestCase):
+    def setUp(self):
+        holds.reset_expiry()
+        availability.reset_engine()
+        create_parking_spots()
+        self.spot = ParkingSpot.objects.get(pk=1)
+        self.start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.end_ts = self.start_ts + timedelta(hours=1)
+
+    def tearDown(self):
+        holds.reset_expiry()
+        availability.reset_engine()
+
+    def available_ids(self):
+        _, spots = ParkingSpot.within_range(37.781533, -122.39661, 50, 0, 10, self.start_ts, self.end_ts,
+                                            use_index=False)
+        return [spot.id for spot in spots]
+
+    def test_hold_takes_the_window(self):
+        hold = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts)
+        self.assertEqual(len(hold.hold_token), 32)
+        self.assertNotIn(self.spot.id, self.available_ids())
+
+        with self.assertRaises(ValidationError):
+            ParkingSpotReservation.objects.create(user_id=2, parkingspot=self.spot,
+                                                  start_ts=self.start_ts + timedelta(minutes=30),
+                                                  end_ts=self.end_ts + timedelta(minutes=30))
+        with self.assertRaises(ValidationError):
+            ParkingSpotReservation.hold(2, self.spot, self.start_ts, self.end_ts)
+        results = ParkingSpotReservation.bulk_reserve([(2, self.spot.id, self.start_ts, self.end_ts)])
+        self.assertIsInstance(results[0], ValidationError)
+        # holds are not part of the history
+        self.assertEqual(ParkingSpotReservation.history(1), [])
+
+    def test_confirm(self):
+        hold = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts)
+        with self.assertRaises(ValidationError):
+            ParkingSpotReservation.confirm(hold.id, 'not the token')
+
+        reservation = ParkingSpotReservation.confirm(hold.id, hold.hold_token)
+        self.assertEqual((reservation.id, reservation.hold_token, reservation.expires_at), (hold.id, None, None))
+        self.assertEqual([row['id'] for row in ParkingSpotReservation.history(1)], [hold.id])
+        with self.assertRaises(ValidationError):
+            ParkingSpotReservation.confirm(hold.id, hold.hold_token)
+
+        # a confirmed hold stays in the heap, its release deletes nothing
+        self.assertEqual(holds.get_expiry().release_due(hold.expires_at + timedelta(seconds=1)), 0)
+        self.assertTrue(ParkingSpotReservation.objects.filter(pk=hold.id).exists())
+
+    def test_expired_hold_frees_the_window(self):
+        hold = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts, ttl_seconds=60)
+        ParkingSpotReservation.objects.filter(pk=hold.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        # ignored before it is released
+        self.assertIn(self.spot.id, self.available_ids())
+        with self.assertRaises(ValidationError):
+            ParkingSpotReservation.confirm(hold.id, hold.hold_token)
+        other = ParkingSpotReservation.hold(2, self.spot, self.start_ts, self.end_ts)
+        self.assertEqual(ParkingSpotReservation.history(1), [])
+
+        expiry = holds.get_expiry()
+        self.assertEqual(expiry.release_due(hold.expires_at - timedelta(seconds=1)), 0)
+        self.assertEqual(expiry.release_due(hold.expires_at + timedelta(seconds=1)), 1)
+        self.assertEqual(list(ParkingSpotReservation.objects.values_list('id', flat=True)), [other.id])
+
+    def test_zero_ttl_is_not_the_default(self):
+        hold = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts, ttl_seconds=0)
+        self.assertLessEqual(hold.expires_at, timezone.now())
+        self.assertIn(self.spot.id, self.available_ids())
+
+    @override_settings(PARKING_AVAILABILITY_ENGINE=True, PARKING_SLOT_BITMAPS=True)
+    def test_expired_hold_frees_the_engine_and_bitmaps(self):
+        slots.reset_bitmaps()
+        self.addCleanup(slots.reset_bitmaps)
+        start_ts = slots.slot_start(timezone.now()) + timedelta(days=1)
+        end_ts = start_ts + timedelta(hours=1)
+        hold = ParkingSpotReservation.hold(1, self.spot, start_ts, end_ts, ttl_seconds=60)
+        self.assertFalse(availability.get_engine().is_free(self.spot.id, start_ts, end_ts))
+        self.assertEqual(slots.get_bitmaps().free_spots([self.spot.id], start_ts, end_ts), [])
+
+        # expired, but not released yet
+        with mock.patch('django.utils.timezone.now', return_value=hold.expires_at + timedelta(seconds=1)):
+            self.assertTrue(availability.get_engine().is_free(self.spot.id, start_ts, end_ts))
+            self.assertEqual(slots.get_bitmaps().free_spots([self.spot.id], start_ts, end_ts), [self.spot.id])
+            _, spots = ParkingSpot.within_range(37.781533, -122.39661, 50, 0, 10, start_ts, end_ts, use_index=False)
+            self.assertIn(self.spot.id, [spot.id for spot in spots])
+            ParkingSpotReservation.objects.create(user_id=2, parkingspot=self.spot, start_ts=start_ts, end_ts=end_ts)
+
+    @override_settings(PARKING_AVAILABILITY_ENGINE=True)
+    def test_release_frees_the_engine(self):
+        engine = availability.get_engine()
+        with self.captureOnCommitCallbacks(execute=True):
+            hold = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts)
+        self.assertFalse(engine.is_free(self.spot.id, self.start_ts, self.end_ts))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            holds.get_expiry().release_due(hold.expires_at)
+        self.assertTrue(engine.is_free(self.spot.id, self.start_ts, self.end_ts))
+
+    def test_pending_holds_are_scheduled(self):
+        first = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts, ttl_seconds=60)
+        second = ParkingSpotReservation.hold(1, ParkingSpot.objects.get(pk=2), self.start_ts, self.end_ts,
+                                             ttl_seconds=30)
+        expiry = holds.build_expiry()
+        self.assertEqual(len(expiry), 2)
+        self.assertEqual(expiry.pop_due(second.expires_at), {'default': [second.id]})
+        self.assertEqual(expiry.pop_due(first.expires_at), {'default': [first.id]})
+        self.assertEqual(len(expiry), 0)
+
+    def test_archive_releases_expired_holds(self):
+        hold = ParkingSpotReservation.hold(1, self.spot, self.start_ts, self.end_ts)
+        ParkingSpotReservation.objects.filter(pk=hold.id).update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = io.StringIO()
+        call_command('archive_reservations', stdout=out)
+        self.assertIn('1 expired holds released', out.getvalue())
+        self.assertFalse(ParkingSpotReservation.objects.exists())
+
+
+class HoldViewTests(TestCase):
+    def setUp(self):
+        holds.reset_expiry()
+        create_parking_spots()
+        start_ts = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        self.payload = {
+            "user_id": 1,
+            "parkingspot_id": 1,
+            "start_ts": start_ts.isoformat(),
+            "end_ts": (start_ts + timedelta(hours=1)).isoformat()
+        }
+
+    def tearDown(self):
+        holds.reset_expiry()
+
+    def test_hold_and_confirm(self):
+        response = self.client.post(reverse('parking:hold'), json.dumps(dict(self.payload, ttl_seconds=30)), 'json')
+        self.assertEqual(response.status_code, 200)
+        hold = json.loads(response.content)['hold']
+        expires_at = parse_datetime(hold['expires_at'])
+        self.assertLessEqual(expires_at, timezone.now() + timedelta(seconds=30))
+
+        response = self.client.post(reverse('parking:reserve'), json.dumps(self.payload), 'json')
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(reverse('parking:confirm_hold'),
+                                    json.dumps({'id': hold['id'], 'token': hold['token']}), 'json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['parkingspot_reservation']['id'], hold['id'])
+
+        response = self.client.post(reverse('parking:confirm_hold'),
+                                    json.dumps({'id': hold['id'], 'token': hold['token']}), 'json')
+        self.assertEqual(response.status_code, 409)
+
+    def test_invalid_holds(self):
+        response = self.client.post(reverse('parking:hold'), json.dumps(dict(self.payload, parkingspot_id=99)),
+                                    'json')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post(reverse('parking:hold'), json.dumps(dict(self.payload, ttl_seconds=0)), 'json')
+        self.assertEqual(response.status_code, 400)
+        for invalid in ({'user_id': 'one'}, {'parkingspot_id': 'one'}, {'parkingspot_id': None},
+                        {'start_ts': (timezone.now() + timedelta(days=1)).replace(tzinfo=None).isoformat()}):
+            response = self.client.post(reverse('parking:hold'), json.dumps(dict(self.payload, **invalid)), 'json')
+            self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('parking:confirm_hold'), json.dumps({'id': 'one'}), 'json')
+        self.assertEqual(response.status_code, 400)
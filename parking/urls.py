@@ -1,19 +1,45 @@
 
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
+if getattr(settings, 'PARKING_ASYNC_VIEWS', False):
+    # same endpoints, served by coroutines under ASGI
+    from . import async_views as views  # noqa: F811
+
 app_name = 'parking'
 
 urlpatterns = [
     # list parking spots given lat, lng, radius in meters
     path('v1/parking_spots/available', views.available, name='available'),
 
+    # available parking spots for many lat, lng, radius, start_ts, end_ts queries at once
+    # post with json request body
+    path('v1/parking_spots/available/batch', views.batch_available, name='batch_available'),
+
+    # k closest parking spots given lat, lng, optionally available between start_ts and end_ts
+    path('v1/parking_spots/nearest', views.nearest, name='nearest'),
+
     # reserve parking spot given a time slot, parking spot id and user id
     # put with json request body
     path('v1/parking_spots/reserve', views.make_reservation, name='reserve'),
 
-    # view existing reservations given a user id
+    # hold a parking spot for a time slot until the hold expires, returns the hold id and token
+    # post with json request body
+    path('v1/parking_spots/hold', views.hold_reservation, name='hold'),
+
+    # turn a hold into a reservation given its id and token
+    # post with json request body
+    path('v1/parking_spots/hold/confirm', views.confirm_hold, name='confirm_hold'),
+
+    # reserve many parking spots in one transaction, all or nothing (atomic) or partial
+    # post with json request body
+    path('v1/parking_spots/reserve/bulk', views.bulk_reservation, name='bulk_reserve'),
+
+    # reservations of a user given a user id, newest first, including the archived ones
+    path('v1/reservations/history', views.history, name='history'),
+
     # cancel existing reservation given a user id and parking id
     # show the user the cost of the reservation
 
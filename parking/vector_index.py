@@ -0,0 +1,99 @@
+"""
+Vectorised radius search over the spot coordinates held in contiguous NumPy arrays.
+
+The arrays are in the layout of the spot snapshot, sorted into bands of projected y, so
+the bands of a circle's bounding box are one contiguous slice. The slice is narrowed by
+a lat/lng box mask and the haversine distance of the remaining spots is computed in
+one batch. Over a mapped snapshot the arrays are views of the file, nothing is copied.
+"""
+import math
+
+from parking import snapshot
+from parking.spatial_index import EARTH_RADIUS_METERS, bounding_box
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def haversine_meters(lat, lng, lats, lngs):
+    """
+    Great circle distances in meters from the point to every point of the arrays.
+    """
+    phi = numpy.radians(lats)
+    phi1 = math.radians(lat)
+    a = numpy.sin((phi - phi1) / 2) ** 2 + \
+        math.cos(phi1) * numpy.cos(phi) * numpy.sin(numpy.radians(lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+class VectorIndex():
+    def __init__(self, ids, lats, lngs, bands, starts, band_meters=snapshot.BAND_METERS):
+        self.ids = ids
+        self.lats = lats
+        self.lngs = lngs
+        self.bands = bands
+        self.starts = starts
+        self.band_meters = band_meters
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_snapshot(cls, spot_snapshot):
+        """
+        Arrays sharing the memory of a SpotSnapshot.
+        """
+        return cls(numpy.frombuffer(spot_snapshot.ids, dtype='<i8'),
+                   numpy.frombuffer(spot_snapshot.lats, dtype='<f8'),
+                   numpy.frombuffer(spot_snapshot.lngs, dtype='<f8'),
+                   numpy.frombuffer(spot_snapshot.bands, dtype='<i8'),
+                   numpy.frombuffer(spot_snapshot.starts, dtype='<i8'),
+                   spot_snapshot.band_meters)
+
+    @classmethod
+    def from_spots(cls, spots):
+        """
+        :param spots: iterable of (id, lat, lng)
+        """
+        ids, lats, lngs, _, _, bands, starts = snapshot.layout(spots)
+        return cls(numpy.array(ids, dtype=numpy.int64), numpy.array(lats, dtype=numpy.float64),
+                   numpy.array(lngs, dtype=numpy.float64), numpy.array(bands, dtype=numpy.int64),
+                   numpy.array(starts, dtype=numpy.int64))
+
+    def search(self, lat, lng, radius_meters):
+        """
+        Spots inside the circle, closest first.
+
+        :return: arrays of the ids and the distances in meters
+        """
+        min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_meters)
+        first = numpy.searchsorted(self.bands, math.floor(snapshot.project(min_lat, 0)[1] / self.band_meters))
+        last = numpy.searchsorted(self.bands, math.floor(snapshot.project(max_lat, 0)[1] / self.band_meters),
+                                  side='right')
+        low, high = self.starts[first], self.starts[last]
+
+        lats, lngs = self.lats[low:high], self.lngs[low:high]
+        mask = (lats >= min_lat) & (lats <= max_lat)
+        if max_lng - min_lng < 360:
+            # longitude offsets wrapped to [-180, 180), so boxes crossing the antimeridian need no special case
+            mask &= numpy.abs((lngs - lng + 180.0) % 360.0 - 180.0) <= (max_lng - min_lng) / 2
+        candidates = numpy.flatnonzero(mask) + low
+
+        distances = haversine_meters(lat, lng, self.lats[candidates], self.lngs[candidates])
+        inside = distances <= radius_meters
+        ids, distances = self.ids[candidates[inside]], distances[inside]
+        order = numpy.lexsort((ids, distances))
+        return ids[order], distances[order]
+
+    def within(self, lat, lng, radius_meters):
+        """
+        :return: list of (spot_id, distance in meters), closest first
+        """
+        ids, distances = self.search(lat, lng, radius_meters)
+        return list(zip(ids.tolist(), distances.tolist()))
+
+
+def is_available():
+    return numpy is not None
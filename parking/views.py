@@ -1,59 +1,258 @@
+import base64
+import binascii
 import json
 import logging
+from collections import namedtuple
+from datetime import timezone as dt_timezone
 
-from django.core import serializers
 from django.core.exceptions import ValidationError
 from django.forms.models import model_to_dict
-from django.http import JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
+from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.views.decorators.csrf import csrf_exempt
 
+from parking import availability_cache, batch, metrics, sharding
+from parking.log import Summary
 from parking.models import ParkingSpot, ParkingSpotReservation
 
 logger = logging.getLogger(__name__)
 
+# response payload summaries, sampled by the logging config
+payload_logger = logging.getLogger('parking.payloads')
 
-def available(request):
-    if request.method != 'GET':
-        raise Http404()
+MAX_NEAREST = 100
+
+MAX_BATCH_QUERIES = 500
+
+MAX_BULK_RESERVATIONS = 500
+
+MAX_HISTORY = 200
+
+MAX_HOLD_SECONDS = 900
+
+STREAM_CHUNK_SIZE = 2000
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode('utf-8')).decode('ascii')
 
+
+def decode_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))['id'])
+    except (ValueError, KeyError, TypeError, UnicodeError, binascii.Error):
+        raise ValidationError('Invalid cursor.')
+
+
+AvailableQuery = namedtuple('AvailableQuery', 'lat lng radius offset pagesize start_ts end_ts after_id with_total '
+                                               'stream')
+
+
+def parse_available(request):
     lat, lng, radius, offset, pagesize, start_ts, end_ts = float(request.GET['lat']), \
                                                            float(request.GET['lng']), \
                                                            float(request.GET['radius']), \
                                                            int(request.GET.get('offset', 0)), \
-                                                           int(request.GET.get('pagesize', 10)), \
+                                                           int(request.GET.get('page_size',
+                                                                               request.GET.get('pagesize', 10))), \
                                                            request.GET.get('start_ts', None), \
                                                            request.GET.get('end_ts', None)
 
+    if offset < 0 or pagesize < 0:
+        raise ValidationError('offset and page_size must not be negative.')
+
+    if start_ts is not None and end_ts is not None:
+        start_ts = parse_datetime(start_ts)
+        end_ts = parse_datetime(end_ts)
+
+    # keyset pagination: a cursor replaces the offset, and skips the COUNT unless asked for
+    cursor = request.GET.get('cursor')
+    after_id = decode_cursor(cursor) if cursor else None
+    if after_id is not None:
+        offset = 0
+
+    stream = request.GET.get('format') == 'ndjson'
+    if stream and 'page_size' not in request.GET and 'pagesize' not in request.GET:
+        pagesize = None
+
+    with_total = request.GET.get('total', 'false' if after_id is not None else 'true').lower() == 'true'
+
+    return AvailableQuery(lat, lng, radius, offset, pagesize, start_ts, end_ts, after_id, with_total, stream)
+
+
+def search_available(query):
+    """
+    Total and (id, lng, lat, address) rows of an available search, one more row than the
+    page size when a next page exists. The sync and the async view both search with it.
+    """
+    return availability_cache.within_range(query.lat, query.lng, query.radius, query.offset, query.pagesize + 1,
+                                           query.start_ts, query.end_ts, after_id=query.after_id,
+                                           with_total=query.with_total, lean=True)
+
+
+def count_available(query):
+    """
+    The total of an available search alone, for the async view running it next to the page.
+    """
+    return ParkingSpot.search(query.lat, query.lng, query.radius, query.start_ts, query.end_ts).count()
+
+
+def available_response(query, total, rows):
+    """
+    :param rows: (id, lng, lat, address) rows, one more than the page size when a next page exists
+    """
+    result_set = [{
+        'id': spot_id,
+        'lng': spot_lng,
+        'lat': spot_lat,
+        'address': address
+    } for spot_id, spot_lng, spot_lat, address in rows]
+
+    hits = {
+        'offset': query.offset,
+        'page_size': min(len(result_set), query.pagesize),
+    }
+    if query.with_total:
+        hits['total'] = total
+    if len(result_set) > query.pagesize:
+        result_set = result_set[:query.pagesize]
+        if result_set:
+            hits['next_cursor'] = encode_cursor(result_set[-1]['id'])
+
+    response = {
+        'hits': hits,
+        'result': result_set
+    }
+    payload_logger.info('Returning %s', Summary(response))
+    return JsonResponse(response)
+
+
+def available(request):
+    if request.method != 'GET':
+        raise Http404()
+
+    try:
+        query = parse_available(request)
+    except ValidationError as validationerr:
+        return JsonResponse({
+            'exception': validationerr.message
+        }, status=400)
+
+    if query.stream:
+        return stream_available(query)
+
+    logger.debug('Getting the available parking spots at %s %s %s between %s and %s!',
+                 query.lat, query.lng, query.radius, query.start_ts, query.end_ts)
+
+    total, rows = search_available(query)
+    return available_response(query, total, rows)
+
+
+def stream_available(query):
+    """
+    One JSON object per line, written while the rows are read in chunks, so memory and
+    time to first byte don't depend on the size of the area. Streams every match
+    unless a page size is given. Sharded spots are merged in memory first.
+    """
+    logger.debug('Streaming the available parking spots at %s %s %s between %s and %s!',
+                 query.lat, query.lng, query.radius, query.start_ts, query.end_ts)
+
+    _, rows = ParkingSpot.within_range(query.lat, query.lng, query.radius, query.offset, query.pagesize,
+                                       query.start_ts, query.end_ts,
+                                       after_id=query.after_id, with_total=False, lean=True)
+
+    if not isinstance(rows, list):
+        rows = rows.iterator(chunk_size=STREAM_CHUNK_SIZE)
+
+    return StreamingHttpResponse((ndjson_line(row) for row in rows), content_type='application/x-ndjson')
+
+
+def ndjson_line(row):
+    spot_id, spot_lng, spot_lat, address = row
+    return json.dumps({'id': spot_id, 'lng': spot_lng, 'lat': spot_lat, 'address': address}) + '\n'
+
+
+def nearest(request):
+    if request.method != 'GET':
+        raise Http404()
+
+    lat, lng, k, start_ts, end_ts = float(request.GET['lat']), \
+                                    float(request.GET['lng']), \
+                                    min(int(request.GET.get('k', 10)), MAX_NEAREST), \
+                                    request.GET.get('start_ts', None), \
+                                    request.GET.get('end_ts', None)
+    max_radius = float(request.GET.get('max_radius', 50000))
+
     if start_ts is not None and end_ts is not None:
         start_ts = parse_datetime(start_ts)
         end_ts = parse_datetime(end_ts)
 
-    logger.debug('Getting the available parking spots at %s %s %s between %s and %s!' % (
-        lat, lng, radius, start_ts, end_ts))
+    logger.debug('Getting the %s nearest parking spots to %s %s between %s and %s!',
+                 k, lat, lng, start_ts, end_ts)
 
-    total, query_result_set = ParkingSpot.within_range(lat, lng, radius, offset, pagesize, start_ts, end_ts)
     result_set = []
-    for result in query_result_set:
+    for spot, distance in ParkingSpot.nearest(lat, lng, k, start_ts, end_ts, max_radius_meters=max_radius):
         result_set.append({
-            'id': result.id,
-            'lng': result.location.x,
-            'lat': result.location.y,
-            'address': result.address
+            'id': spot.id,
+            'lng': spot.location.x,
+            'lat': spot.location.y,
+            'address': spot.address,
+            'distance': distance
         })
 
     response = {
         'hits': {
-            'offset': 0,
-            'page_size': len(result_set),
-            'total': total
+            'page_size': len(result_set)
         },
         'result': result_set
     }
-    logger.info(response)
+    payload_logger.info('Returning %s', Summary(response))
     return JsonResponse(response)
 
 
+def parse_batch(request):
+    """
+    :return: the list of batch.SearchQuery of the request body
+    """
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        queries = []
+        for query in body['queries']:
+            start_ts, end_ts = query.get('start_ts'), query.get('end_ts')
+            if start_ts is not None and end_ts is not None:
+                start_ts, end_ts = parse_datetime(start_ts), parse_datetime(end_ts)
+            queries.append(batch.SearchQuery(float(query['lat']), float(query['lng']), float(query['radius']),
+                                             start_ts, end_ts, int(query.get('page_size', 10))))
+    except (ValueError, KeyError, TypeError) as exc:
+        raise ValidationError('Invalid queries: %s' % exc)
+
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise ValidationError('At most %s queries per batch.' % MAX_BATCH_QUERIES)
+    if any(query.page_size < 0 for query in queries):
+        raise ValidationError('page_size must not be negative.')
+    return queries
+
+
+@csrf_exempt
+def batch_available(request):
+    if request.method != 'POST':
+        raise Http404()
+
+    try:
+        queries = parse_batch(request)
+    except ValidationError as validationerr:
+        return JsonResponse({
+            'exception': validationerr.message
+        }, status=400)
+
+    logger.debug('Searching available parking spots for %s locations', len(queries))
+
+    return JsonResponse({
+        'results': batch.search(queries)
+    })
+
+
 @csrf_exempt
 def make_reservation(request):
     if request.method != 'POST':
@@ -61,7 +260,6 @@ def make_reservation(request):
 
     try:
         body_unicode = request.body.decode('utf-8')
-        logger.info(body_unicode)
         body = json.loads(body_unicode)
 
         user_id = body['user_id']
@@ -69,12 +267,11 @@ def make_reservation(request):
         start = parse_datetime(body['start_ts'])
         end = parse_datetime(body['end_ts'])
 
-        logger.info('incoming parameters %s' % body)
-
-        logger.debug('Comparing start "%s" end "%s"' % (start, end))
+        logger.debug('Reserving parking spot %s for user %s between %s and %s', parkingspot_id, user_id, start, end)
 
+        parkingspot = ParkingSpot.objects.using(sharding.database_for_spot(parkingspot_id)).get(pk=parkingspot_id)
         parkingspot_reservation = ParkingSpotReservation(user_id=user_id,
-                                                         parkingspot=(ParkingSpot.objects.get(pk=parkingspot_id)),
+                                                         parkingspot=parkingspot,
                                                          start_ts=start,
                                                          end_ts=end)
 
@@ -82,9 +279,11 @@ def make_reservation(request):
 
         return JsonResponse({
             # TODO change this to provide the proper lat, long json data structure
-            # POINT is not JSON serializable when model_to_dict is used
-            'parkingspot': json.loads(serializers.serialize('json', [
-                (ParkingSpot.objects.get(pk=parkingspot_id)), ]))[0]['fields'],
+            # same fields as serializers.serialize('json', [parkingspot]), without reloading the spot
+            'parkingspot': {
+                'location': str(parkingspot.location),
+                'address': parkingspot.address
+            },
             'parkingspot_reservation': model_to_dict(parkingspot_reservation),
         })
     except ValidationError as validationerr:
@@ -103,3 +302,197 @@ def make_reservation(request):
         return JsonResponse({
             'exception': exc.message
         }, status=400)
+
+
+def parse_booking(item):
+    """
+    :param item: dict with the user_id, parkingspot_id, start_ts and end_ts of a booking
+    :return: (user id, parking spot id, start, end)
+    :raises ValueError, KeyError, TypeError: for a malformed item
+    """
+    user_id, parkingspot_id = int(item['user_id']), int(item['parkingspot_id'])
+    start, end = parse_datetime(item['start_ts']), parse_datetime(item['end_ts'])
+    if start is None or end is None:
+        raise ValueError('start_ts and end_ts must be datetimes')
+    # naive datetimes can't be compared with the aware ones of validate_window
+    if timezone.is_naive(start) or timezone.is_naive(end):
+        raise ValueError('start_ts and end_ts need a time zone offset')
+    return user_id, parkingspot_id, start, end
+
+
+@csrf_exempt
+def hold_reservation(request):
+    """
+    Hold a parking spot for a window, the hold is confirmed with its id and token
+    before it expires.
+    """
+    if request.method != 'POST':
+        raise Http404()
+
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        user_id, parkingspot_id, start, end = parse_booking(body)
+        ttl_seconds = min(int(body['ttl_seconds']), MAX_HOLD_SECONDS) if 'ttl_seconds' in body else None
+        if ttl_seconds is not None and ttl_seconds <= 0:
+            raise ValueError('ttl_seconds must be positive')
+    except (ValueError, KeyError, TypeError) as exc:
+        return JsonResponse({
+            'exception': 'Invalid hold: %s' % exc
+        }, status=400)
+
+    logger.debug('Holding parking spot %s for user %s between %s and %s', parkingspot_id, user_id, start, end)
+
+    try:
+        parkingspot = ParkingSpot.objects.using(sharding.database_for_spot(parkingspot_id)).get(pk=parkingspot_id)
+        reservation = ParkingSpotReservation.hold(user_id, parkingspot, start, end, ttl_seconds)
+    except ValidationError as validationerr:
+        return JsonResponse({
+            'exception': validationerr.message
+        }, status=400)
+    except ParkingSpot.DoesNotExist:
+        return JsonResponse({
+            'exception': 'Parking spot not available.'
+        }, status=404)
+
+    return JsonResponse({
+        'parkingspot': {
+            'location': str(parkingspot.location),
+            'address': parkingspot.address
+        },
+        'hold': {
+            'id': reservation.id,
+            'token': reservation.hold_token,
+            'parkingspot': parkingspot.id,
+            'start_ts': reservation.start_ts,
+            'end_ts': reservation.end_ts,
+            'expires_at': reservation.expires_at
+        }
+    })
+
+
+@csrf_exempt
+def confirm_hold(request):
+    if request.method != 'POST':
+        raise Http404()
+
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        reservation_id, token = int(body['id']), str(body['token'])
+    except (ValueError, KeyError, TypeError) as exc:
+        return JsonResponse({
+            'exception': 'Invalid confirmation: %s' % exc
+        }, status=400)
+
+    logger.debug('Confirming hold %s', reservation_id)
+
+    try:
+        reservation = ParkingSpotReservation.confirm(reservation_id, token)
+    except ValidationError as validationerr:
+        return JsonResponse({
+            'exception': validationerr.message
+        }, status=409)
+
+    return JsonResponse({
+        'parkingspot_reservation': model_to_dict(reservation),
+    })
+
+
+@csrf_exempt
+def bulk_reservation(request):
+    if request.method != 'POST':
+        raise Http404()
+
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        mode = body.get('mode', 'atomic')
+        if mode not in ('atomic', 'partial'):
+            raise ValueError('mode must be atomic or partial')
+        reservations = list(body['reservations'])
+    except (ValueError, KeyError, TypeError) as exc:
+        return JsonResponse({
+            'exception': 'Invalid reservations: %s' % exc
+        }, status=400)
+
+    if len(reservations) > MAX_BULK_RESERVATIONS:
+        return JsonResponse({
+            'exception': 'At most %s reservations per request.' % MAX_BULK_RESERVATIONS
+        }, status=400)
+
+    # a malformed item fails on its own, like an unavailable one
+    items, invalid = {}, {}
+    for position, item in enumerate(reservations):
+        try:
+            items[position] = parse_booking(item)
+        except (ValueError, KeyError, TypeError) as exc:
+            invalid[position] = ValidationError('Invalid reservation: %s' % exc)
+
+    logger.debug('Reserving %s parking spots in %s mode', len(items), mode)
+
+    outcomes = dict(invalid)
+    if not invalid or mode == 'partial':
+        outcomes.update(zip(items, ParkingSpotReservation.bulk_reserve(list(items.values()),
+                                                                        atomic=(mode == 'atomic'))))
+
+    results = []
+    for position in range(len(reservations)):
+        result = outcomes.get(position)
+        if isinstance(result, ParkingSpotReservation):
+            results.append({'parkingspot_reservation': model_to_dict(result)})
+        elif result is None:
+            results.append({'exception': 'Batch rejected.'})
+        else:
+            results.append({'exception': result.message})
+
+    failed = any('exception' in result for result in results)
+    return JsonResponse({
+        'mode': mode,
+        'reserved': sum('parkingspot_reservation' in result for result in results),
+        'results': results
+    }, status=400 if failed and mode == 'atomic' else 200)
+
+
+def history(request):
+    """
+    A user's reservations, newest first, including the archived ones. Pages are
+    linked by `next_before`, the start in UTC and the id of the last reservation returned,
+    so reservations starting at the same time are not skipped between pages.
+    """
+    if request.method != 'GET':
+        raise Http404()
+
+    try:
+        user_id = int(request.GET['user_id'])
+        limit = min(int(request.GET.get('limit', 50)), MAX_HISTORY)
+        before_ts, before_id = request.GET.get('before'), None
+        if before_ts is not None:
+            # <start_ts>,<id> as returned in next_before, or a datetime alone
+            if ',' in before_ts:
+                before_ts, before_id = before_ts.rsplit(',', 1)
+                before_id = int(before_id)
+            before_ts = parse_datetime(before_ts)
+            if before_ts is None:
+                raise ValueError('before must be a datetime')
+    except (ValueError, KeyError) as exc:
+        return JsonResponse({
+            'exception': 'Invalid parameters: %s' % exc
+        }, status=400)
+
+    logger.debug('Getting the reservations of user %s before %s', user_id, before_ts)
+
+    reservations = ParkingSpotReservation.history(user_id, limit, before_ts, before_id)
+    response = {
+        'hits': {
+            'page_size': len(reservations)
+        },
+        'result': reservations
+    }
+    if len(reservations) == limit:
+        # a Z suffix rather than +00:00, which a query string would decode to a space
+        start_ts = reservations[-1]['start_ts'].astimezone(dt_timezone.utc).replace(tzinfo=None)
+        response['hits']['next_before'] = '%sZ,%s' % (start_ts.isoformat(), reservations[-1]['id'])
+    payload_logger.info('Returning %s', Summary(response))
+    return JsonResponse(response)
+
+
+def prometheus_metrics(request):
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,28 @@
+"""
+ASGI config for parking_demo project.
+
+It exposes the ASGI callable as a module-level variable named ``application``
+and serves the parking endpoints with the async views of ``parking.async_views``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "parking_demo.settings")
+os.environ.setdefault("PARKING_ASYNC_VIEWS", "true")
+
+application = get_asgi_application()
+
+from parking import availability, slots, spatial_index  # noqa: E402
+
+# load the in-memory structures before the first request instead of during it
+if spatial_index.is_enabled():
+    spatial_index.get_index()
+if availability.is_enabled():
+    availability.get_engine()
+if slots.is_enabled():
+    slots.get_bitmaps()
@@ -40,6 +40,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'parking.middleware.MetricsMiddleware',
+    'parking.middleware.ProfilingMiddleware',
+    'parking.middleware.ReadYourWritesMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -69,18 +72,111 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'parking_demo.wsgi.application'
 
+ASGI_APPLICATION = 'parking_demo.asgi.application'
+
+# Route the parking endpoints to the async views, set by the asgi entry point
+PARKING_ASYNC_VIEWS = os.getenv('PARKING_ASYNC_VIEWS', 'false').lower() == 'true'
+# Threads running the database work of the async views
+PARKING_ASYNC_DB_THREADS = int(os.getenv('PARKING_ASYNC_DB_THREADS', 8))
+
 SPATIALITE_LIBRARY_PATH='/usr/local/miniconda2/envs/django/lib/mod_spatialite.so'
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
 
+# Connections are kept open by every worker thread, so SpatiaLite is loaded once per
+# connection instead of once per request.
+CONN_MAX_AGE = int(os.getenv('PARKING_CONN_MAX_AGE', 600))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.contrib.gis.db.backends.spatialite',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': CONN_MAX_AGE,
     }
 }
 
+# Read replicas, comma separated SQLite files, e.g. copies made by `manage.py sync_replicas`.
+# Searches read from them, writes and the checks guarding bookings go to 'default'.
+PARKING_READ_REPLICAS = []
+for replica_position, replica_file in enumerate(filter(None, os.getenv('PARKING_READ_REPLICA_FILES', '').split(','))):
+    DATABASES['replica_%s' % replica_position] = {
+        'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+        'NAME': replica_file,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'TEST': {'MIRROR': 'default'},
+    }
+    PARKING_READ_REPLICAS.append('replica_%s' % replica_position)
+
+# Geo shards of the parking spots and their reservations, ';' separated SQLite files
+# with the geohash prefixes they own, e.g. "west.sqlite3:9q,9r,c2;east.sqlite3:dr,dq".
+# Spots outside every prefix go to the first shard. Create the files with
+# `manage.py init_shards`.
+PARKING_SHARDS = []
+for shard_position, shard_spec in enumerate(filter(None, os.getenv('PARKING_SHARD_FILES', '').split(';'))):
+    shard_file, _, shard_prefixes = shard_spec.rpartition(':')
+    DATABASES['shard_%s' % shard_position] = {
+        'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+        'NAME': shard_file,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+    }
+    PARKING_SHARDS.append(('shard_%s' % shard_position, shard_prefixes.split(',')))
+# Threads querying the shards of a search in parallel
+PARKING_SHARD_THREADS = int(os.getenv('PARKING_SHARD_THREADS', 8))
+
+DATABASE_ROUTERS = ['parking.sharding.ShardRouter', 'parking.routers.ReadReplicaRouter']
+
+# Reads of a client stay on 'default' for this many seconds after it booked
+PARKING_READ_YOUR_WRITES_SECONDS = int(os.getenv('PARKING_READ_YOUR_WRITES_SECONDS', 5))
+
+# Serve radius searches from an in-memory grid index of the parking spots instead of
+# computing the distance to every row in SpatiaLite. Like the availability engine and
+# the slot bitmaps below it is loaded from 'default', so they are all off with shards.
+PARKING_SPATIAL_INDEX = os.getenv('PARKING_SPATIAL_INDEX', 'false').lower() == 'true' and not PARKING_SHARDS
+PARKING_SPATIAL_INDEX_CELL_DEGREES = 0.01
+# larger candidate sets fall back to the SQL distance filter
+PARKING_SPATIAL_INDEX_MAX_CANDIDATES = 900
+# Keep the coordinates in NumPy arrays and filter them with vectorised haversine
+# distances, when NumPy is installed, instead of the grid of Python dicts
+PARKING_SPATIAL_INDEX_NUMPY = os.getenv('PARKING_SPATIAL_INDEX_NUMPY', 'true').lower() == 'true'
+# Spot snapshot written by `manage.py build_spot_snapshot`. When the file exists the
+# spatial index searches it memory-mapped, shared by the workers, instead of loading
+# every spot, and picks up a new version within PARKING_SPOT_SNAPSHOT_CHECK_SECONDS.
+PARKING_SPOT_SNAPSHOT = os.getenv('PARKING_SPOT_SNAPSHOT') or None
+PARKING_SPOT_SNAPSHOT_CHECK_SECONDS = 5
+
+# Answer reservation conflicts from an in-memory schedule of the current and future
+# reservations of every spot instead of querying the reservation table.
+PARKING_AVAILABILITY_ENGINE = os.getenv('PARKING_AVAILABILITY_ENGINE', 'false').lower() == 'true' \
+    and not PARKING_SHARDS
+PARKING_AVAILABILITY_MAX_CANDIDATES = 900
+
+# Time a hold keeps a spot for the user to confirm the booking, see ParkingSpotReservation.hold
+PARKING_HOLD_SECONDS = int(os.getenv('PARKING_HOLD_SECONDS', '120'))
+
+# Answer windows aligned to 15 minute slots within the next 7 days from per-spot slot
+# bitmaps, a bitwise AND per candidate (vectorised with NumPy when it is installed).
+PARKING_SLOT_BITMAPS = os.getenv('PARKING_SLOT_BITMAPS', 'false').lower() == 'true' and not PARKING_SHARDS
+
+# Cache the available searches: None, 'local' for an in-process LRU or 'django' for the
+# cache named by PARKING_AVAILABILITY_CACHE_ALIAS, shared by the workers. Entries are
+# invalidated by the reservation and spot writes around them.
+PARKING_AVAILABILITY_CACHE = os.getenv('PARKING_AVAILABILITY_CACHE') or None
+PARKING_AVAILABILITY_CACHE_ALIAS = 'default'
+PARKING_AVAILABILITY_CACHE_TTL = 30
+PARKING_AVAILABILITY_CACHE_SIZE = 10000
+
+# Requests running more SQL queries are flagged with an X-Query-Budget-Exceeded header
+# and a warning, None (an empty or `none` value) disables the check
+PARKING_QUERY_BUDGET = os.getenv('PARKING_QUERY_BUDGET', '10').strip()
+PARKING_QUERY_BUDGET = None if PARKING_QUERY_BUDGET.lower() in ('', 'none') else int(PARKING_QUERY_BUDGET)
+
+# cProfile this fraction of the requests, and those with a valid X-Parking-Profile header
+# (parking.profiling.make_token), into PARKING_PROFILE_DIR
+PARKING_PROFILE_SAMPLE_RATE = float(os.getenv('PARKING_PROFILE_SAMPLE_RATE', 0))
+PARKING_PROFILE_DIR = os.getenv('PARKING_PROFILE_DIR', os.path.join(BASE_DIR, 'profiles'))
+PARKING_PROFILE_TOKEN_MAX_AGE = 3600
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -119,6 +215,9 @@ STATIC_URL = '/static/'
 
 import logging.config
 
+# the file handler's log, anchored to the project rather than the working directory
+PARKING_LOG_FILE = os.getenv('PARKING_LOG_FILE', os.path.join(BASE_DIR, 'parking.log'))
+
 # https://lincolnloop.com/blog/django-logging-right-way/
 LOGGING_CONFIG = None
 logging.config.dictConfig({
@@ -132,23 +231,36 @@ logging.config.dictConfig({
             'format': '%(asctime)s %(name)-12s %(levelname)-8s [%(filename)s:%(lineno)s - %(funcName)10s() ] %(message)s',
         },
     },
+    'filters': {
+        # payload summaries are only written for a sample of the requests
+        'sample_payloads': {
+            '()': 'parking.log.SampleFilter',
+            'rate': float(os.getenv('PARKING_LOG_PAYLOAD_SAMPLE_RATE', 0.01)),
+        },
+    },
     'handlers': {
+        # formatted and written by a background thread
         'console': {
-            'class': 'logging.StreamHandler',
+            '()': 'parking.log.BackgroundHandler',
             'formatter': 'console'
         },
         'file': {
             'level': 'DEBUG',
             'class': 'logging.FileHandler',
-            'filename': 'parking.log',
+            'filename': PARKING_LOG_FILE,
+            # only created once something logs to it
+            'delay': True,
         },
     },
     'loggers': {
         # root logger
         '': {
             'handlers': ['console'],
-            'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG'),
+            'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
             'propagate': True,
         },
+        'parking.payloads': {
+            'filters': ['sample_payloads'],
+        },
     },
 })
@@ -0,0 +1,12 @@
+"""
+Settings of the test runner, `./manage.py test` uses them by default.
+"""
+import os
+
+from parking_demo.settings import *  # noqa: F401,F403
+
+# Second shard of the sharded search tests, its database is only created by the test runner
+DATABASES['test_shard'] = {  # noqa: F405
+    'ENGINE': 'django.contrib.gis.db.backends.spatialite',
+    'NAME': os.path.join(BASE_DIR, 'test_shard.sqlite3'),  # noqa: F405
+}
@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from parking.views import prometheus_metrics
+
 urlpatterns = [
+    path('metrics', prometheus_metrics, name='metrics'),
     path('parking/', include('parking.urls')),
     path('admin/', admin.site.urls),
 ]
@@ -14,3 +14,13 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "parking_demo.settings")
 
 application = get_wsgi_application()
+
+from parking import availability, slots, spatial_index  # noqa: E402
+
+# load the in-memory structures before the first request instead of during it
+if spatial_index.is_enabled():
+    spatial_index.get_index()
+if availability.is_enabled():
+    availability.get_engine()
+if slots.is_enabled():
+    slots.get_bitmaps()